@@ -1,12 +1,15 @@
 import os
+import json
 import logging
 import time
+import hashlib
 from datetime import datetime
-from collections import OrderedDict
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from sqlalchemy import insert, delete
+from sqlalchemy.exc import IntegrityError
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, flash, session, abort
 from werkzeug.middleware.proxy_fix import ProxyFix
 from database import db
-from models import Agent, Assignment
+from models import Agent, Assignment, ComuneSet
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -32,13 +35,44 @@ db.init_app(app)
 
 # Import data utilities after app is created to avoid circular imports
 from data_utils import load_comuni_data
-from geo_utils import get_geojson_from_wfs
+from geo_utils import (get_geojson_fragments, iter_feature_collection, join_feature_collection, load_adjacency,
+                       get_bounds_and_center, filter_by_bbox)
+from geometry_store import load_fragments, select_lod, topology_store, data_version
+from comuni_index import ComuniIndex
+from istat_codes import IstatCodeResolver
+from vector_tiles import tile_renderer
+from territory_outlines import territory_outlines
+from spatial_index import spatial_index, parse_bbox
+from territory_partition import partition_territories
+from http_cache import cached_payload_response, not_modified_response
+from assignment_snapshot import assignment_snapshot, ensure_revision_row, current_revision, changes_since
+from invalidation_bus import invalidation_bus
+from change_stream import change_stream, MAX_STREAMS
+from assignment_import import detect_format, iter_rows, import_assignments
+from territory_export import iter_export_rows, iter_csv, iter_geojson
 
 # Initialize database
 with app.app_context():
     db.create_all()
+    # create_all non aggiunge gli indici alle tabelle già esistenti
+    for index in Assignment.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    # Riga del contatore di revisione delle assegnazioni
+    ensure_revision_row(db.session)
+    # Notifiche delle scritture degli altri worker (LISTEN/NOTIFY su PostgreSQL, polling su SQLite)
+    invalidation_bus.configure(db.engine, current_revision)
+    # Eventi per le mappe aperte, costruiti una volta per revisione dal thread del bus
+    invalidation_bus.subscribe(change_stream.publish)
+    invalidation_bus.start()
     # Load CSV data into memory
     comuni_data = load_comuni_data()
+    # Tabella alias -> codice ISTAT canonico e indice in memoria per le ricerche
+    # per codice, regione e provincia
+    code_resolver = IstatCodeResolver.from_comuni_data(comuni_data)
+    comuni_index = ComuniIndex(comuni_data, code_resolver)
+    # Carichiamo le geometrie e l'indice spaziale all'avvio del worker invece che alla prima richiesta
+    load_fragments()
+    spatial_index.load()
 
 @app.route('/')
 def index():
@@ -48,14 +82,10 @@ def index():
 @app.route('/assegnazione')
 def assegnazione():
     """Page with the municipality selection form for an agent"""
-    # Force refresh of database tables to ensure we have the latest data
-    db.session.expire_all()
-    db.session.close()
-    
     # Generate a timestamp to force cache invalidation on client side
     import_time = int(time.time())
     
-    regions = sorted(comuni_data['regione'].unique())
+    regions = comuni_index.regions
     
     # Verifica prima se è stato passato agent_id nel percorso
     agent_id = request.args.get('agent_id', type=int)
@@ -83,7 +113,7 @@ def get_provinces():
     if not region:
         return jsonify([])
     
-    provinces = sorted(comuni_data[comuni_data['regione'] == region]['provincia'].unique())
+    provinces = comuni_index.provinces(region)
     return jsonify(provinces)
 
 @app.route('/get_comuni', methods=['POST'])
@@ -94,14 +124,16 @@ def get_comuni():
         return jsonify([])
     
     # Get all comuni for this province
-    province_comuni = comuni_data[comuni_data['provincia'] == province][['codice', 'comune']].to_dict('records')
+    province_comuni = [
+        {'codice': comune['id'], 'comune': comune['name']}
+        for comune in comuni_index.comuni_in_province(province)
+    ]
     
     # Get list of all assigned comuni
-    assigned_comuni = []
+    assigned_comuni = {}
     try:
-        # Execute a fresh query to ensure we have the latest data
-        db.session.expire_all()  # Expire cached objects to force a fresh load
-        assigned_comuni = [a.comune_id for a in Assignment.query.all()]
+        # Snapshot in memoria, ricaricata solo se le assegnazioni sono cambiate
+        assigned_comuni = assignment_snapshot.load(db.session).agent_by_comune
     except Exception as e:
         logger.error(f"Error getting assigned comuni: {str(e)}")
     
@@ -124,18 +156,20 @@ def remove_comune():
         if not agent_id or not comune_id:
             return jsonify({'success': False, 'error': 'Dati mancanti'}), 400
         
+        # Le assegnazioni salvano il codice nel formato del CSV dei comuni
+        comune_data = comuni_index.get(comune_id)
+        stored_ids = {comune_id, comune_data['id']} if comune_data is not None else {comune_id}
+        
         # Elimina l'assegnazione se esiste
-        assignment = Assignment.query.filter_by(
-            agent_id=agent_id, 
-            comune_id=comune_id
+        assignment = Assignment.query.filter(
+            Assignment.agent_id == agent_id,
+            Assignment.comune_id.in_(stored_ids)
         ).first()
         
         if assignment:
             logger.debug(f"Removing assignment: comune {comune_id} from agent {agent_id}")
             db.session.delete(assignment)
             db.session.commit()
-            db.session.expire_all()
-            db.session.close()
             return jsonify({'success': True})
         else:
             return jsonify({'success': False, 'error': 'Assegnazione non trovata'}), 404
@@ -145,6 +179,13 @@ def remove_comune():
         logger.error(f"Error removing comune: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def _insert_assignments(agent_id, comune_ids):
+    """Insert the assignments of an agent with bulk INSERT statements (no commit)"""
+    now = datetime.now()
+    rows = [{'agent_id': agent_id, 'comune_id': comune_id, 'assignment_date': now} for comune_id in comune_ids]
+    for start in range(0, len(rows), QUERY_CHUNK_SIZE):
+        db.session.execute(insert(Assignment), rows[start:start + QUERY_CHUNK_SIZE])
+
 @app.route('/submit', methods=['POST'])
 def submit():
     """Process form submission for agent and selected municipalities"""
@@ -172,40 +213,44 @@ def submit():
         existing_agent = Agent.query.filter_by(name=agent_name).first()
         
         # First, process all inputs to validate them BEFORE any database changes
-        # Use a set to ensure no duplicate comune_ids
-        valid_comune_ids = set()
-        invalid_comuni = []
-        
+        # Keep only known comuni, without duplicates, in the order they were selected;
+        # any alias is converted to the code format of the comuni CSV, as stored in the assignments
+        candidate_ids = []
+        comuni_details = {}
+        lookup_ids = set()
         for comune_id in comune_ids:
-            # Skip if already processed
-            if comune_id in valid_comune_ids:
+            comune_data = comuni_index.get(comune_id)
+            if comune_data is None:
                 continue
-                
-            # Check if the comune is valid
-            comune_data = comuni_data[comuni_data['codice'] == comune_id]
-            if comune_data.empty:
+            lookup_ids.add(comune_id)
+            if comune_data['id'] in comuni_details:
                 continue
-                
-            # Check if comune is already assigned to another agent
-            # Force a fresh query to ensure we're working with the latest data
-            db.session.expire_all()
-            existing_assignment = Assignment.query.filter_by(comune_id=comune_id).first()
-            
-            if existing_agent and existing_assignment and existing_assignment.agent_id == existing_agent.id:
-                # Already assigned to this agent - keep it
-                valid_comune_ids.add(comune_id) 
-            elif existing_assignment:
+            comuni_details[comune_data['id']] = comune_data
+            candidate_ids.append(comune_data['id'])
+        
+        # Current assignments of all the selected comuni, with a single IN query per chunk
+        # (also by the submitted form of the code, for rows saved before the conversion)
+        lookup_ids = list(lookup_ids.union(candidate_ids))
+        current_owners = {}
+        for start in range(0, len(lookup_ids), QUERY_CHUNK_SIZE):
+            rows = db.session.query(Assignment.comune_id, Assignment.agent_id, Agent.name) \
+                .outerjoin(Agent, Assignment.agent_id == Agent.id) \
+                .filter(Assignment.comune_id.in_(lookup_ids[start:start + QUERY_CHUNK_SIZE])).all()
+            for comune_id, owner_id, owner_name in rows:
+                current_owners[comuni_index.get(comune_id)['id']] = (owner_id, owner_name)
+        
+        valid_comune_ids = []
+        invalid_comuni = []
+        for comune_id in candidate_ids:
+            owner = current_owners.get(comune_id)
+            if owner is None or (existing_agent and owner[0] == existing_agent.id):
+                # Not assigned to anyone, or already assigned to this agent - valid
+                valid_comune_ids.append(comune_id)
+            else:
                 # Assigned to another agent - not valid
-                comune_name = comune_data.iloc[0]['comune']
-                other_agent = Agent.query.get(existing_assignment.agent_id)
-                other_agent_name = other_agent.name if other_agent else "un altro agente"
+                comune_name = comuni_details[comune_id]['name']
+                other_agent_name = owner[1] or "un altro agente"
                 invalid_comuni.append(f'{comune_name} (già assegnato a {other_agent_name})')
-            else:
-                # Not assigned to anyone - valid
-                valid_comune_ids.add(comune_id)
-                
-        # Convert set back to list for further processing
-        valid_comune_ids = list(valid_comune_ids)
                 
         # If there are invalid comuni, alert the user but don't stop the process for valid ones
         if invalid_comuni:
@@ -224,34 +269,32 @@ def submit():
             existing_agent.phone = agent_phone  # Update phone number
             existing_agent.email = agent_email  # Update email
             
-            # Get existing comune assignments for this agent
-            # Ensure we're using fresh data
-            db.session.expire_all()
-            existing_assignments = Assignment.query.filter_by(agent_id=existing_agent.id).all()
-            existing_comuni_ids = [assignment.comune_id for assignment in existing_assignments]
+            # Get existing comune assignments for this agent, stored form -> code as saved
+            existing_rows = {}
+            for (comune_id,) in db.session.query(Assignment.comune_id).filter_by(agent_id=existing_agent.id):
+                comune_data = comuni_index.get(comune_id)
+                existing_rows[comune_data['id'] if comune_data is not None else comune_id] = comune_id
+            existing_comuni_ids = set(existing_rows)
+            selected_ids = set(valid_comune_ids)
             
-            # Remove assignments that are no longer selected
-            for assignment in existing_assignments:
-                if assignment.comune_id not in valid_comune_ids:
-                    logger.debug(f"Removing comune {assignment.comune_id} from agent {existing_agent.id}")
-                    db.session.delete(assignment)
+            # Remove assignments that are no longer selected, with bulk deletes
+            removed_ids = [existing_rows[comune_id] for comune_id in existing_comuni_ids
+                           if comune_id not in selected_ids]
+            for start in range(0, len(removed_ids), QUERY_CHUNK_SIZE):
+                db.session.execute(delete(Assignment).where(
+                    Assignment.agent_id == existing_agent.id,
+                    Assignment.comune_id.in_(removed_ids[start:start + QUERY_CHUNK_SIZE])
+                ))
             
-            # Add new comune assignments
-            for comune_id in valid_comune_ids:
-                if comune_id not in existing_comuni_ids:
-                    logger.debug(f"Adding comune {comune_id} to agent {existing_agent.id}")
-                    new_assignment = Assignment(
-                        agent_id=existing_agent.id,
-                        comune_id=comune_id
-                    )
-                    db.session.add(new_assignment)
+            # Add new comune assignments with a bulk insert
+            _insert_assignments(existing_agent.id,
+                                [comune_id for comune_id in valid_comune_ids if comune_id not in existing_comuni_ids])
+            logger.debug(f"Agent {existing_agent.id}: removed {len(removed_ids)} comuni, "
+                         f"{len(selected_ids - existing_comuni_ids)} added")
             
+            # Everything in a single transaction
             db.session.commit()
             
-            # Ensure the cache is cleared after commit
-            db.session.expire_all()
-            db.session.close()
-            
             flash(f'Aggiornate le assegnazioni per l\'agente {agent_name}', 'success')
         else:
             # Create new agent with color
@@ -265,26 +308,16 @@ def submit():
             db.session.add(new_agent)
             db.session.flush()  # Get the ID of the new agent
             
-            # Add comune assignments
-            for comune_id in valid_comune_ids:
-                logger.debug(f"Adding comune {comune_id} to new agent {new_agent.id}")
-                new_assignment = Assignment(
-                    agent_id=new_agent.id,
-                    comune_id=comune_id
-                )
-                db.session.add(new_assignment)
+            # Add comune assignments with a bulk insert
+            _insert_assignments(new_agent.id, valid_comune_ids)
+            logger.debug(f"Added {len(valid_comune_ids)} comuni to new agent {new_agent.id}")
             
             db.session.commit()
             
-            # Ensure the cache is cleared after commit
-            db.session.expire_all()
-            db.session.close()
-            
             flash(f'Nuovo agente {agent_name} registrato con successo', 'success')
         
         # Store in session for map display
-        session['agent_name'] = agent_name
-        session['comune_ids'] = comune_ids
+        _remember_selection(agent_name, comune_ids)
         
         return redirect(url_for('visualizza_mappa'))
         
@@ -294,9 +327,37 @@ def submit():
         flash(f'Errore durante il salvataggio: {str(e)}', 'danger')
         return redirect(url_for('assegnazione'))
 
+def _remember_selection(agent_name, comune_ids):
+    """
+    Keep the selection shown by visualizza_mappa in the session.
+    
+    The codes are registered as a comune set (database table plus process
+    cache) and the cookie only carries its digest, so its size does not
+    depend on the number of selected comuni.
+    
+    Returns:
+        str: Digest of the registered set, None if the selection is empty
+    """
+    digest = register_comune_set(comune_ids)[0] if comune_ids else None
+    session['agent_name'] = agent_name
+    session['comune_set'] = digest
+    # Le sessioni precedenti contenevano l'elenco completo dei codici
+    session.pop('comune_ids', None)
+    return digest
+
+def _selected_comune_ids():
+    """Return the comuni of the selection stored in the session"""
+    digest = session.get('comune_set')
+    if digest:
+        return load_comune_set(digest) or []
+    return session.get('comune_ids', [])
+
 @app.route('/visualizza_mappa', methods=['GET', 'POST'])
 def visualizza_mappa():
     """Display the map with selected municipalities"""
+    # Revisione delle assegnazioni da cui la mappa chiederà gli aggiornamenti
+    assignments_revision = assignment_snapshot.load(db.session).revision
+    
     # Inizializziamo agent_id per evitare warning
     agent_id = None
     
@@ -312,12 +373,11 @@ def visualizza_mappa():
         logger.info(f"Visualizzazione mappa richiesta direttamente: Agente={agent_name}, Comuni={comune_ids}")
         
         # Salva i dati in sessione per retrocompatibilità
-        session['agent_name'] = agent_name
-        session['comune_ids'] = comune_ids
+        _remember_selection(agent_name, comune_ids)
     else:
         # Logica originale per richieste GET (retrocompatibilità)
         agent_name = session.get('agent_name')
-        comune_ids = session.get('comune_ids', [])
+        comune_ids = _selected_comune_ids()
         
         if not agent_name:
             flash('Seleziona prima un agente', 'warning')
@@ -336,14 +396,9 @@ def visualizza_mappa():
             continue
             
         processed_ids.add(comune_id)  # Marca questo ID come elaborato
-        comune_row = comuni_data[comuni_data['codice'] == comune_id]
-        if not comune_row.empty:
-            comuni_details.append({
-                'id': comune_id,
-                'name': comune_row.iloc[0]['comune'],
-                'province': comune_row.iloc[0]['provincia'],
-                'region': comune_row.iloc[0]['regione']
-            })
+        comune_details = comuni_index.get(comune_id)
+        if comune_details is not None:
+            comuni_details.append(comune_details)
     
     # Se siamo in modalità POST ma l'agente non esiste nel database, 
     # usiamo direttamente i dati del form
@@ -371,6 +426,12 @@ def visualizza_mappa():
     # Aggiorna anche la lista degli ID dei comuni eliminando i duplicati
     unique_comune_ids = list(processed_ids)
     
+    # URL GET cacheabile con le geometrie dei comuni selezionati
+    geometry_url = None
+    if unique_comune_ids:
+        digest, _ = register_comune_set(unique_comune_ids)
+        geometry_url = comune_set_url(digest, output_format='topojson')
+    
     return render_template('mappa.html', 
                           agent_name=agent_name, 
                           agent_color=agent_color,
@@ -378,91 +439,198 @@ def visualizza_mappa():
                           agent_phone=agent_phone,  # Passiamo il numero di telefono al template
                           comuni=comuni_details,
                           comune_ids=unique_comune_ids,
+                          geometry_url=geometry_url,
+                          assignments_revision=assignments_revision,
                           google_maps_api_key=google_maps_api_key)
 
+def _canonical_set(comune_ids):
+    """Return the sorted, deduplicated canonical ISTAT codes of a set of municipalities"""
+    return sorted(set(code_resolver.canonical(c) for c in comune_ids))
+
+def _comune_set_digest(canonical_ids):
+    """Return the content digest of a canonical set of municipalities"""
+    return hashlib.sha1(','.join(canonical_ids).encode()).hexdigest()
+
+# Insiemi di comuni già registrati, per digest: il contenuto di un digest non cambia
+# mai, quindi possono restare in memoria senza invalidazione
+_comune_sets = {}
+MAX_CACHED_COMUNE_SETS = 256
+
+def _remember_comune_set(digest, canonical_ids):
+    """Keep a registered set in memory, dropping the oldest one when the cache is full"""
+    if len(_comune_sets) >= MAX_CACHED_COMUNE_SETS:
+        _comune_sets.pop(next(iter(_comune_sets)))
+    _comune_sets[digest] = canonical_ids
+
+def register_comune_sets(comune_id_sets):
+    """
+    Register several sets of municipalities with a constant number of queries.
+    
+    The digest only depends on the canonical codes, so registering the same
+    set again (in any order or code format) returns the same digest.
+    
+    Args:
+        comune_id_sets (list): Iterables of ISTAT codes in any supported format
+    
+    Returns:
+        list: (digest, list of canonical codes) for each set, in the same order
+    """
+    entries = []
+    for comune_ids in comune_id_sets:
+        canonical_ids = _canonical_set(comune_ids)
+        entries.append((_comune_set_digest(canonical_ids), canonical_ids))
+    
+    unknown = {digest: canonical_ids for digest, canonical_ids in entries if digest not in _comune_sets}
+    if unknown:
+        existing = {digest for (digest,) in
+                    db.session.query(ComuneSet.digest).filter(ComuneSet.digest.in_(list(unknown)))}
+        new_sets = [ComuneSet(digest=digest, comune_ids=','.join(canonical_ids))
+                    for digest, canonical_ids in unknown.items() if digest not in existing]
+        if new_sets:
+            db.session.add_all(new_sets)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Qualche insieme è stato registrato nel frattempo da un altro worker:
+                # il contenuto è lo stesso, inseriamo solo quelli che mancano ancora
+                db.session.rollback()
+                for comune_set in new_sets:
+                    if db.session.get(ComuneSet, comune_set.digest) is None:
+                        db.session.add(ComuneSet(digest=comune_set.digest, comune_ids=comune_set.comune_ids))
+                        db.session.commit()
+        for digest, canonical_ids in unknown.items():
+            _remember_comune_set(digest, canonical_ids)
+    
+    return entries
+
+def register_comune_set(comune_ids):
+    """
+    Register a set of municipalities and return its digest.
+    
+    Args:
+        comune_ids (list): ISTAT codes in any supported format
+    
+    Returns:
+        tuple: (digest, list of canonical codes)
+    """
+    return register_comune_sets([comune_ids])[0]
+
+def _assignments_by_agent():
+    """
+    Return all the assignments grouped by agent, from the assignment snapshot.
+    
+    Returns:
+        Mapping: agent_id -> tuple of comune IDs, in assignment order
+    """
+    return assignment_snapshot.load(db.session).comuni_by_agent
+
+def load_comune_set(digest):
+    """Return the canonical codes of a registered set, or None if the digest is unknown"""
+    canonical_ids = _comune_sets.get(digest)
+    if canonical_ids is None:
+        comune_set = db.session.get(ComuneSet, digest)
+        if comune_set is None:
+            return None
+        canonical_ids = comune_set.comune_ids.split(',') if comune_set.comune_ids else []
+        _remember_comune_set(digest, canonical_ids)
+    return canonical_ids
+
+def comune_set_url(digest, output_format=None, zoom=None):
+    """URL of the cacheable geometry of a registered set, bound to the current geometry data"""
+    return url_for('geojson_by_digest', digest=digest, v=data_version(), format=output_format, zoom=zoom)
+
+def _geometry_response(comune_set_hash, load_comune_ids, output_format='geojson', zoom=None, tolerance=None,
+                       bbox=None, stream=False):
+    """
+    Build the geometry response for a set of municipalities.
+    
+    The response is compressed according to Accept-Encoding and carries a
+    strong ETag derived only from the request (digest of the comune set,
+    format, level of detail, bbox) and the version of the geometry files on
+    disk: a client that already has it gets a 304 before the comune set, the
+    spatial index or the geometry store are read.
+    
+    Args:
+        comune_set_hash (str): Digest of the canonical comune set
+        load_comune_ids (callable): Function returning the ISTAT codes of the set
+    """
+    lod = select_lod(zoom, tolerance)
+    etag_parts = (output_format, lod, comune_set_hash, bbox, data_version())
+    if not stream:
+        not_modified = not_modified_response(etag_parts)
+        if not_modified is not None:
+            return not_modified
+    
+    def visible_comuni():
+        comune_ids = load_comune_ids()
+        unknown_ids = [comune_id for comune_id in comune_ids if code_resolver.resolve(comune_id) is None]
+        if unknown_ids:
+            logger.warning(f"Comune IDs not found in dataset: {unknown_ids}")
+        # Con un'area visibile la risposta contiene solo i comuni che la intersecano
+        return filter_by_bbox(_canonical_set(comune_ids), bbox)
+    
+    def build_topojson(visible_ids, topology):
+        # Formato TopoJSON: solo gli archi usati dai comuni richiesti, quantizzati
+        subset, missing = topology.subset(visible_ids)
+        subset['bbox'], subset['center'] = get_bounds_and_center(visible_ids)
+        if missing:
+            logger.warning(f"Comune IDs not found in topology: {missing}")
+        logger.info(f"Returning TopoJSON with {len(visible_ids) - len(missing)} geometries "
+                    f"and {len(subset['arcs'])} arcs")
+        return json.dumps(subset, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    
+    def geojson_parts(visible_ids):
+        # Le feature arrivano già serializzate dall'ETL, con i nomi definitivi dei comuni:
+        # la risposta si compone concatenando i frammenti, senza ricodificare le coordinate
+        fragments = get_geojson_fragments(visible_ids, resolver=code_resolver,
+                                          name_lookup=comuni_index.name, lod=lod)
+        logger.info(f"Returning GeoJSON with {len(fragments)} features (level of detail: {lod})")
+        # Riquadro e centro complessivi dalle metriche precalcolate, in O(numero di comuni)
+        extent, center = get_bounds_and_center(visible_ids, lod)
+        return fragments, ({'bbox': extent, 'center': center} if extent is not None else None)
+    
+    def build_payload():
+        visible_ids = visible_comuni()
+        if output_format == 'topojson':
+            topology = topology_store.load()
+            if topology is not None:
+                return build_topojson(visible_ids, topology)
+            logger.warning("Topology not found, falling back to GeoJSON")
+        return join_feature_collection(*geojson_parts(visible_ids))
+    
+    if stream:
+        return Response(iter_feature_collection(*geojson_parts(visible_comuni())), mimetype='application/json')
+    
+    return cached_payload_response(etag_parts, build_payload)
+
 @app.route('/get_geojson', methods=['POST'])
 def get_geojson():
     """Get GeoJSON data for the selected municipalities"""
     comune_ids = request.json.get('comune_ids', [])
+    output_format = request.json.get('format', request.args.get('format', 'geojson'))
+    # Livello di dettaglio: dallo zoom della mappa o da una tolleranza esplicita
+    zoom = request.json.get('zoom', request.args.get('zoom'))
+    tolerance = request.json.get('tolerance', request.args.get('tolerance'))
+    # Area visibile della mappa: "minlon,minlat,maxlon,maxlat"
+    bbox = request.json.get('bbox', request.args.get('bbox'))
+    try:
+        zoom = int(zoom) if zoom is not None else None
+        tolerance = float(tolerance) if tolerance is not None else None
+        bbox = parse_bbox(bbox)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid zoom, tolerance or bbox', 'type': 'FeatureCollection', 'features': []}), 400
     
     if not comune_ids:
         logger.warning("No municipality IDs received in /get_geojson request")
         return jsonify({'error': 'No municipalities selected', 'type': 'FeatureCollection', 'features': []})
     
-    logger.info(f"Processing GeoJSON request for {len(comune_ids)} municipalities: {comune_ids}")
+    logger.info(f"Processing GeoJSON request for {len(comune_ids)} municipalities")
     
     try:
-        # Prima di ottenere il GeoJSON, otteniamo i nomi reali dei comuni per i popup
-        comuni_names = {}
-        # Creiamo un dizionario per mappare i formati diversi degli ID dei comuni
-        id_mapping = {}
-        
-        for comune_id in comune_ids:
-            # Costruiamo le possibili varianti per l'ID del comune
-            comune_id_str = str(comune_id).strip()
-            variants = [comune_id_str]
-            
-            # Se è un codice di 6 cifre che inizia con 0, aggiungiamo anche la versione senza 0
-            if len(comune_id_str) == 6 and comune_id_str.startswith('0'):
-                variants.append(comune_id_str[1:])  # senza lo zero iniziale
-            
-            # Se è un id che inizia con 13 (Como), aggiungiamo anche con lo 0 davanti
-            if comune_id_str.startswith('13') and len(comune_id_str) == 5:
-                variants.append(f"0{comune_id_str}")
-                
-            # Se è un codice di 5 cifre che inizia con 97, aggiungiamo la versione con 0
-            if len(comune_id_str) == 5 and comune_id_str.startswith('97'):
-                variants.append(f"0{comune_id_str}")
-            
-            # Cerchiamo in tutte le varianti possibili
-            found = False
-            for variant in variants:
-                comune_row = comuni_data[comuni_data['codice'] == variant]
-                if not comune_row.empty:
-                    name = comune_row.iloc[0]['comune']
-                    comuni_names[comune_id_str] = name
-                    for v in variants:
-                        id_mapping[v] = comune_id_str
-                    logger.debug(f"Found name for comune {variant}: {name}")
-                    found = True
-                    break
-            
-            if not found:
-                logger.warning(f"Comune ID not found in dataset: {comune_id_str} (tried variants: {variants})")
-        
-        # Eliminiamo i duplicati per evitare problemi di visualizzazione
-        unique_comune_ids = list(OrderedDict.fromkeys(comune_ids))
-        logger.info(f"Removed duplicates: {len(comune_ids)} -> {len(unique_comune_ids)} unique IDs")
-        
-        # Richiamiamo il servizio WFS per ottenere i poligoni
-        geojson = get_geojson_from_wfs(unique_comune_ids)
-        
-        # Verifichiamo che il GeoJSON sia valido e contenga features
-        if not geojson or 'features' not in geojson or not isinstance(geojson['features'], list):
-            logger.error(f"Invalid GeoJSON structure received from WFS service")
-            return jsonify({'error': 'Invalid GeoJSON structure', 'type': 'FeatureCollection', 'features': []})
-            
-        # Arricchiamo il GeoJSON con i nomi reali dei comuni
-        for feature in geojson['features']:
-            if 'properties' in feature and 'id' in feature['properties']:
-                comune_id = feature['properties']['id']
-                
-                # Cerchiamo nel mapping degli ID (normalizzati)
-                mapped_id = id_mapping.get(comune_id, comune_id)
-                
-                if mapped_id in comuni_names:
-                    feature['properties']['name'] = comuni_names[mapped_id]
-                else:
-                    # Se non troviamo il nome, proviamo a cercarlo direttamente nel dataframe
-                    comune_row = comuni_data[comuni_data['codice'] == comune_id]
-                    if not comune_row.empty:
-                        feature['properties']['name'] = comune_row.iloc[0]['comune']
-                    else:
-                        # Se ancora non troviamo il nome, manteniamo almeno l'ID come identificativo
-                        feature['properties']['name'] = f"Comune {comune_id}"
-        
-        logger.info(f"Returning GeoJSON with {len(geojson['features'])} features")
-        return jsonify(geojson)
+        # Insieme canonico dei comuni: stesso insieme -> stessa risposta, in qualsiasi ordine
+        comune_set_hash = _comune_set_digest(_canonical_set(comune_ids))
+        return _geometry_response(comune_set_hash, lambda: comune_ids, output_format, zoom, tolerance, bbox,
+                                  stream=bool(request.args.get('stream', type=int)))
     except Exception as e:
         logger.error(f"Error fetching GeoJSON: {str(e)}")
         import traceback
@@ -473,13 +641,78 @@ def get_geojson():
             'features': []
         })
 
+@app.route('/geojson/sets', methods=['POST'])
+def register_geojson_set():
+    """
+    Register a set of municipalities for the cacheable GET endpoint.
+    
+    Returns the digest of the set and the URL of its geometry, which can be
+    cached by browsers and proxies until the geometry data changes.
+    """
+    comune_ids = request.json.get('comune_ids', [])
+    output_format = request.json.get('format')
+    zoom = request.json.get('zoom')
+    try:
+        zoom = int(zoom) if zoom is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid zoom'}), 400
+    
+    if not comune_ids:
+        return jsonify({'error': 'No municipalities selected'}), 400
+    
+    digest, canonical_ids = register_comune_set(comune_ids)
+    logger.info(f"Registered comune set {digest} with {len(canonical_ids)} municipalities")
+    return jsonify({
+        'digest': digest,
+        'count': len(canonical_ids),
+        'url': comune_set_url(digest, output_format, zoom)
+    })
+
+@app.route('/geojson/<digest>')
+def geojson_by_digest(digest):
+    """
+    Get the geometry of a registered set of municipalities.
+    
+    The content of a digest never changes, so when the URL carries the
+    current geometry data version (v) the response can be cached for a year;
+    otherwise it is served with no-cache and revalidated through its ETag.
+    """
+    if len(digest) != 40 or not all(c in '0123456789abcdef' for c in digest):
+        abort(404)
+    
+    output_format = request.args.get('format', 'geojson')
+    try:
+        zoom = int(request.args['zoom']) if request.args.get('zoom') else None
+        tolerance = float(request.args['tolerance']) if request.args.get('tolerance') else None
+        bbox = parse_bbox(request.args.get('bbox'))
+    except ValueError:
+        return jsonify({'error': 'Invalid zoom, tolerance or bbox', 'type': 'FeatureCollection', 'features': []}), 400
+    
+    def load_ids():
+        canonical_ids = load_comune_set(digest)
+        if canonical_ids is None:
+            raise LookupError(digest)
+        return canonical_ids
+    
+    try:
+        response = _geometry_response(digest, load_ids, output_format, zoom, tolerance, bbox)
+    except LookupError:
+        abort(404)
+    except Exception as e:
+        logger.error(f"Error fetching GeoJSON for comune set {digest}: {str(e)}")
+        import traceback
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e), 'type': 'FeatureCollection', 'features': []}), 500
+    
+    if request.args.get('v') == data_version():
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/agents')
 def list_agents():
     """List all registered agents and their assigned municipalities"""
-    # Force refresh of database tables to ensure we have the latest data
-    db.session.expire_all()
-    db.session.close()
-    
     # Generate a timestamp to force cache invalidation on client side
     import_time = int(time.time())
     
@@ -499,25 +732,22 @@ def list_agents():
         '#ffc107', '#ff9800', '#ff5722', '#795548', '#607d8b'
     ]
     
+    # Tutte le assegnazioni con una sola query, raggruppate per agente in memoria
+    assignments_by_agent = _assignments_by_agent()
+    colors_changed = False
+    
     for i, agent in enumerate(agents):
         # Assicuriamoci che ogni agente abbia un colore
         if not agent.color:
             # Assegniamo un colore predefinito se non ne ha uno
             agent.color = default_colors[i % len(default_colors)]
-            db.session.commit()
-            
-        assignments = Assignment.query.filter_by(agent_id=agent.id).all()
-        comuni = []
+            colors_changed = True
         
-        for assignment in assignments:
-            comune_row = comuni_data[comuni_data['codice'] == assignment.comune_id]
-            if not comune_row.empty:
-                comuni.append({
-                    'id': assignment.comune_id,
-                    'name': comune_row.iloc[0]['comune'],
-                    'province': comune_row.iloc[0]['provincia'],
-                    'region': comune_row.iloc[0]['regione']
-                })
+        comuni = []
+        for comune_id in assignments_by_agent.get(agent.id, []):
+            comune_details = comuni_index.get(comune_id)
+            if comune_details is not None:
+                comuni.append(comune_details)
         
         agent_data.append({
             'id': agent.id,
@@ -529,14 +759,17 @@ def list_agents():
             'comuni': comuni
         })
     
+    # Un solo commit per tutti i colori assegnati
+    if colors_changed:
+        db.session.commit()
+    
     return render_template('agents.html', agents=agent_data, import_time=import_time)
 
 @app.route('/mappa_completa')
 def mappa_completa():
     """Visualizza la mappa completa con i territori di tutti gli agenti"""
-    # Force refresh of database tables to ensure we have the latest data
-    db.session.expire_all()
-    db.session.close()
+    # Revisione letta prima dei dati: il client chiederà le modifiche successive a questa
+    assignments_revision = assignment_snapshot.load(db.session).revision
     
     # Get Google Maps API key from environment
     google_maps_api_key = os.environ.get('GOOGLE_MAPS_API_KEY', '')
@@ -556,30 +789,27 @@ def mappa_completa():
         '#ffc107', '#ff9800', '#ff5722', '#795548', '#607d8b'
     ]
     
+    # Tutte le assegnazioni con una sola query, raggruppate per agente in memoria
+    assignments_by_agent = _assignments_by_agent()
+    
     # Raccogliamo tutti i dati
     for i, agent in enumerate(agents):
         # Assicuriamoci che ogni agente abbia un colore
         agent_color = agent.color if agent.color else default_colors[i % len(default_colors)]
         
-        assignments = Assignment.query.filter_by(agent_id=agent.id).all()
         agent_comuni = []
         
-        for assignment in assignments:
-            comune_id = assignment.comune_id
+        for comune_id in assignments_by_agent.get(agent.id, []):
             all_comuni_ids.append(comune_id)
             
-            comune_row = comuni_data[comuni_data['codice'] == comune_id]
-            if not comune_row.empty:
-                comune_info = {
-                    'id': comune_id,
-                    'name': comune_row.iloc[0]['comune'],
-                    'province': comune_row.iloc[0]['provincia'],
-                    'region': comune_row.iloc[0]['regione'],
+            comune_info = comuni_index.get(comune_id)
+            if comune_info is not None:
+                comune_info.update({
                     'agent_id': agent.id,
                     'agent_name': agent.name,
                     'agent_color': agent_color,
                     'agent_phone': agent.phone  # Aggiungiamo il numero di telefono
-                }
+                })
                 agent_comuni.append(comune_info)
                 all_comuni_details.append(comune_info)
         
@@ -593,6 +823,14 @@ def mappa_completa():
             'count': len(agent_comuni)
         })
     
+    # URL GET cacheabili con le geometrie dei territori, registrati tutti insieme
+    territories = [agent for agent in agent_data if agent['comuni']]
+    registered = register_comune_sets([comune['id'] for comune in agent['comuni']] for agent in territories)
+    for agent in agent_data:
+        agent['geometry_url'] = None
+    for agent, (digest, _) in zip(territories, registered):
+        agent['geometry_url'] = comune_set_url(digest)
+    
     # Rimuoviamo i comuni duplicati, preservando l'assegnazione univoca
     # (Questo non dovrebbe essere necessario data la constraint sulla tabella Assignment,
     # ma è un controllo di sicurezza)
@@ -607,12 +845,650 @@ def mappa_completa():
     # Assumendo che il cognome sia l'ultima parola del nome completo
     agent_data.sort(key=lambda x: x['name'].split()[-1] if x['name'] and ' ' in x['name'] else x['name'])
     
+    # Revisione delle assegnazioni per l'URL delle tile e riquadro dei territori assegnati
+    _, tiles_revision = _tile_assignments()
+    extent, _ = get_bounds_and_center(code_resolver.canonical(c) for c in all_comuni_ids)
+    territory_bounds = [[extent[1], extent[0]], [extent[3], extent[2]]] if extent is not None else None
+    
     return render_template('mappa_completa.html',
                           agents=agent_data,
+                          assignments_revision=assignments_revision,
                           all_comuni=unique_comuni_details,
                           comune_ids=all_comuni_ids,
+                          tiles_revision=tiles_revision,
+                          territory_bounds=territory_bounds,
                           google_maps_api_key=google_maps_api_key)
 
+# Attributi delle tile calcolati sull'ultima snapshot delle assegnazioni: (snapshot, risultato)
+_tile_assignments_cache = (None, None)
+
+def _tile_assignments():
+    """
+    Return the tile attributes of every assigned municipality.
+    
+    The attributes are derived from the assignment snapshot and computed
+    again only when its revision changes.
+    
+    Returns:
+        tuple: (dict canonical ISTAT code -> attributes, revision of the assignments)
+    """
+    global _tile_assignments_cache
+    snapshot = assignment_snapshot.load(db.session)
+    cached_snapshot, result = _tile_assignments_cache
+    if cached_snapshot is snapshot:
+        return result
+    
+    assignments = {}
+    for comune_id, agent_id in snapshot.agent_by_comune.items():
+        agent = snapshot.agents.get(agent_id)
+        if agent is None:
+            continue
+        assignments[code_resolver.canonical(comune_id)] = {
+            'agent_id': agent_id,
+            'agent_name': agent.name,
+            'agent_color': agent.color or '#ff9800'
+        }
+    
+    # La revisione cambia con qualsiasi assegnazione, rimozione o cambio di colore
+    revision = hashlib.sha1(repr(sorted(
+        (comune_id, attributes['agent_id'], attributes['agent_color'])
+        for comune_id, attributes in assignments.items()
+    )).encode()).hexdigest()[:16]
+    
+    result = (assignments, revision)
+    _tile_assignments_cache = (snapshot, result)
+    return result
+
+def _revision_not_modified(resource):
+    """
+    Answer a conditional request for a URL carrying the tiles revision (rev).
+    
+    The ETag of these responses is built from the resource, the revision and
+    the geometry data version, so a client that sends it back for the same
+    rev gets a 304 before the assignments are loaded.
+    
+    Args:
+        resource (tuple): Identifies the response (e.g. the tile coordinates)
+    
+    Returns:
+        Response: 304 response, or None if the request must be served
+    """
+    revision = request.args.get('rev')
+    if not revision:
+        return None
+    response = not_modified_response(resource + (revision, data_version()))
+    if response is not None:
+        response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.pbf')
+def vector_tile(z, x, y):
+    """Mapbox Vector Tile with the assigned municipalities"""
+    if z > 20 or x >= (1 << z) or y >= (1 << z):
+        abort(404)
+    
+    # L'ETag dipende solo dalla revisione nell'URL e dai file delle geometrie:
+    # una tile già in cache si conferma senza leggere le assegnazioni
+    not_modified = _revision_not_modified(('tile', z, x, y))
+    if not_modified is not None:
+        return not_modified
+    
+    assignments, revision = _tile_assignments()
+    response = cached_payload_response(
+        ('tile', z, x, y, revision, data_version()),
+        lambda: tile_renderer.render(z, x, y, assignments),
+        mimetype='application/vnd.mapbox-vector-tile'
+    )
+    # Il browser può tenere la tile solo se l'URL contiene la revisione corrente
+    if request.args.get('rev') == revision:
+        response.headers['Cache-Control'] = 'public, max-age=86400'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/territories')
+def territory_outlines_geojson():
+    """
+    One dissolved outline per agent, for the overview map at low zoom.
+    
+    Each outline is cached per agent and computed again only when that
+    agent's assignments change.
+    """
+    not_modified = _revision_not_modified(('territories',))
+    if not_modified is not None:
+        return not_modified
+    
+    assignments, revision = _tile_assignments()
+    
+    def build_outlines():
+        territories = {}
+        for comune_id, attributes in assignments.items():
+            agent_id = attributes['agent_id']
+            if agent_id not in territories:
+                territories[agent_id] = (dict(attributes), [])
+            territories[agent_id][1].append(comune_id)
+        for properties, comune_ids in territories.values():
+            properties['count'] = len(comune_ids)
+        return territory_outlines.feature_collection(territories)
+    
+    response = cached_payload_response(('territories', revision, data_version()), build_outlines)
+    if request.args.get('rev') == revision:
+        response.headers['Cache-Control'] = 'public, max-age=86400'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/assignments/changes')
+def assignment_changes():
+    """
+    Assignments changed since a revision, so that open maps can patch their
+    layers instead of downloading every territory again.
+    
+    Query parameters:
+        since (int): Revision the client already has (from the page or the previous call)
+        zoom (int): Map zoom, selects the level of detail of the geometries
+        geometry (int): 0 to omit the geometries of the assigned comuni
+    
+    The response is a FeatureCollection with the geometries of the comuni
+    assigned or reassigned since then, and the members:
+        since: The requested revision
+        revision: Revision to pass as since in the next call
+        assignments: canonical ISTAT code -> agent ID, for those comuni
+        removed: Canonical codes of the comuni that are no longer assigned
+        agents: agent ID -> current attributes, for the agents involved or
+            changed (e.g. recolored)
+        removed_agents: IDs of the deleted agents
+        tiles_revision: Current revision of the tiles and outlines URLs
+        reset: true if the log no longer covers since: the map must be reloaded
+    """
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'error': 'Missing or invalid since'}), 400
+    zoom = request.args.get('zoom', type=int)
+    with_geometry = request.args.get('geometry', '1') != '0'
+    
+    snapshot = assignment_snapshot.load(db.session)
+    members = _assignment_delta(snapshot, since)
+    if members is None:
+        return jsonify({'revision': snapshot.revision, 'reset': True})
+    assignments = members['assignments']
+    
+    lod = select_lod(zoom)
+    _, store = load_fragments(lod)
+    store_version = store.version if store is not None else None
+    
+    def build_changes():
+        fragments = []
+        if with_geometry and assignments:
+            fragments = get_geojson_fragments(sorted(assignments), resolver=code_resolver,
+                                              name_lookup=comuni_index.name, lod=lod)
+        return join_feature_collection(fragments, members)
+    
+    response = cached_payload_response(('changes', since, snapshot.revision, lod, with_geometry, store_version),
+                                       build_changes)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _assignment_delta(snapshot, since):
+    """
+    Compute the changes between a revision and the snapshot.
+    
+    Args:
+        snapshot (AssignmentSnapshot): Current assignments
+        since (int): Revision the client already has
+    
+    Returns:
+        dict: The members of the /api/assignments/changes response, or None
+            if the change log does not cover since
+    """
+    if since > snapshot.revision:
+        # Pagina resa da un altro worker dopo una scrittura che il bus di questo worker
+        # non ha ancora visto (fino a POLL_INTERVAL su SQLite): niente di nuovo per ora
+        if current_revision(db.session) < since:
+            # Revisione mai esistita in questo database (es. database ricreato)
+            return None
+        return {
+            'since': since,
+            'revision': since,
+            'reset': False,
+            'assignments': {},
+            'removed': [],
+            'agents': {},
+            'removed_agents': [],
+            'tiles_revision': _tile_assignments()[1]
+        }
+    
+    changes = changes_since(db.session, since, snapshot.revision)
+    if changes is None:
+        return None
+    comune_ids, agent_ids = changes
+    
+    # Lo stato attuale dei comuni toccati, non la sequenza delle modifiche
+    assignments = {}
+    removed = []
+    for comune_id in comune_ids:
+        agent_id = snapshot.agent_by_comune.get(comune_id)
+        if agent_id is None:
+            removed.append(code_resolver.canonical(comune_id))
+        else:
+            assignments[code_resolver.canonical(comune_id)] = agent_id
+    
+    agents = {}
+    for agent_id in agent_ids | set(assignments.values()):
+        agent = snapshot.agents.get(agent_id)
+        if agent is not None:
+            agents[agent_id] = {
+                'name': agent.name,
+                'phone': agent.phone,
+                'email': agent.email,
+                'color': agent.color or '#ff9800',
+                'count': len(snapshot.comuni_by_agent.get(agent_id, ()))
+            }
+    
+    _, tiles_revision = _tile_assignments()
+    members = {
+        'since': since,
+        'revision': snapshot.revision,
+        'reset': False,
+        'assignments': assignments,
+        'removed': sorted(removed),
+        'agents': agents,
+        'removed_agents': sorted(agent_id for agent_id in agent_ids if agent_id not in snapshot.agents),
+        'tiles_revision': tiles_revision
+    }
+    logger.debug(f"Changes {since} -> {snapshot.revision}: {len(assignments)} assigned, "
+                 f"{len(removed)} removed, {len(agents)} agents")
+    return members
+
+def _change_event(since):
+    """
+    Build the change event pushed to the open maps (called by the invalidation bus thread).
+    
+    Returns:
+        tuple: (revision, delta without geometries or None if not available)
+    """
+    with app.app_context():
+        snapshot = assignment_snapshot.load(db.session)
+        members = _assignment_delta(snapshot, since)
+        # Una snapshot ancora indietro rispetto a since non fa tornare indietro lo stream
+        return (members['revision'] if members is not None else snapshot.revision), members
+
+change_stream.configure(_change_event)
+
+@app.route('/api/assignments/stream')
+def assignment_stream():
+    """
+    Server-Sent Events stream of the assignment changes.
+    
+    Each 'changes' event carries the same members as /api/assignments/changes,
+    without geometries: clients apply removals and agent attributes (e.g. a
+    new color) directly and fetch the geometries of newly assigned comuni
+    from /api/assignments/changes. A 'resync' event asks the client to call
+    that endpoint. The events are built once per worker for each revision,
+    whatever the number of open streams.
+    
+    Query parameters:
+        since (int): Revision the client already has; on reconnection the
+            browser sends it as Last-Event-ID
+    """
+    if change_stream.active >= MAX_STREAMS:
+        response = jsonify({'error': 'Too many open streams'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+
+    # Avvia il thread del bus se questa è la prima richiesta del worker (es. dopo un fork):
+    # senza, lo stream non riceverebbe mai eventi
+    invalidation_bus.start()
+
+    response = Response(change_stream.stream(since), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # I proxy (es. nginx) non devono accumulare gli eventi
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/export/territories.<output_format>')
+def export_territories(output_format):
+    """
+    Export every assignment, joined with the comune and agent details, for GIS and BI tools.
+
+    The file is streamed one row (CSV) or feature (GeoJSON) at a time from
+    the assignment snapshot, so memory use does not depend on the number of
+    assignments; GeoJSON features carry the geometry of the geometry store.
+
+    Query parameters:
+        agent_id (int): Export only the territory of this agent
+        zoom (int): Level of detail of the geometries (GeoJSON only)
+    """
+    if output_format not in ('csv', 'geojson'):
+        abort(404)
+    agent_id = request.args.get('agent_id', type=int)
+
+    # La snapshot è immutabile: l'esportazione resta coerente anche se nel frattempo cambia qualcosa
+    snapshot = assignment_snapshot.load(db.session)
+    if agent_id is not None and agent_id not in snapshot.agents:
+        return jsonify({'error': 'Agent not found'}), 404
+    rows = iter_export_rows(snapshot, comuni_index, agent_id=agent_id)
+
+    if output_format == 'csv':
+        response = Response(iter_csv(rows), mimetype='text/csv')
+    else:
+        fragments, _ = load_fragments(select_lod(request.args.get('zoom', type=int)))
+        response = Response(iter_geojson(rows, fragments, {'revision': snapshot.revision}),
+                            mimetype='application/geo+json')
+
+    filename = f"territori_{snapshot.revision}" + (f"_agente_{agent_id}" if agent_id is not None else '')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{output_format}"'
+    response.headers['X-Assignments-Revision'] = str(snapshot.revision)
+    logger.info(f"Exporting territories as {output_format} at revision {snapshot.revision}")
+    return response
+
+# Numero massimo di punti per una richiesta di localizzazione in blocco
+MAX_LOCATE_POINTS = 10000
+# Livello di dettaglio dei poligoni usati per la localizzazione (il più preciso)
+LOCATE_LOD = 'stradale'
+# Dimensione dei blocchi di codici nelle query IN
+QUERY_CHUNK_SIZE = 500
+
+def _agents_for_comuni(canonical_ids):
+    """
+    Return the agent responsible for each of the given municipalities.
+    
+    Args:
+        canonical_ids (iterable): Canonical ISTAT codes
+    
+    Returns:
+        dict: canonical ISTAT code -> AgentRecord, only for the assigned comuni
+    """
+    snapshot = assignment_snapshot.load(db.session)
+    
+    agents = {}
+    for comune_id in set(canonical_ids):
+        # Le assegnazioni salvano il codice nel formato del CSV dei comuni
+        details = comuni_index.get(comune_id)
+        agent_id = snapshot.agent_by_comune.get(details['id'] if details is not None else comune_id)
+        if agent_id is None:
+            agent_id = snapshot.agent_by_comune.get(comune_id)
+        if agent_id is not None and agent_id in snapshot.agents:
+            agents[comune_id] = snapshot.agents[agent_id]
+    return agents
+
+def locate_points(lons, lats):
+    """
+    Find the municipality and the responsible agent for each point.
+    
+    Args:
+        lons, lats (list): Coordinates of the points, in degrees
+    
+    Returns:
+        list: One dict per point with the coordinates, the comune and the agent (or None)
+    """
+    index = spatial_index.load()
+    if index is None:
+        raise RuntimeError("Comuni geometries not available")
+    
+    fragments, _ = load_fragments(LOCATE_LOD)
+    located = index.locate(lons, lats, fragments)
+    agents = _agents_for_comuni(comune_id for comune_id in located if comune_id is not None)
+    
+    results = []
+    for lon, lat, comune_id in zip(lons, lats, located):
+        agent = agents.get(comune_id)
+        results.append({
+            'lat': lat,
+            'lon': lon,
+            'comune': comuni_index.get(comune_id) if comune_id is not None else None,
+            'agent': {
+                'id': agent.id,
+                'name': agent.name,
+                'phone': agent.phone,
+                'email': agent.email,
+                'color': agent.color
+            } if agent is not None else None
+        })
+    return results
+
+@app.route('/api/locate', methods=['GET', 'POST'])
+def api_locate():
+    """
+    Find which comune and which agent cover a point.
+    
+    GET /api/locate?lat=&lon= locates a single point. POST accepts
+    {"points": [[lat, lon], ...]} (or a list of {"lat", "lon"} objects) and
+    locates up to MAX_LOCATE_POINTS points in one vectorized pass.
+    """
+    try:
+        if request.method == 'GET':
+            lats = [float(request.args['lat'])]
+            lons = [float(request.args['lon'])]
+        else:
+            points = (request.get_json(silent=True) or {}).get('points', [])
+            if len(points) > MAX_LOCATE_POINTS:
+                return jsonify({'error': f'Too many points (max {MAX_LOCATE_POINTS})'}), 400
+            lats, lons = [], []
+            for point in points:
+                lat, lon = (point['lat'], point['lon']) if isinstance(point, dict) else point
+                lats.append(float(lat))
+                lons.append(float(lon))
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Invalid coordinates'}), 400
+    
+    if any(not -90 <= lat <= 90 for lat in lats) or any(not -180 <= lon <= 180 for lon in lons):
+        return jsonify({'error': 'Coordinates out of range'}), 400
+    
+    try:
+        results = locate_points(lons, lats) if lats else []
+    except Exception as e:
+        logger.error(f"Error locating points: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    
+    if request.method == 'GET':
+        return jsonify(results[0])
+    
+    logger.info(f"Located {len(results)} points, "
+                f"{sum(1 for result in results if result['agent'] is not None)} covered by an agent")
+    return jsonify({'results': results})
+
+@app.route('/api/comuni/<comune_id>/neighbours')
+def comune_neighbours(comune_id):
+    """Municipalities bordering a comune"""
+    graph = load_adjacency()
+    if graph is None:
+        return jsonify({'error': 'Adjacency graph not available'}), 503
+    
+    canonical_id = code_resolver.canonical(comune_id)
+    if canonical_id not in graph:
+        return jsonify({'error': f'Unknown comune {comune_id}'}), 404
+    
+    neighbours = [comuni_index.get(n) or {'id': n} for n in graph.neighbours(canonical_id)]
+    return jsonify({'id': canonical_id, 'neighbours': neighbours})
+
+@app.route('/api/agents/<int:agent_id>/contiguity')
+def agent_contiguity(agent_id):
+    """
+    Contiguity of an agent's territory: its connected parts and the comuni
+    of other agents (or unassigned) entirely surrounded by it.
+    """
+    graph = load_adjacency()
+    if graph is None:
+        return jsonify({'error': 'Adjacency graph not available'}), 503
+    
+    snapshot = assignment_snapshot.load(db.session)
+    if agent_id not in snapshot.agents:
+        return jsonify({'error': 'Agent not found'}), 404
+    
+    comune_ids = [code_resolver.canonical(comune_id) for comune_id in snapshot.comuni_by_agent.get(agent_id, ())]
+    components = graph.components(comune_ids)
+    enclaves = graph.enclaves(comune_ids)
+    
+    return jsonify({
+        'agent_id': agent_id,
+        'count': len(comune_ids),
+        'contiguous': len(components) <= 1,
+        'components': components,
+        'enclaves': enclaves
+    })
+
+def replace_assignments(territories):
+    """
+    Replace the assignments of the given municipalities in a single transaction.
+    
+    Existing assignments of those comuni (to any agent) are deleted and the
+    new ones inserted with one bulk statement each, in chunks.
+    
+    Args:
+        territories (dict): agent_id -> list of canonical ISTAT codes
+    """
+    rows = []
+    codes = set()
+    for agent_id, comune_ids in territories.items():
+        for comune_id in comune_ids:
+            # Le assegnazioni salvano il codice nel formato del CSV dei comuni
+            details = comuni_index.get(comune_id)
+            if details is None:
+                logger.warning(f"Skipping unknown comune {comune_id}")
+                continue
+            stored_id = details['id']
+            rows.append({'agent_id': agent_id, 'comune_id': stored_id, 'assignment_date': datetime.now()})
+            codes.update((comune_id, stored_id))
+    
+    codes = list(codes)
+    try:
+        for start in range(0, len(codes), QUERY_CHUNK_SIZE):
+            db.session.execute(delete(Assignment).where(Assignment.comune_id.in_(codes[start:start + QUERY_CHUNK_SIZE])))
+        for start in range(0, len(rows), QUERY_CHUNK_SIZE):
+            db.session.execute(insert(Assignment), rows[start:start + QUERY_CHUNK_SIZE])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    
+    logger.info(f"Replaced assignments of {len(rows)} comuni for {len(territories)} agents")
+
+@app.route('/api/partition', methods=['POST'])
+def api_partition():
+    """
+    Split a set of municipalities into contiguous, balanced territories.
+    
+    JSON body:
+        agent_ids (list): Agents that receive a territory
+        comune_ids / province / region / all: The comuni to split (one of them)
+        seeds (dict): Optional agent_id -> starting comune
+        balance (str): 'count' (default) or 'area'
+        dry_run (bool): If true, compute the territories without saving them
+    """
+    graph = load_adjacency()
+    if graph is None:
+        return jsonify({'error': 'Adjacency graph not available'}), 503
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        # Un agente ripetuto riceverebbe due territori, il secondo sovrascritto al primo
+        agent_ids = list(dict.fromkeys(int(agent_id) for agent_id in data.get('agent_ids', [])))
+        seeds = {int(agent_id): code_resolver.canonical(comune_id)
+                 for agent_id, comune_id in (data.get('seeds') or {}).items()}
+    except (TypeError, ValueError, AttributeError):
+        return jsonify({'error': 'Invalid agent_ids or seeds'}), 400
+    
+    if data.get('comune_ids'):
+        if not isinstance(data['comune_ids'], list):
+            return jsonify({'error': 'comune_ids must be a list'}), 400
+        unknown_ids = [comune_id for comune_id in data['comune_ids'] if comuni_index.get(comune_id) is None]
+        if unknown_ids:
+            return jsonify({'error': 'Unknown comuni', 'unknown': unknown_ids}), 400
+        comune_ids = _canonical_set(data['comune_ids'])
+    elif data.get('province'):
+        comune_ids = comuni_index.codes(province=data['province'])
+    elif data.get('region'):
+        comune_ids = comuni_index.codes(region=data['region'])
+    elif data.get('all'):
+        comune_ids = comuni_index.codes()
+    else:
+        return jsonify({'error': 'Specify comune_ids, province, region or all'}), 400
+    
+    unknown_seeds = [comune_id for comune_id in seeds.values() if comuni_index.get(comune_id) is None]
+    if unknown_seeds:
+        return jsonify({'error': 'Unknown seed comuni', 'unknown': unknown_seeds}), 400
+    
+    found = {agent_id for (agent_id,) in db.session.query(Agent.id).filter(Agent.id.in_(agent_ids))}
+    missing_agents = [agent_id for agent_id in agent_ids if agent_id not in found]
+    if missing_agents:
+        return jsonify({'error': f'Unknown agents: {missing_agents}'}), 404
+    
+    start = time.perf_counter()
+    try:
+        territories, totals = partition_territories(graph, comune_ids, agent_ids, seeds,
+                                                    balance=data.get('balance', 'count'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    elapsed = time.perf_counter() - start
+    logger.info(f"Partitioned {len(comune_ids)} comuni among {len(agent_ids)} agents in {elapsed * 1000:.0f} ms")
+    
+    dry_run = bool(data.get('dry_run'))
+    if not dry_run:
+        try:
+            replace_assignments(territories)
+        except Exception as e:
+            logger.error(f"Error saving partition: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+    
+    return jsonify({
+        'dry_run': dry_run,
+        'elapsed_ms': round(elapsed * 1000, 1),
+        'territories': [
+            {
+                'agent_id': agent_id,
+                'count': len(territories[agent_id]),
+                'weight': totals[agent_id],
+                'components': len(graph.components(territories[agent_id])),
+                'comune_ids': territories[agent_id]
+            }
+            for agent_id in agent_ids
+        ]
+    })
+
+@app.route('/api/assignments/import', methods=['POST'])
+def api_import_assignments():
+    """
+    Bulk import of agent assignments from a CSV or JSON file.
+
+    The file is sent as the 'file' field of a multipart form or as the raw
+    request body (text/csv, application/json, application/x-ndjson), and is
+    parsed row by row while it is read.
+
+    Query parameters:
+        format (str): 'csv' or 'json'; by default from the file name or content type
+        replace (bool): Reassign comuni already assigned to another agent
+        dry_run (bool): Only validate the file
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        stream = upload.stream
+        input_format = request.args.get('format') or detect_format(upload.filename, upload.mimetype)
+    else:
+        stream = request.stream
+        input_format = request.args.get('format') or detect_format(content_type=request.mimetype)
+    if input_format not in ('csv', 'json'):
+        return jsonify({'error': f'Unsupported format {input_format}'}), 400
+
+    flags = ('1', 'true', 'yes')
+    start = time.perf_counter()
+    try:
+        result = import_assignments(db.session, iter_rows(stream, input_format), comuni_index,
+                                    replace=request.args.get('replace', '').lower() in flags,
+                                    dry_run=request.args.get('dry_run', '').lower() in flags)
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'error': f'Invalid file: {str(e)}'}), 400
+    except Exception as e:
+        logger.error(f"Error importing assignments: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    result['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return jsonify(result)
+
 @app.route('/get_agent_comuni', methods=['POST'])
 def get_agent_comuni():
     """Get municipalities assigned to an agent"""
@@ -620,31 +1496,20 @@ def get_agent_comuni():
     if not agent_id:
         return jsonify([])
     
-    # Force database refresh to ensure we're working with the latest data
-    db.session.expire_all()
-    
-    agent = Agent.query.get(agent_id)
-    if not agent:
+    # Snapshot delle assegnazioni, ricaricata solo dopo una modifica
+    snapshot = assignment_snapshot.load(db.session)
+    if agent_id not in snapshot.agents:
         return jsonify([])
     
-    # Get agent's assigned comuni with a fresh query
-    assignments = Assignment.query.filter_by(agent_id=agent.id).all()
-    logger.debug(f"Found {len(assignments)} assignments for agent {agent_id}")
+    assigned_ids = snapshot.comuni_by_agent.get(agent_id, ())
+    logger.debug(f"Found {len(assigned_ids)} assignments for agent {agent_id}")
     
     comuni_list = []
     
-    for assignment in assignments:
-        comune_row = comuni_data[comuni_data['codice'] == assignment.comune_id]
-        if not comune_row.empty:
-            comuni_list.append({
-                'id': assignment.comune_id,
-                'name': comune_row.iloc[0]['comune'],
-                'province': comune_row.iloc[0]['provincia'],
-                'region': comune_row.iloc[0]['regione']
-            })
-    
-    # Close the session to prevent stale data
-    db.session.close()
+    for comune_id in assigned_ids:
+        comune_details = comuni_index.get(comune_id)
+        if comune_details is not None:
+            comuni_list.append(comune_details)
     
     return jsonify(comuni_list)
 
@@ -664,12 +1529,6 @@ def delete_agent(agent_id):
         db.session.delete(agent)
         db.session.commit()
         
-        # Pulizia esplicita della cache delle sessioni per assicurarsi che i dati siano aggiornati
-        db.session.expire_all()
-        
-        # Invalida la cache anche per le richieste future
-        db.session.close()
-        
         flash(f'Agente {agent_name} eliminato con successo', 'success')
         return redirect(url_for('list_agents'))
     except Exception as e:
@@ -706,7 +1565,6 @@ def update_agent_contacts(agent_id):
             )
             db.session.add(new_agent)
             db.session.commit()
-            db.session.expire_all()
             
             flash(f'Nuovo agente {agent_name} creato con successo', 'success')
             return redirect(url_for('list_agents'))
@@ -738,9 +1596,6 @@ def update_agent_contacts(agent_id):
         # Salva le modifiche
         db.session.commit()
         
-        # Invalida la cache per assicurarsi che i dati siano aggiornati
-        db.session.expire_all()
-        
         flash(f'Informazioni per {agent.name} aggiornate con successo', 'success')
         return redirect(url_for('list_agents'))
     except Exception as e:
@@ -767,9 +1622,6 @@ def update_agent_color(agent_id):
         # Salva le modifiche
         db.session.commit()
         
-        # Invalida la cache per assicurarsi che i dati siano aggiornati
-        db.session.expire_all()
-        
         flash(f'Colore per {agent.name} aggiornato con successo', 'success')
         return redirect(url_for('list_agents'))
     except Exception as e:
@@ -815,9 +1667,6 @@ def update_agent_field(agent_id):
         # Salva le modifiche
         db.session.commit()
         
-        # Invalida la cache
-        db.session.expire_all()
-        
         return jsonify({
             'success': True, 
             'message': f'Campo {field_type} aggiornato per {agent.name}',
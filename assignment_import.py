@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Import massivo delle assegnazioni agente-comune da un file CSV o JSON.
+
+Uso:
+    python assignment_import.py assegnazioni.csv             # importa
+    python assignment_import.py assegnazioni.csv --dry-run   # solo validazione
+    python assignment_import.py assegnazioni.json --replace  # riassegna i comuni già assegnati
+"""
+
+import io
+import csv
+import sys
+import json
+import logging
+import argparse
+from datetime import datetime
+from itertools import chain
+from sqlalchemy import select, insert, delete
+from models import Agent, Assignment
+from assignment_snapshot import record_changes
+
+logger = logging.getLogger(__name__)
+
+# Nomi accettati per le colonne (CSV) o le chiavi (JSON), senza distinzione di maiuscole
+AGENT_COLUMNS = ('agent', 'agente', 'agent_name', 'nome_agente')
+COMUNE_COLUMNS = ('comune', 'comune_id', 'codice', 'codice_istat', 'istat')
+OPTIONAL_COLUMNS = {
+    'color': ('color', 'colore', 'agent_color'),
+    'phone': ('phone', 'telefono', 'cellulare', 'agent_phone'),
+    'email': ('email', 'agent_email'),
+}
+
+# Dimensione dei blocchi di righe per INSERT/DELETE e per la lettura dei file JSON
+CHUNK_SIZE = 500
+READ_SIZE = 64 * 1024
+# Su PostgreSQL, oltre questo numero di righe si usa COPY invece di executemany
+COPY_THRESHOLD = 1000
+
+def detect_format(filename=None, content_type=None):
+    """Guess the input format ('csv' or 'json') from the file name or the content type"""
+    name = (filename or '').lower()
+    if name.endswith(('.json', '.jsonl', '.ndjson')):
+        return 'json'
+    if name.endswith('.csv'):
+        return 'csv'
+    if content_type and 'json' in content_type:
+        return 'json'
+    return 'csv'
+
+def _find_key(keys, candidates):
+    """Return the first key matching one of the candidate names, or None"""
+    normalized = {str(key).strip().lower(): key for key in keys}
+    for candidate in candidates:
+        if candidate in normalized:
+            return normalized[candidate]
+    return None
+
+def _text(stream):
+    """Wrap a binary stream as UTF-8 text, accepting a BOM (e.g. CSV saved by Excel)"""
+    if isinstance(stream, io.TextIOBase):
+        return stream
+    return io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+def _iter_csv(stream):
+    """Yield (line, dict) for every CSV row; ',' or ';' separated, with a header row"""
+    text = _text(stream)
+    header = text.readline()
+    if not header.strip():
+        raise ValueError("Empty file")
+    delimiter = ';' if header.count(';') > header.count(',') else ','
+    reader = csv.reader(chain([header], text), delimiter=delimiter)
+    columns = [column.strip() for column in next(reader)]
+    for line, values in enumerate(reader, start=2):
+        if any(value.strip() for value in values):
+            yield line, dict(zip(columns, values))
+
+def _iter_json_array(buffer, text):
+    """Decode the elements of a top-level JSON array one at a time, reading the text in chunks"""
+    decoder = json.JSONDecoder()
+    position = 1
+    while True:
+        # Separatori tra gli elementi
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer):
+                break
+            more = text.read(READ_SIZE)
+            if not more:
+                raise ValueError("Unterminated JSON array")
+            buffer, position = more, 0
+        if buffer[position] == ']':
+            return
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # Elemento spezzato tra due blocchi
+            more = text.read(READ_SIZE)
+            if not more:
+                raise ValueError(f"Invalid JSON near: {buffer[position:position + 50]!r}")
+            buffer, position = buffer[position:] + more, 0
+            continue
+        yield element
+        position = end
+        if position > READ_SIZE:
+            buffer, position = buffer[position:], 0
+
+def _iter_json(stream):
+    """Yield (index, dict) for every JSON record: a JSON array or JSON Lines"""
+    text = _text(stream)
+    head = text.read(READ_SIZE)
+    if not head.strip():
+        raise ValueError("Empty file")
+
+    if head.lstrip().startswith('['):
+        records = _iter_json_array(head.lstrip(), text)
+    else:
+        # Il primo blocco viene completato fino a fine riga, poi si legge riga per riga
+        lines = chain(io.StringIO(head + text.readline()), text)
+        records = (json.loads(line) for line in lines if line.strip())
+    try:
+        for index, record in enumerate(records, start=1):
+            if not isinstance(record, dict):
+                raise ValueError(f"Record {index} is not a JSON object")
+            yield index, record
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {str(e)}")
+
+def iter_rows(stream, input_format='csv'):
+    """
+    Stream-parse the (agent, comune) rows of an import file.
+
+    A record may also list several comuni of the same agent, e.g. the JSON
+    object {"agent": "Mario Rossi", "comuni": ["097001", "E507"]}.
+
+    Args:
+        stream: Binary or text file object
+        input_format (str): 'csv' or 'json' (JSON array or JSON Lines)
+
+    Yields:
+        tuple: (line or record number, agent name, comune code, dict of optional agent fields)
+
+    Raises:
+        ValueError: If the file cannot be parsed or lacks the required columns
+    """
+    records = _iter_json(stream) if input_format == 'json' else _iter_csv(stream)
+    keys = None
+    for line, record in records:
+        if keys is None or set(record) != keys[0]:
+            agent_key = _find_key(record, AGENT_COLUMNS)
+            comune_key = _find_key(record, COMUNE_COLUMNS)
+            comuni_key = _find_key(record, ('comuni', 'comune_ids', 'codici'))
+            if agent_key is None or (comune_key is None and comuni_key is None):
+                raise ValueError(f"Row {line}: columns {AGENT_COLUMNS[0]!r} and {COMUNE_COLUMNS[0]!r} are required")
+            optional = {field: _find_key(record, names) for field, names in OPTIONAL_COLUMNS.items()}
+            keys = (set(record), agent_key, comune_key, comuni_key, optional)
+        _, agent_key, comune_key, comuni_key, optional = keys
+
+        agent_name = str(record.get(agent_key) or '').strip()
+        extras = {field: str(record[key]).strip() for field, key in optional.items()
+                  if key is not None and record.get(key)}
+        codes = record.get(comuni_key) if comuni_key is not None else [record.get(comune_key)]
+        if isinstance(codes, str):
+            codes = [codes]
+        for code in codes or [None]:
+            yield line, agent_name, str(code).strip() if code is not None else '', extras
+
+def _copy_assignments(session, rows):
+    """Write the assignments with COPY (PostgreSQL), in the current transaction"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow((row['agent_id'], row['comune_id'], row['assignment_date'].isoformat(sep=' ')))
+    buffer.seek(0)
+
+    dbapi_connection = session.connection().connection.dbapi_connection
+    with dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {Assignment.__table__.name} (agent_id, comune_id, assignment_date) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+    # COPY non passa dall'ORM: registriamo noi le modifiche per la revisione e il registro
+    record_changes(session, [('assign', row['comune_id'], row['agent_id']) for row in rows])
+
+def _write_assignments(session, rows):
+    """Insert the assignments with executemany, or COPY on PostgreSQL for large imports"""
+    if session.connection().dialect.name == 'postgresql' and len(rows) >= COPY_THRESHOLD:
+        _copy_assignments(session, rows)
+        return
+    for start in range(0, len(rows), CHUNK_SIZE):
+        session.execute(insert(Assignment), rows[start:start + CHUNK_SIZE])
+
+def import_assignments(session, rows, comuni_index, replace=False, dry_run=False):
+    """
+    Validate and save the imported assignments in a single transaction.
+
+    The current agents and assignments are read with one query each; every
+    row is then checked in a single pass (unknown codes through the ISTAT
+    code index, comuni assigned to another agent in the database or earlier
+    in the file) and the valid rows are written with bulk statements. Rows
+    with errors or conflicts are skipped and reported, as the assignment form
+    does for the comuni of other agents.
+
+    Args:
+        session: SQLAlchemy session
+        rows (iterable): Rows from iter_rows()
+        comuni_index (ComuniIndex): Index used to resolve the comune codes
+        replace (bool): Reassign comuni already assigned to another agent
+            instead of reporting them as conflicts
+        dry_run (bool): Only validate, without writing anything
+
+    Returns:
+        dict: Summary with the counts, the created agents, the errors and the conflicts
+    """
+    result = {
+        'rows': 0,
+        'assigned': 0,
+        'reassigned': 0,
+        'unchanged': 0,
+        'created_agents': [],
+        'errors': [],
+        'conflicts': [],
+        'dry_run': dry_run
+    }
+
+    # Stato attuale: una query per gli agenti e una per le assegnazioni
+    agent_ids = {name: agent_id for agent_id, name in session.execute(select(Agent.id, Agent.name))}
+    agent_names = {agent_id: name for name, agent_id in agent_ids.items()}
+    # Le righe salvate in un altro formato del codice (es. '069001' invece di '69001')
+    # appartengono allo stesso comune: le chiavi sono normalizzate nel formato del CSV
+    owners = {}
+    stored_forms = {}
+    for stored_id, owner_id in session.execute(select(Assignment.comune_id, Assignment.agent_id)):
+        details = comuni_index.get(stored_id)
+        comune_id = details['id'] if details is not None else stored_id
+        owners[comune_id] = owner_id
+        stored_forms.setdefault(comune_id, []).append(stored_id)
+
+    planned = {}  # codice del comune (come salvato) -> nome dell'agente
+    new_agents = {}  # nome -> campi facoltativi del primo record
+    for line, agent_name, code, extras in rows:
+        result['rows'] += 1
+        if not agent_name:
+            result['errors'].append({'line': line, 'comune': code, 'error': 'Nome agente mancante'})
+            continue
+        details = comuni_index.get(code) if code else None
+        if details is None:
+            result['errors'].append({'line': line, 'comune': code, 'error': f'Codice comune sconosciuto: {code}'})
+            continue
+
+        comune_id = details['id']
+        planned_agent = planned.get(comune_id)
+        if planned_agent is not None:
+            if planned_agent != agent_name:
+                result['conflicts'].append({'line': line, 'comune': comune_id, 'name': details['name'],
+                                            'agent': agent_name, 'assigned_to': planned_agent})
+            continue
+        owner_id = owners.get(comune_id)
+        if owner_id is not None and agent_names.get(owner_id) != agent_name and not replace:
+            result['conflicts'].append({'line': line, 'comune': comune_id, 'name': details['name'],
+                                        'agent': agent_name, 'assigned_to': agent_names.get(owner_id)})
+            continue
+
+        planned[comune_id] = agent_name
+        if agent_name not in agent_ids and agent_name not in new_agents:
+            new_agents[agent_name] = extras
+
+    result['created_agents'] = list(new_agents)
+    if dry_run:
+        for comune_id, agent_name in planned.items():
+            owner_id = owners.get(comune_id)
+            if owner_id is None:
+                result['assigned'] += 1
+            elif agent_names.get(owner_id) == agent_name:
+                result['unchanged'] += 1
+            else:
+                result['reassigned'] += 1
+        return result
+
+    try:
+        now = datetime.now()
+        if new_agents:
+            # Senza colore gli agenti ricevono quello della tavolozza alla prima visualizzazione
+            agents = [Agent(name=name, phone=extras.get('phone', ''), email=extras.get('email', ''),
+                            color=extras.get('color'), registration_date=now)
+                      for name, extras in new_agents.items()]
+            session.add_all(agents)
+            session.flush()
+            agent_ids.update((agent.name, agent.id) for agent in agents)
+
+        rows_to_insert = []
+        reassigned_ids = []
+        deleted_ids = []
+        for comune_id, agent_name in planned.items():
+            agent_id = agent_ids[agent_name]
+            owner_id = owners.get(comune_id)
+            if owner_id == agent_id:
+                result['unchanged'] += 1
+                continue
+            if owner_id is not None:
+                reassigned_ids.append(comune_id)
+                # Tutte le forme salvate del codice, come in replace_assignments
+                deleted_ids.extend(stored_forms[comune_id])
+            rows_to_insert.append({'agent_id': agent_id, 'comune_id': comune_id, 'assignment_date': now})
+
+        for start in range(0, len(deleted_ids), CHUNK_SIZE):
+            session.execute(delete(Assignment).where(
+                Assignment.comune_id.in_(deleted_ids[start:start + CHUNK_SIZE])))
+        _write_assignments(session, rows_to_insert)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    result['reassigned'] = len(reassigned_ids)
+    result['assigned'] = len(rows_to_insert) - len(reassigned_ids)
+    logger.info(f"Imported {result['rows']} rows: {result['assigned']} assigned, {result['reassigned']} reassigned, "
+                f"{result['unchanged']} unchanged, {len(new_agents)} new agents, "
+                f"{len(result['errors'])} errors, {len(result['conflicts'])} conflicts")
+    return result
+
+def main():
+    """Funzione principale"""
+    parser = argparse.ArgumentParser(description="Importa le assegnazioni agente-comune da un file CSV o JSON")
+    parser.add_argument('file', help="File CSV (colonne agente, comune) o JSON (array o JSON Lines)")
+    parser.add_argument('--format', choices=('csv', 'json'), help="Formato del file (predefinito: dall'estensione)")
+    parser.add_argument('--replace', action='store_true', help="Riassegna i comuni già assegnati ad altri agenti")
+    parser.add_argument('--dry-run', action='store_true', help="Valida il file senza salvare nulla")
+    args = parser.parse_args()
+
+    from app import app, comuni_index
+    from database import db
+
+    with open(args.file, 'rb') as f, app.app_context():
+        try:
+            result = import_assignments(db.session, iter_rows(f, args.format or detect_format(args.file)),
+                                        comuni_index, replace=args.replace, dry_run=args.dry_run)
+        except ValueError as e:
+            logger.error(f"File non valido: {str(e)}")
+            sys.exit(2)
+
+    for error in result['errors']:
+        logger.warning(f"Riga {error['line']}: {error['error']}")
+    for conflict in result['conflicts']:
+        logger.warning(f"Riga {conflict['line']}: {conflict['name']} (già assegnato a {conflict['assigned_to']})")
+    logger.info(f"{result['rows']} righe: {result['assigned']} assegnati, {result['reassigned']} riassegnati, "
+                f"{result['unchanged']} invariati, {len(result['created_agents'])} nuovi agenti"
+                f"{' (simulazione)' if args.dry_run else ''}")
+    sys.exit(1 if result['errors'] or result['conflicts'] else 0)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
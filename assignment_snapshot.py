@@ -0,0 +1,276 @@
+import logging
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from models import Agent, Assignment, AssignmentRevision, AssignmentChange
+from invalidation_bus import invalidation_bus, NOTIFY_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# Unica riga della tabella delle revisioni
+REVISION_ROW_ID = 1
+# Numero di revisioni conservate nel registro delle modifiche
+CHANGE_LOG_REVISIONS = 1000
+# Il registro viene potato una volta ogni tante revisioni
+CHANGE_LOG_PRUNE_EVERY = 100
+
+AgentRecord = namedtuple('AgentRecord', ['id', 'name', 'phone', 'email', 'color'])
+
+_revision_table = AssignmentRevision.__table__
+_change_table = AssignmentChange.__table__
+_tracked_mappers = (Agent, Assignment)
+
+def ensure_revision_row(session):
+    """
+    Create the revision row if the table is empty (e.g. on a new database),
+    and mark the start of the change log if it has never been written.
+    """
+    if session.get(AssignmentRevision, REVISION_ROW_ID) is None:
+        try:
+            session.add(AssignmentRevision(id=REVISION_ROW_ID, revision=0))
+            session.commit()
+        except IntegrityError:
+            # Creata nel frattempo da un altro worker
+            session.rollback()
+
+    start = session.execute(select(_change_table.c.id).where(_change_table.c.kind == 'start').limit(1)).first()
+    if start is None:
+        # Il registro copre solo le revisioni successive a quella corrente
+        session.execute(_change_table.insert().values(revision=current_revision(session), kind='start'))
+        session.commit()
+
+def current_revision(session):
+    """Return the committed assignment revision, with a single primary key lookup (session or connection)"""
+    return session.execute(
+        select(_revision_table.c.revision).where(_revision_table.c.id == REVISION_ROW_ID)
+    ).scalar() or 0
+
+def _prune_change_log(connection, revision):
+    """Drop the changes older than CHANGE_LOG_REVISIONS and move the start of the log"""
+    start = revision - CHANGE_LOG_REVISIONS
+    if start <= 0:
+        return
+    connection.execute(_change_table.delete().where(_change_table.c.revision <= start))
+    connection.execute(_change_table.insert().values(revision=start, kind='start'))
+
+def _bump_revision(session):
+    """
+    Increment the revision once per transaction, in the same transaction as the write.
+
+    Returns:
+        int: The revision of the transaction
+    """
+    revision = session.info.get('revision')
+    if revision is not None:
+        return revision
+    # Esecuzione Core sulla connessione: non passa di nuovo dagli eventi dell'ORM
+    connection = session.connection()
+    statement = _revision_table.update() \
+        .where(_revision_table.c.id == REVISION_ROW_ID) \
+        .values(revision=_revision_table.c.revision + 1)
+    if connection.dialect.name == 'postgresql':
+        # NOTIFY è transazionale: gli altri worker ricevono la nuova revisione solo al commit
+        revision = connection.execute(statement.returning(_revision_table.c.revision)).scalar()
+        connection.execute(select(func.pg_notify(NOTIFY_CHANNEL, str(revision))))
+    else:
+        connection.execute(statement)
+        revision = current_revision(connection)
+    session.info['revision'] = revision
+
+    if revision % CHANGE_LOG_PRUNE_EVERY == 0:
+        _prune_change_log(connection, revision)
+    return revision
+
+def record_changes(session, changes):
+    """Bump the revision and write the (kind, comune_id, agent_id) changes to the change log"""
+    revision = _bump_revision(session)
+    if changes:
+        session.connection().execute(_change_table.insert(), [
+            {'revision': revision, 'kind': kind, 'comune_id': comune_id, 'agent_id': agent_id}
+            for kind, comune_id, agent_id in changes
+        ])
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    """Writes through the unit of work: added, modified or deleted agents and assignments"""
+    changes = []
+    for objects, assignment_kind in ((session.new, 'assign'), (session.deleted, 'remove'),
+                                     ((obj for obj in session.dirty if session.is_modified(obj)), 'assign')):
+        for obj in objects:
+            if isinstance(obj, Assignment):
+                changes.append((assignment_kind, obj.comune_id, obj.agent_id))
+            elif isinstance(obj, Agent):
+                changes.append(('agent', None, obj.id))
+    if changes:
+        record_changes(session, changes)
+
+@event.listens_for(Session, 'do_orm_execute')
+def _on_orm_execute(orm_execute_state):
+    """Bulk INSERT/UPDATE/DELETE statements on agents and assignments"""
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    classes = {mapper.class_ for mapper in orm_execute_state.all_mappers}
+    if not classes.intersection(_tracked_mappers):
+        return
+
+    session = orm_execute_state.session
+    statement = orm_execute_state.statement
+    changes = []
+    if orm_execute_state.is_insert:
+        if Assignment in classes:
+            parameters = orm_execute_state.parameters or []
+            if isinstance(parameters, dict):
+                parameters = [parameters]
+            changes = [('assign', row.get('comune_id'), row.get('agent_id')) for row in parameters]
+    else:
+        # Le righe interessate sono lette prima dell'istruzione, nella stessa transazione
+        connection = session.connection()
+        if Assignment in classes:
+            kind = 'remove' if orm_execute_state.is_delete else 'assign'
+            query = select(Assignment.comune_id, Assignment.agent_id)
+            if statement.whereclause is not None:
+                query = query.where(statement.whereclause)
+            changes = [(kind, comune_id, agent_id) for comune_id, agent_id in connection.execute(query)]
+        else:
+            query = select(Agent.id)
+            if statement.whereclause is not None:
+                query = query.where(statement.whereclause)
+            changes = [('agent', None, agent_id) for (agent_id,) in connection.execute(query)]
+        if not changes:
+            # Nessuna riga interessata
+            return
+    record_changes(session, changes)
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    if session.info.pop('revision', None) is not None:
+        # Le richieste successive di questo worker devono vedere la propria scrittura
+        invalidation_bus.invalidate()
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('revision', None)
+
+def changes_since(session, since, until):
+    """
+    Return what the change log records between two revisions.
+
+    Args:
+        session: SQLAlchemy session used for the query
+        since (int): Revision the client already has
+        until (int): Revision of the state that will be sent to the client
+
+    Returns:
+        tuple: (set of changed comune IDs, set of changed agent IDs), or None
+            if the log no longer covers since (pruned)
+    """
+    if since >= until:
+        # Nessuna revisione nell'intervallo: il chiamante gestisce i client più avanti di until
+        return set(), set()
+    start = session.execute(
+        select(func.max(_change_table.c.revision)).where(_change_table.c.kind == 'start')
+    ).scalar()
+    if start is None or since < start:
+        return None
+
+    comune_ids = set()
+    agent_ids = set()
+    rows = session.execute(
+        select(_change_table.c.kind, _change_table.c.comune_id, _change_table.c.agent_id)
+        .where(_change_table.c.revision > since, _change_table.c.revision <= until)
+    )
+    for kind, comune_id, agent_id in rows:
+        if kind == 'agent':
+            agent_ids.add(agent_id)
+        elif kind in ('assign', 'remove'):
+            comune_ids.add(comune_id)
+    return comune_ids, agent_ids
+
+class AssignmentSnapshot:
+    """
+    Immutable view of all the agents and assignments at a given revision.
+
+    The mappings are read-only and never modified after construction, so a
+    snapshot can be shared by all the threads of a worker without locking.
+    """
+
+    __slots__ = ('revision', 'agents', 'agent_by_comune', 'comuni_by_agent')
+
+    def __init__(self, revision, agents, assignments):
+        """
+        Args:
+            revision (int): Revision the data was read at
+            agents (iterable): AgentRecord of every agent
+            assignments (iterable): (comune_id, agent_id) pairs, in assignment order
+        """
+        self.revision = revision
+        self.agents = MappingProxyType({agent.id: agent for agent in agents})
+
+        agent_by_comune = {}
+        comuni_by_agent = {}
+        for comune_id, agent_id in assignments:
+            agent_by_comune[comune_id] = agent_id
+            comuni_by_agent.setdefault(agent_id, []).append(comune_id)
+        self.agent_by_comune = MappingProxyType(agent_by_comune)
+        self.comuni_by_agent = MappingProxyType({
+            agent_id: tuple(comune_ids) for agent_id, comune_ids in comuni_by_agent.items()
+        })
+
+    def __len__(self):
+        return len(self.agent_by_comune)
+
+class AssignmentSnapshotCache:
+    """
+    Per-worker snapshot of the assignments, refreshed only when the revision
+    stored in the database changes.
+
+    Reading the current snapshot costs one primary key lookup, or nothing
+    while the invalidation bus is running and already knows the latest
+    revision; the agents and assignments are loaded again (two queries) only
+    after a write, by any worker, has incremented the revision.
+    """
+
+    def __init__(self, bus=invalidation_bus):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self.bus = bus
+
+    def load(self, session):
+        """
+        Return the snapshot of the current revision.
+
+        Args:
+            session: SQLAlchemy session used for the queries
+
+        Returns:
+            AssignmentSnapshot: The current agents and assignments
+        """
+        revision = self.bus.revision
+        if revision is None:
+            generation = self.bus.generation
+            revision = current_revision(session)
+            self.bus.observe(revision, generation)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.revision == revision:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.revision != revision:
+                # La revisione è letta prima dei dati: un'eventuale scrittura nel frattempo
+                # porta la revisione oltre quella della snapshot, che sarà ricaricata
+                agents = [AgentRecord(*row) for row in session.execute(
+                    select(Agent.id, Agent.name, Agent.phone, Agent.email, Agent.color))]
+                assignments = session.execute(
+                    select(Assignment.comune_id, Assignment.agent_id).order_by(Assignment.id)).all()
+                snapshot = AssignmentSnapshot(revision, agents, assignments)
+                self._snapshot = snapshot
+                logger.info(f"Loaded assignment snapshot at revision {revision}: "
+                            f"{len(snapshot.agents)} agents, {len(snapshot)} comuni")
+        return snapshot
+
+# Istanza condivisa da tutto il processo
+assignment_snapshot = AssignmentSnapshotCache()
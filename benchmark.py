@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+"""
+Script di benchmark per le parti critiche dell'applicazione.
+Ogni benchmark misura lo scenario peggiore realistico (tutti i comuni
+italiani assegnati) e confronta, dove possibile, l'implementazione
+precedente con quella attuale.
+
+Uso:
+    python benchmark.py            # esegue tutti i benchmark
+    python benchmark.py comuni     # esegue solo il benchmark indicato
+"""
+
+import os
+import sys
+import time
+import logging
+
+# Database SQLite in memoria, separato da quello dell'applicazione: va impostato
+# prima che un benchmark importi app, perché alcuni svuotano le tabelle
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _timeit(func, repeat=3):
+    """Esegue func più volte e restituisce il tempo migliore in secondi"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_comuni_index():
+    """Ricerca dei dettagli dei comuni: maschera pandas contro ComuniIndex"""
+    from data_utils import load_comuni_data
+    from comuni_index import ComuniIndex
+
+    comuni_data = load_comuni_data()
+    # Assegnazione nazionale completa: tutti i comuni del dataset
+    comune_ids = comuni_data['codice'].tolist()
+
+    def pandas_lookup():
+        details = []
+        for comune_id in comune_ids:
+            comune_row = comuni_data[comuni_data['codice'] == comune_id]
+            if not comune_row.empty:
+                details.append({
+                    'id': comune_id,
+                    'name': comune_row.iloc[0]['comune'],
+                    'province': comune_row.iloc[0]['provincia'],
+                    'region': comune_row.iloc[0]['regione']
+                })
+        return details
+
+    build_time = _timeit(lambda: ComuniIndex(comuni_data), repeat=1)
+    comuni_index = ComuniIndex(comuni_data)
+
+    def index_lookup():
+        details = []
+        for comune_id in comune_ids:
+            comune_details = comuni_index.get(comune_id)
+            if comune_details is not None:
+                details.append(comune_details)
+        return details
+
+    pandas_time = _timeit(pandas_lookup, repeat=1)
+    index_time = _timeit(index_lookup)
+
+    logger.info(f"[comuni] {len(comune_ids)} comuni assegnati")
+    logger.info(f"[comuni] costruzione indice (una volta per processo): {build_time * 1000:.1f} ms")
+    logger.info(f"[comuni] maschera pandas per richiesta: {pandas_time * 1000:.1f} ms")
+    logger.info(f"[comuni] ComuniIndex per richiesta: {index_time * 1000:.2f} ms "
+                f"(x{pandas_time / index_time:.0f})")
+
+# Codice eseguito in un processo separato per misurare un avvio "a freddo"
+_STORE_LOAD_SCRIPT = """
+import resource, sys, time
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+from geometry_store import GeometryStore, MappedFragments, _load_json
+loader = {'json': _load_json, 'mmap': MappedFragments}[sys.argv[1]]
+data = GeometryStore(sys.argv[2], loader=loader).load()
+elapsed = time.perf_counter() - start
+print(len(data), elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline)
+"""
+
+def bench_geometry_store():
+    """Avvio a freddo e memoria: comuni_dict.json contro archivio binario mappato"""
+    import subprocess
+    from geometry_store import COMUNI_DICT_PATH, COMUNI_BINARY_PATH
+
+    for label, path in (('json', COMUNI_DICT_PATH), ('mmap', COMUNI_BINARY_PATH)):
+        if not path.exists():
+            logger.warning(f"[store] {path} non trovato, esegui prima process_geojson.py")
+            continue
+
+        result = subprocess.run([sys.executable, '-c', _STORE_LOAD_SCRIPT, label, str(path)],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            logger.error(f"[store] errore nel caricamento di {path}: {result.stderr}")
+            continue
+
+        count, elapsed, rss_kb = result.stdout.split()
+        logger.info(f"[store] {label}: {count} comuni, avvio {float(elapsed) * 1000:.1f} ms, "
+                    f"RSS aggiuntiva {int(rss_kb) / 1024:.1f} MB per worker")
+
+# Viewport tipiche (larghezza x altezza in gradi) per i livelli di zoom più usati
+VIEWPORTS = {
+    'nazionale (z6)': (11.0, 8.0),
+    'regionale (z8)': (2.8, 2.0),
+    'provinciale (z10)': (0.7, 0.5),
+    'comunale (z12)': (0.18, 0.12),
+}
+
+def bench_spatial_index():
+    """Query per area visibile: STRtree contro scansione dei rettangoli di tutti i comuni"""
+    import random
+    from geometry_store import load_fragments
+    from spatial_index import SpatialIndex
+
+    fragments, _ = load_fragments()
+    if fragments is None:
+        logger.warning("[bbox] geometrie non trovate, esegui prima process_geojson.py")
+        return
+
+    build_time = _timeit(lambda: SpatialIndex(fragments), repeat=1)
+    index = SpatialIndex(fragments)
+    bounds = index.bounds.tolist()
+    minlon, minlat = index.bounds[:, 0].min(), index.bounds[:, 1].min()
+    maxlon, maxlat = index.bounds[:, 2].max(), index.bounds[:, 3].max()
+    logger.info(f"[bbox] indice su {len(index)} comuni costruito in {build_time * 1000:.1f} ms")
+
+    random.seed(0)
+    for label, (width, height) in VIEWPORTS.items():
+        viewports = []
+        for _ in range(200):
+            lon = random.uniform(minlon, max(minlon, maxlon - width))
+            lat = random.uniform(minlat, max(minlat, maxlat - height))
+            viewports.append((lon, lat, lon + width, lat + height))
+
+        def scan():
+            for west, south, east, north in viewports:
+                [i for i, (gw, gs, ge, gn) in enumerate(bounds)
+                 if gw <= east and ge >= west and gs <= north and gn >= south]
+
+        def tree():
+            for viewport in viewports:
+                index.query_bbox(viewport)
+
+        scan_time = _timeit(scan) / len(viewports)
+        tree_time = _timeit(tree) / len(viewports)
+        average = sum(len(index.query_bbox(v)) for v in viewports) / len(viewports)
+        logger.info(f"[bbox] {label}: {average:.0f} comuni in media, scansione {scan_time * 1000:.2f} ms, "
+                    f"STRtree {tree_time * 1000:.3f} ms per query")
+
+def bench_locate():
+    """Localizzazione di punti: un punto singolo e un blocco di punti vettorializzato"""
+    import random
+    from geometry_store import load_fragments
+    from spatial_index import SpatialIndex
+
+    fragments, _ = load_fragments()
+    if fragments is None:
+        logger.warning("[locate] geometrie non trovate, esegui prima process_geojson.py")
+        return
+
+    index = SpatialIndex(fragments)
+    locate_fragments, _ = load_fragments('stradale')
+    minlon, minlat = index.bounds[:, 0].min(), index.bounds[:, 1].min()
+    maxlon, maxlat = index.bounds[:, 2].max(), index.bounds[:, 3].max()
+
+    random.seed(0)
+    for count in (1, 1000, 10000):
+        lons = [random.uniform(minlon, maxlon) for _ in range(count)]
+        lats = [random.uniform(minlat, maxlat) for _ in range(count)]
+        elapsed = _timeit(lambda: index.locate(lons, lats, locate_fragments))
+        found = sum(1 for comune_id in index.locate(lons, lats, locate_fragments) if comune_id is not None)
+        logger.info(f"[locate] {count} punti in {elapsed * 1000:.1f} ms "
+                    f"({elapsed / count * 1e6:.0f} us per punto, {found} dentro un comune)")
+
+def bench_partition():
+    """Suddivisione automatica di tutti i comuni italiani in territori contigui"""
+    from geo_utils import load_adjacency
+    from territory_partition import partition_territories
+
+    graph = load_adjacency()
+    if graph is None:
+        logger.warning("[partition] grafo di adiacenza non trovato, esegui prima process_geojson.py")
+        return
+
+    for agents in (20, 100, 400):
+        for balance in ('count', 'area'):
+            if balance == 'area' and graph.area_km2 is None:
+                continue
+            result = {}
+
+            def run():
+                result['territories'], result['totals'] = partition_territories(
+                    graph, graph.ids, list(range(agents)), balance=balance)
+
+            elapsed = _timeit(run)
+            totals = list(result['totals'].values())
+            mean = sum(totals) / len(totals)
+            split = sum(1 for comuni in result['territories'].values() if len(graph.components(comuni)) > 1)
+            logger.info(f"[partition] {len(graph)} comuni, {agents} agenti ({balance}): {elapsed * 1000:.0f} ms, "
+                        f"min/max {min(totals) / mean:.2f}/{max(totals) / mean:.2f} della media, "
+                        f"{split} territori non contigui")
+
+def bench_queries():
+    """
+    Numero di istruzioni SQL per /agents e /mappa_completa al crescere degli
+    agenti: deve restare costante (nessuna query per agente, verificato da
+    tests/test_queries.py).
+    """
+    from sqlalchemy import event
+    from app import app, comuni_index
+    from database import db
+    from models import Agent, Assignment
+
+    codes = [record['id'] for record in (comuni_index.get(code) for code in comuni_index.codes())][:2000]
+    statements = []
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        for agents in (5, 50, 200):
+            db.session.query(Assignment).delete()
+            db.session.query(Agent).delete()
+            for i in range(agents):
+                agent = Agent(name=f"Agente {i:03d}", color='#ff9800')
+                db.session.add(agent)
+                db.session.flush()
+                for comune_id in codes[i::agents][:10]:
+                    db.session.add(Assignment(agent_id=agent.id, comune_id=comune_id))
+            db.session.commit()
+
+            client = app.test_client()
+            for url in ('/agents', '/mappa_completa'):
+                # La prima richiesta registra gli insiemi di comuni, contiamo la seconda
+                client.get(url)
+                statements.clear()
+                client.get(url)
+                logger.info(f"[queries] {url} con {agents} agenti: {len(statements)} istruzioni SQL")
+
+def bench_submit():
+    """
+    Tempo e numero di istruzioni SQL di /submit per 10, 100 e 1.000 comuni:
+    la validazione è una query IN, inserimenti e cancellazioni sono massivi.
+    """
+    from sqlalchemy import event
+    from app import app, comuni_index
+    from database import db
+    from models import Agent, Assignment
+
+    codes = [record['id'] for record in (comuni_index.get(code) for code in comuni_index.codes())]
+    statements = []
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        client = app.test_client()
+
+        for size in (10, 100, 1000):
+            selected = codes[:size]
+
+            best = None
+            for _ in range(3):
+                db.session.query(Assignment).delete()
+                db.session.query(Agent).delete()
+                # Metà dei comuni è già di un altro agente, per esercitare i conflitti
+                other = Agent(name="Altro agente", color='#2196f3')
+                db.session.add(other)
+                db.session.flush()
+                db.session.add_all([Assignment(agent_id=other.id, comune_id=c) for c in selected[::2]])
+                db.session.commit()
+
+                statements.clear()
+                start = time.perf_counter()
+                client.post('/submit', data={'agent_name': 'Agente test', 'comuni': selected})
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            logger.info(f"[submit] {size} comuni: {best * 1000:.1f} ms, {len(statements)} istruzioni SQL")
+
+def bench_import():
+    """
+    Import massivo di 8.000 righe CSV (200 agenti da 40 comuni): una sola
+    passata di validazione e scritture massive in un'unica transazione.
+    """
+    import io
+    from sqlalchemy import event
+    from app import app, comuni_index
+    from database import db
+    from models import Agent, Assignment
+    from assignment_import import iter_rows, import_assignments
+
+    codes = comuni_index.codes()[:8000]
+    data = ('agente,comune\n' + ''.join(f"Agente {i // 40},{code}\n" for i, code in enumerate(codes))).encode('utf-8')
+    statements = []
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        for replace in (False, True):
+            best = None
+            for _ in range(3):
+                db.session.query(Assignment).delete()
+                db.session.query(Agent).delete()
+                # Un decimo dei comuni è già di un altro agente
+                other = Agent(name="Altro agente", color='#2196f3')
+                db.session.add(other)
+                db.session.flush()
+                db.session.add_all([Assignment(agent_id=other.id, comune_id=comuni_index.get(c)['id'])
+                                    for c in codes[::10]])
+                db.session.commit()
+
+                statements.clear()
+                start = time.perf_counter()
+                result = import_assignments(db.session, iter_rows(io.BytesIO(data), 'csv'), comuni_index,
+                                            replace=replace)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            logger.info(f"[import] {result['rows']} righe{' (replace)' if replace else ''}: {best * 1000:.1f} ms, "
+                        f"{result['assigned']} assegnati, {result['reassigned']} riassegnati, "
+                        f"{len(result['conflicts'])} conflitti, {len(statements)} istruzioni SQL")
+
+def bench_export():
+    """
+    Esportazione dei territori: tempo e picco di memoria per 1.000 e 7.000
+    assegnazioni; il picco non deve crescere con il numero di righe.
+    """
+    import tracemalloc
+    from app import comuni_index
+    from assignment_snapshot import AssignmentSnapshot, AgentRecord
+    from geometry_store import load_fragments
+    from territory_export import iter_export_rows, iter_csv, iter_geojson
+
+    codes = comuni_index.codes()
+    fragments, _ = load_fragments()
+    agents = [AgentRecord(i, f"Agente {i}", '', '', '#ff9800') for i in range(200)]
+    for size in (1000, 7000):
+        snapshot = AssignmentSnapshot(1, agents, [(code, i % 200) for i, code in enumerate(codes[:size])])
+        for name, encode in (('csv', iter_csv), ('geojson', lambda rows: iter_geojson(rows, fragments))):
+            tracemalloc.start()
+            start = time.perf_counter()
+            total = sum(len(chunk) for chunk in encode(iter_export_rows(snapshot, comuni_index)))
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            logger.info(f"[export] {name}, {size} assegnazioni: {elapsed * 1000:.1f} ms, "
+                        f"{total / 1024:.0f} KB inviati, picco di memoria {peak / 1024:.0f} KB")
+
+# Processo che scrive: crea un agente e stampa l'istante del commit
+_INVALIDATION_WRITER_SCRIPT = """
+import os, sys, time
+os.environ['DATABASE_URL'] = sys.argv[1]
+from app import app
+from database import db
+from models import Agent
+with app.app_context():
+    db.session.add(Agent(name=sys.argv[2], color='#ff9800'))
+    db.session.commit()
+    print(time.time())
+"""
+
+# Processo che legge: query per richiesta a regime e ritardo con cui vede le scritture dell'altro processo
+_INVALIDATION_READER_SCRIPT = """
+import os, sys, time, threading, subprocess
+os.environ['DATABASE_URL'] = sys.argv[1]
+from sqlalchemy import event
+from app import app
+from database import db
+from assignment_snapshot import assignment_snapshot
+from invalidation_bus import invalidation_bus
+
+statements = []
+reader = threading.get_ident()
+with app.app_context():
+    # Contiamo solo le query del thread delle richieste, non quelle del bus
+    event.listen(db.engine, 'before_cursor_execute',
+                 lambda *args: threading.get_ident() == reader and statements.append(args[2]))
+    assignment_snapshot.load(db.session)
+    time.sleep(2 * invalidation_bus.poll_interval)
+
+    statements.clear()
+    for _ in range(1000):
+        assignment_snapshot.load(db.session)
+    idle = len(statements)
+
+    delays = []
+    for i in range(5):
+        name = f"Agente {time.time_ns()}"
+        result = subprocess.run([sys.executable, '-c', sys.argv[2], sys.argv[1], name],
+                                capture_output=True, text=True, check=True)
+        committed = float(result.stdout.split()[-1])
+        while name not in {agent.name for agent in assignment_snapshot.load(db.session).agents.values()}:
+            time.sleep(0.005)
+        delays.append(time.time() - committed)
+    print(invalidation_bus.backend, idle, max(delays))
+"""
+
+def bench_invalidation():
+    """
+    Invalidazione tra processi su SQLite: nessuna query per richiesta a regime
+    e ritardo massimo con cui un worker vede le scritture di un altro.
+    """
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = f"sqlite:///{os.path.join(directory, 'invalidation.db')}"
+        result = subprocess.run([sys.executable, '-c', _INVALIDATION_READER_SCRIPT, database_url,
+                                 _INVALIDATION_WRITER_SCRIPT], capture_output=True, text=True)
+    if result.returncode != 0:
+        logger.error(f"[invalidation] errore: {result.stderr[-2000:]}")
+        return
+
+    backend, idle, delay = result.stdout.split()[-3:]
+    logger.info(f"[invalidation] {backend}: {idle} query SQL su 1000 letture a regime, "
+                f"scritture di un altro processo visibili entro {float(delay) * 1000:.0f} ms")
+
+# Processo con N mappe aperte sullo stream SSE: istruzioni SQL e ritardo per una scrittura di un altro processo
+_STREAM_SCRIPT = """
+import os, sys, time, threading, subprocess
+os.environ['DATABASE_URL'] = sys.argv[1]
+from sqlalchemy import event
+from app import app
+from database import db
+from invalidation_bus import invalidation_bus
+
+statements = []
+received = []
+with app.app_context():
+    event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+def listen():
+    response = app.test_client().get('/api/assignments/stream', buffered=False)
+    for chunk in response.response:
+        if b'event: changes' in chunk:
+            received.append(time.time())
+            return
+
+threads = [threading.Thread(target=listen, daemon=True) for _ in range(int(sys.argv[3]))]
+for thread in threads:
+    thread.start()
+time.sleep(2 * invalidation_bus.poll_interval)
+
+statements.clear()
+result = subprocess.run([sys.executable, '-c', sys.argv[2], sys.argv[1], f"Agente {time.time_ns()}"],
+                        capture_output=True, text=True, check=True)
+committed = float(result.stdout.split()[-1])
+for thread in threads:
+    thread.join(timeout=10)
+print(len(received), len(statements), max(received) - committed if received else -1)
+"""
+
+def bench_stream():
+    """
+    Stream SSE delle modifiche: le istruzioni SQL per una scrittura non devono
+    crescere con il numero di mappe aperte.
+    """
+    import subprocess
+    import tempfile
+
+    for clients in (1, 50):
+        with tempfile.TemporaryDirectory() as directory:
+            database_url = f"sqlite:///{os.path.join(directory, 'stream.db')}"
+            result = subprocess.run([sys.executable, '-c', _STREAM_SCRIPT, database_url,
+                                     _INVALIDATION_WRITER_SCRIPT, str(clients)], capture_output=True, text=True)
+        if result.returncode != 0:
+            logger.error(f"[stream] errore: {result.stderr[-2000:]}")
+            continue
+
+        received, statements, delay = result.stdout.split()[-3:]
+        logger.info(f"[stream] {clients} mappe aperte: evento ricevuto da {received}, "
+                    f"{statements} istruzioni SQL nel processo, ritardo {float(delay) * 1000:.0f} ms")
+
+BENCHMARKS = {
+    'comuni': bench_comuni_index,
+    'store': bench_geometry_store,
+    'bbox': bench_spatial_index,
+    'locate': bench_locate,
+    'partition': bench_partition,
+    'queries': bench_queries,
+    'submit': bench_submit,
+    'import': bench_import,
+    'export': bench_export,
+    'invalidation': bench_invalidation,
+    'stream': bench_stream,
+}
+
+def main():
+    """Funzione principale"""
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            logger.error(f"Benchmark sconosciuto: {name} (disponibili: {', '.join(BENCHMARKS)})")
+            continue
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Eventi conservati per worker, per i client rimasti indietro di qualche revisione
+MAX_BUFFERED_EVENTS = 100
+# Intervallo (secondi) dei commenti che tengono aperta la connessione attraverso i proxy
+KEEPALIVE_INTERVAL = 15.0
+# Durata massima (secondi) di una connessione: EventSource si riconnette da solo con Last-Event-ID
+MAX_STREAM_DURATION = 300.0
+# Connessioni aperte contemporaneamente per worker (ognuna occupa un thread di gunicorn,
+# vedi --threads nel Dockerfile): gli altri thread restano per le richieste normali
+MAX_STREAMS = 48
+# Attesa (millisecondi) suggerita al browser prima di riconnettersi
+RETRY_MILLISECONDS = 5000
+
+def format_event(event, data, event_id=None):
+    """Encode a Server-Sent Event"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'), ensure_ascii=False)}")
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+class ChangeStream:
+    """
+    Fan-out of the assignment changes to the Server-Sent Events clients of a worker.
+
+    The event of each new revision is built once per worker, by the
+    invalidation bus thread, and kept in a short buffer; every open stream
+    only waits on a condition and writes the buffered events it has not sent
+    yet, so the database load does not grow with the number of open maps.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        # (revisione di partenza, revisione, evento codificato), in ordine
+        self._events = deque(maxlen=MAX_BUFFERED_EVENTS)
+        self._revision = None
+        self._build_event = None
+        self.active = 0
+
+    def configure(self, build_event):
+        """
+        Args:
+            build_event (callable): Function since -> (revision, data), where
+                data is the change event from since to revision, or None if
+                the changes are not available
+        """
+        self._build_event = build_event
+
+    @property
+    def revision(self):
+        """Revision of the last event, None before the first notification"""
+        return self._revision
+
+    def publish(self, revision):
+        """Build the event of a new revision and wake the streams (invalidation bus callback)"""
+        previous = self._revision
+        if previous is None or self._build_event is None:
+            with self._condition:
+                self._revision = revision
+            return
+        if revision == previous:
+            return
+
+        try:
+            revision, data = self._build_event(previous)
+        except Exception as e:
+            logger.error(f"Error building the change event {previous} -> {revision}: {str(e)}")
+            data = None
+        if revision == previous:
+            return
+        if data is None:
+            # I client aggiornano lo stato con /api/assignments/changes
+            payload = format_event('resync', {'revision': revision}, event_id=revision)
+        else:
+            payload = format_event('changes', data, event_id=revision)
+        with self._condition:
+            self._events.append((previous, revision, payload))
+            self._revision = revision
+            self._condition.notify_all()
+
+    def _pending(self, since):
+        """Return the events after revision since, or None if the buffer does not cover it"""
+        if self._revision is None or since >= self._revision:
+            # Worker appena avviato, o client più avanti di questo worker (pagina resa da
+            # un altro worker dopo una scrittura): si aspetta l'evento successivo
+            return []
+        events = list(self._events)
+        for i, (start, revision, _) in enumerate(events):
+            if start <= since < revision:
+                return [payload for _, _, payload in events[i:]]
+        return None
+
+    def stream(self, since=None):
+        """
+        Yield the Server-Sent Events from revision since until the maximum duration.
+
+        Args:
+            since (int): Revision the client already has; None to start from the current one
+
+        Yields:
+            bytes: Encoded events and keep-alive comments
+        """
+        with self._condition:
+            self.active += 1
+        try:
+            yield f"retry: {RETRY_MILLISECONDS}\n\n".encode('ascii')
+            deadline = time.monotonic() + MAX_STREAM_DURATION
+            last = since if since is not None else self._revision
+            while time.monotonic() < deadline:
+                with self._condition:
+                    pending = self._pending(last) if last is not None else []
+                    if pending == []:
+                        self._condition.wait(KEEPALIVE_INTERVAL)
+                        pending = self._pending(last) if last is not None else []
+                    current = self._revision
+                if current is not None and (last is None or current > last):
+                    last = current
+
+                if pending is None:
+                    # Il client è troppo indietro: chiederà le modifiche all'endpoint REST
+                    yield format_event('resync', {'revision': current}, event_id=current)
+                elif pending:
+                    yield b''.join(pending)
+                else:
+                    yield b': keepalive\n\n'
+        finally:
+            with self._condition:
+                self.active -= 1
+
+# Istanza condivisa da tutto il processo
+change_stream = ChangeStream()
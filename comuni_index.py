@@ -0,0 +1,109 @@
+import logging
+from istat_codes import normalize_code
+
+logger = logging.getLogger(__name__)
+
+class ComuniIndex:
+    """
+    In-memory index of the Italian municipalities.
+
+    Built once from the DataFrame returned by load_comuni_data(), it replaces
+    the boolean-mask scans (comuni_data[comuni_data['codice'] == id]) with
+    dictionary lookups and keeps the region/province groupings precomputed.
+    Records are keyed by canonical ISTAT code, so any alias known to the
+    resolver (5 or 6 digits, numeric or alphanumeric) finds the same comune.
+    """
+
+    def __init__(self, comuni_data, resolver=None):
+        """
+        Args:
+            comuni_data (DataFrame): DataFrame with columns codice, comune, provincia, regione
+            resolver (IstatCodeResolver): Alias table; if None codes are only zero-padded
+        """
+        self.resolver = resolver
+        self._by_code = {}
+        self._by_province = {}
+        provinces_by_region = {}
+
+        for codice, comune, provincia, regione in zip(comuni_data['codice'],
+                                                      comuni_data['comune'],
+                                                      comuni_data['provincia'],
+                                                      comuni_data['regione']):
+            codice = str(codice)
+            canonical = self.canonical(codice)
+            # In caso di codici duplicati teniamo la prima occorrenza, come faceva iloc[0]
+            if canonical in self._by_code:
+                continue
+
+            record = {
+                'id': codice,
+                'name': comune,
+                'province': provincia,
+                'region': regione
+            }
+            self._by_code[canonical] = record
+            self._by_province.setdefault(provincia, []).append(record)
+            provinces_by_region.setdefault(regione, set()).add(provincia)
+
+        self.regions = sorted(provinces_by_region)
+        self._provinces_by_region = {
+            region: sorted(provinces) for region, provinces in provinces_by_region.items()
+        }
+
+        logger.info(f"ComuniIndex built with {len(self._by_code)} municipalities, "
+                    f"{len(self._by_province)} provinces, {len(self.regions)} regions")
+
+    def __len__(self):
+        return len(self._by_code)
+
+    def __contains__(self, comune_id):
+        return self.canonical(comune_id) in self._by_code
+
+    def canonical(self, comune_id):
+        """Return the canonical ISTAT code for any known form of a code"""
+        if self.resolver is not None:
+            return self.resolver.canonical(comune_id)
+        return normalize_code(comune_id)
+
+    def get(self, comune_id):
+        """
+        Return the details of a municipality as a new dict, or None if unknown.
+
+        Args:
+            comune_id (str): Municipality code in any format known to the resolver
+
+        Returns:
+            dict: {'id', 'name', 'province', 'region'} or None, where 'id' is
+            the code as stored in the CSV (and in the Assignment table)
+        """
+        record = self._by_code.get(self.canonical(comune_id))
+        return dict(record) if record is not None else None
+
+    def name(self, comune_id, default=None):
+        """Return only the name of a municipality"""
+        record = self._by_code.get(self.canonical(comune_id))
+        return record['name'] if record is not None else default
+
+    def provinces(self, region):
+        """Return the sorted provinces of a region"""
+        return list(self._provinces_by_region.get(region, []))
+
+    def comuni_in_province(self, province):
+        """Return the municipalities of a province, in CSV order"""
+        return [dict(record) for record in self._by_province.get(province, [])]
+
+    def codes(self, region=None, province=None):
+        """
+        Return the canonical codes of the municipalities of a province, a region
+        or (with no arguments) of all of Italy.
+        """
+        if province is not None:
+            records = self._by_province.get(province, [])
+            return [self.canonical(record['id']) for record in records]
+        if region is not None:
+            return [
+                self.canonical(record['id'])
+                for province in self._provinces_by_region.get(region, [])
+                for record in self._by_province[province]
+            ]
+        return list(self._by_code)
@@ -6,150 +6,249 @@ import hashlib
 import os.path
 from pathlib import Path
 from urllib.parse import quote
+from collections import OrderedDict
+from istat_codes import normalize_code
+from geometry_store import load_fragments, GeometryStore, COMUNI_ADJACENCY_PATH
+from spatial_index import spatial_index
 
 logger = logging.getLogger(__name__)
 
-def get_geojson_from_wfs(comune_ids):
+def _canonical_ids(comune_ids, resolver=None):
+    """Risolve gli ID nel codice ISTAT canonico, eliminando i duplicati"""
+    canonical = resolver.canonical if resolver is not None else normalize_code
+    return list(OrderedDict.fromkeys(canonical(comune_id) for comune_id in comune_ids))
+
+# Parti fisse di una FeatureCollection serializzata
+FEATURE_COLLECTION_HEAD = b'{"type":"FeatureCollection","features":['
+FEATURE_COLLECTION_TAIL = b']}'
+
+def _ensure_geojson_data():
+    """
+    Scarica ed elabora i dati GeoJSON se non sono ancora presenti.
+    
+    Returns:
+        bool: True se i dati sono disponibili, False altrimenti
+    """
+    geojson_path = Path("static/data/geojson/comuni_italiani.geojson")
+    
+    if geojson_path.exists():
+        return True
+    
+    # Prova a scaricare i dati
+    try:
+        # Importa il modulo di download solo quando necessario
+        logger.info("GeoJSON data not found. Downloading from Openpolis...")
+        import download_italy_geojson
+        download_italy_geojson.main()
+        
+        # Processa i dati
+        import process_geojson
+        process_geojson.main()
+        return True
+    except Exception as e:
+        logger.error(f"Failed to download GeoJSON data: {e}")
+        return False
+
+def _encode_feature(feature):
+    """Serializza una feature nello stesso formato compatto prodotto dall'ETL"""
+    return json.dumps(feature, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def _encode_fallback(comune_ids, name_lookup=None):
+    """Genera e serializza i poligoni di fallback, con il nome reale del comune se disponibile"""
+    features = _generate_fallback_geojson(comune_ids)['features']
+    if name_lookup is not None:
+        for feature in features:
+            comune_id = feature['properties']['id']
+            feature['properties']['name'] = name_lookup(comune_id, f"Comune {comune_id}")
+    return [_encode_feature(feature) for feature in features]
+
+def filter_by_bbox(comune_ids, bbox):
     """
-    Retrieve GeoJSON data for the given municipality IDs.
+    Keep the municipalities whose bounding box intersects bbox, in the given order.
+    
+    Args:
+        comune_ids (list): Canonical ISTAT codes
+        bbox (tuple): (minlon, minlat, maxlon, maxlat), or None for no filter
+    
+    Returns:
+        list: The visible codes; all of them if bbox is None or the spatial index is not available
+    """
+    if bbox is None:
+        return list(comune_ids)
+    index = spatial_index.load()
+    if index is None:
+        logger.warning("Spatial index not available, bbox filter skipped")
+        return list(comune_ids)
+    visible = index.query_bbox(bbox)
+    visible_ids = [comune_id for comune_id in comune_ids if comune_id in visible]
+    logger.info(f"{len(visible_ids)} comuni intersect bbox {bbox}")
+    return visible_ids
+
+def get_geojson_fragments(comune_ids, resolver=None, name_lookup=None, lod=None):
+    """
+    Retrieve the pre-serialized GeoJSON features for the given municipality IDs.
+    
+    The features come from the ETL already encoded, with their final properties,
+    so the cost of a request depends only on the number of requested comuni.
     
     Args:
         comune_ids (list): List of municipality IDs to fetch
+        resolver (IstatCodeResolver): Alias table used to canonicalize the IDs;
+            if None the IDs are only zero-padded to 6 digits
+        name_lookup (callable): (comune_id, default) -> name, used for fallback polygons
+        lod (str): Level of detail (see geometry_store.LOD_LEVELS); None for the default
     
     Returns:
-        dict: GeoJSON data with the requested municipalities
+        list: Feature JSON fragments (bytes or memoryview), one per requested municipality
     """
-    logger.info(f"Fetching GeoJSON for comune IDs: {comune_ids}")
+    logger.info(f"Fetching GeoJSON for {len(comune_ids)} comune IDs")
     
     try:
-        # Verifica se il file JSON con i dati dei comuni esiste già
-        comuni_dict_path = Path("static/data/geojson/optimized/comuni_dict.json")
-        geojson_path = Path("static/data/geojson/comuni_italiani.geojson")
+        # Ogni ID viene risolto nel codice ISTAT canonico con una sola ricerca
+        # nella tabella degli alias; i duplicati vengono eliminati
+        requested_ids = _canonical_ids(comune_ids, resolver)
         
-        # Se non abbiamo ancora dati GeoJSON, proviamo a scaricarli
-        if not geojson_path.exists():
-            # Prova a scaricare i dati
-            try:
-                # Importa il modulo di download solo quando necessario
-                logger.info("GeoJSON data not found. Downloading from Openpolis...")
-                import download_italy_geojson
-                download_italy_geojson.main()
-                
-                # Processa i dati
-                import process_geojson
-                process_geojson.main()
-            except Exception as e:
-                logger.error(f"Failed to download GeoJSON data: {e}")
-                # In caso di errore, torniamo ai poligoni generati
-                return _generate_fallback_geojson(comune_ids)
-                
-        # Verifichiamo se abbiamo i dati ottimizzati
-        if comuni_dict_path.exists():
-            try:
-                with open(comuni_dict_path, 'r') as f:
-                    comuni_dict = json.load(f)
-                    
-                logger.info(f"Loaded comuni dictionary with {len(comuni_dict)} items")
-                
-                # Crea una feature collection con solo i comuni richiesti
-                features = []
-                
-                # Normalizziamo gli ID dei comuni per gestire diverse formattazioni
-                normalized_comuni_ids = []
-                for comune_id in comune_ids:
-                    # Assicurati che sia una stringa
-                    comune_id_str = str(comune_id).strip()
-                    
-                    # Se è un codice ISTAT completo (es. 097042), usalo così com'è
-                    if len(comune_id_str) == 6:
-                        normalized_comuni_ids.append(comune_id_str)
-                    # Se è solo un ID di comune senza prefisso della provincia (es. 042 per Lecco)
-                    elif len(comune_id_str) <= 3:
-                        # Aggiungiamo codici per diverse province per aumentare la compatibilità
-                        normalized_comuni_ids.append(f"097{comune_id_str.zfill(3)}")  # Lecco
-                        normalized_comuni_ids.append(f"013{comune_id_str.zfill(3)}")  # Como
-                        normalized_comuni_ids.append(f"016{comune_id_str.zfill(3)}")  # Bergamo
-                    # Per altri formati (es. 97042 o 13042)
-                    else:
-                        # Se inizia con 97, è probabilmente un comune della provincia di Lecco (097)
-                        if comune_id_str.startswith('97'):
-                            normalized_comuni_ids.append(f"0{comune_id_str}")
-                        # Se inizia con 13, è probabilmente un comune della provincia di Como (013)
-                        elif comune_id_str.startswith('13'):
-                            # Aggiungiamo sempre sia la versione con che senza lo zero
-                            normalized_comuni_ids.append(comune_id_str)
-                            normalized_comuni_ids.append(f"0{comune_id_str}")
-                        # Per tutti gli altri formati
-                        else:
-                            # Proviamo sia il formato originale che con uno zero davanti
-                            normalized_comuni_ids.append(comune_id_str)
-                            normalized_comuni_ids.append(f"0{comune_id_str}")
-                
-                logger.info(f"Normalized comune IDs: {normalized_comuni_ids}")
-                
-                # Raggruppa gli IDs per facilitare la ricerca evitando duplicati
-                # La chiave è il comune senza zeri iniziali, il valore è una lista di tutti i formati provati
-                comuni_groups = {}
-                for comune_id in normalized_comuni_ids:
-                    comune_orig = comune_id.lstrip('0')  # Versione senza zeri iniziali
-                    if comune_orig not in comuni_groups:
-                        comuni_groups[comune_orig] = []
-                    comuni_groups[comune_orig].append(comune_id)
-                
-                # Cerca le feature per ciascun comune richiesto
-                missing_comuni = []
-                found_comuni = set()  # Teniamo traccia dei comuni già trovati
-                
-                # Per ogni gruppo di IDs dello stesso comune
-                for comune_orig, id_variants in comuni_groups.items():
-                    # Se questo comune è già stato trovato, continua
-                    if comune_orig in found_comuni:
-                        continue
-                    
-                    # Prova tutte le varianti di ID
-                    found = False
-                    for comune_id in id_variants:
-                        if comune_id in comuni_dict:
-                            features.append(comuni_dict[comune_id])
-                            found_comuni.add(comune_orig)  # Segna come trovato
-                            found = True
-                            break
-                    
-                    # Se nessuna variante è stata trovata, aggiungi una variante all'elenco dei mancanti
-                    if not found:
-                        # Prendi la prima variante come rappresentante per il fallback
-                        first_variant = id_variants[0]
-                        missing_comuni.append(first_variant)
-                        logger.warning(f"Comune ID not found in GeoJSON data: {first_variant} (tried variants: {id_variants})")
-                
-                # Se abbiamo comuni mancanti, genera poligoni per loro
-                if missing_comuni:
-                    logger.warning(f"Generating fallback polygons for {len(missing_comuni)} missing comuni")
-                    fallback_geojson = _generate_fallback_geojson(missing_comuni)
-                    features.extend(fallback_geojson['features'])
-                
-                # Crea il GeoJSON finale
-                geojson = {
-                    "type": "FeatureCollection",
-                    "features": features
-                }
-                
-                logger.info(f"Created GeoJSON with {len(features)} features")
-                return geojson
-                
-            except Exception as e:
-                logger.error(f"Error loading comuni dictionary: {e}")
-                # In caso di errore, torniamo ai poligoni generati
-                return _generate_fallback_geojson(comune_ids)
-        else:
-            logger.warning("Comuni dictionary not found, using fallback")
+        if not _ensure_geojson_data():
+            # In caso di errore, torniamo ai poligoni generati
+            return _encode_fallback(requested_ids, name_lookup)
+        
+        # Feature già serializzate (caricate una sola volta per processo)
+        fragments_by_id, _ = load_fragments(lod)
+        if fragments_by_id is None:
+            logger.warning("Comuni geometries not found, using fallback")
             # Se non abbiamo i dati ottimizzati, torniamo ai poligoni generati
-            return _generate_fallback_geojson(comune_ids)
+            return _encode_fallback(requested_ids, name_lookup)
+        
+        # Cerca le feature per ciascun comune richiesto
+        fragments = []
+        missing_comuni = []
+        for comune_id in requested_ids:
+            fragment = fragments_by_id.get(comune_id)
+            if fragment is not None:
+                fragments.append(fragment)
+            else:
+                missing_comuni.append(comune_id)
+                logger.warning(f"Comune ID not found in GeoJSON data: {comune_id}")
+        
+        # Se abbiamo comuni mancanti, genera poligoni per loro
+        if missing_comuni:
+            logger.warning(f"Generating fallback polygons for {len(missing_comuni)} missing comuni")
+            fragments.extend(_encode_fallback(missing_comuni, name_lookup))
+        
+        logger.info(f"Collected {len(fragments)} GeoJSON features")
+        return fragments
     
     except Exception as e:
         logger.error(f"Error fetching GeoJSON data: {str(e)}")
         raise Exception(f"Failed to retrieve GeoJSON data: {str(e)}")
 
+def _collection_head(members=None):
+    """Return the opening of a FeatureCollection, with optional extra top-level members"""
+    if not members:
+        return FEATURE_COLLECTION_HEAD
+    encoded = json.dumps(members, separators=(',', ':')).encode('utf-8')
+    return b'{"type":"FeatureCollection",' + encoded[1:-1] + b',"features":['
+
+def iter_feature_collection(fragments, members=None):
+    """
+    Assemble a FeatureCollection from pre-serialized features, chunk by chunk.
+    
+    Args:
+        fragments (list): Feature JSON fragments (bytes or memoryview)
+        members (dict): Extra top-level members (e.g. bbox, center)
+    
+    Yields:
+        bytes: Consecutive pieces of the FeatureCollection
+    """
+    yield _collection_head(members)
+    for i, fragment in enumerate(fragments):
+        if i:
+            yield b','
+        # WSGI richiede bytes: le viste sul file mappato vengono copiate un frammento alla volta
+        yield bytes(fragment)
+    yield FEATURE_COLLECTION_TAIL
+
+def join_feature_collection(fragments, members=None):
+    """
+    Assemble a FeatureCollection from pre-serialized features in a single buffer.
+    
+    Args:
+        fragments (list): Feature JSON fragments (bytes or memoryview)
+        members (dict): Extra top-level members (e.g. bbox, center)
+    
+    Returns:
+        bytes: The encoded FeatureCollection
+    """
+    return b''.join((_collection_head(members), b','.join(fragments), FEATURE_COLLECTION_TAIL))
+
+def _geometry_extent(geometry):
+    """
+    Bounding box and vertex average of a GeoJSON geometry, for data without
+    precomputed metrics.
+    
+    Returns:
+        tuple: (min_lon, min_lat, max_lon, max_lat, center_lon, center_lat) or None
+    """
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+    points = [point for polygon in polygons for ring in polygon for point in ring]
+    if not points:
+        return None
+    lons = [point[0] for point in points]
+    lats = [point[1] for point in points]
+    return (min(lons), min(lats), max(lons), max(lats), sum(lons) / len(lons), sum(lats) / len(lats))
+
+def get_bounds_and_center(comune_ids, lod=None):
+    """
+    Aggregate bounding box and center of a set of municipalities.
+    
+    Uses the bounding boxes, centroids and areas precomputed by
+    process_geojson.py, so the cost is O(number of comuni); the center is the
+    area-weighted average of the centroids. With data produced by an older
+    ETL the geometries are decoded instead.
+    
+    Args:
+        comune_ids (iterable): Canonical ISTAT codes
+        lod (str): Level of detail of the store to read
+    
+    Returns:
+        tuple: ([min_lon, min_lat, max_lon, max_lat], [lat, lon]) or (None, None)
+            if no geometry is known
+    """
+    fragments, _ = load_fragments(lod)
+    if fragments is None:
+        return None, None
+    
+    has_metrics = getattr(fragments, 'has_metrics', False)
+    min_lon = min_lat = math.inf
+    max_lon = max_lat = -math.inf
+    weighted_lon = weighted_lat = total_weight = 0.0
+    
+    for comune_id in comune_ids:
+        if has_metrics:
+            metrics = fragments.metrics(comune_id)
+            if metrics is None:
+                continue
+            west, south, east, north, center_lon, center_lat, weight = metrics
+        else:
+            fragment = fragments.get(comune_id)
+            if fragment is None:
+                continue
+            extent = _geometry_extent(json.loads(bytes(fragment))['geometry'])
+            if extent is None:
+                continue
+            west, south, east, north, center_lon, center_lat = extent
+            weight = 1.0
+        
+        min_lon, min_lat = min(min_lon, west), min(min_lat, south)
+        max_lon, max_lat = max(max_lon, east), max(max_lat, north)
+        weighted_lon += center_lon * weight
+        weighted_lat += center_lat * weight
+        total_weight += weight
+    
+    if total_weight == 0:
+        return None, None
+    return [min_lon, min_lat, max_lon, max_lat], [weighted_lat / total_weight, weighted_lon / total_weight]
+
 def _generate_fallback_geojson(comune_ids):
     """
     Genera poligoni di fallback per i comuni richiesti.
@@ -206,30 +305,9 @@ def _generate_fallback_geojson(comune_ids):
         coords.append(coords[0])
         return coords
     
-    # Elimina duplicati: se abbiamo '13001' e '013001', teniamo solo una versione
-    unique_comuni = {}
-    for comune_id in comune_ids:
-        comune_id_str = str(comune_id).strip()
-        stripped_id = comune_id_str.lstrip('0')  # Rimuovi gli zeri iniziali
-        
-        # Mantieni la versione con lo zero per coerenza con il GeoJSON
-        if stripped_id not in unique_comuni:
-            # Preferisci la versione con lo zero iniziale quando disponibile
-            if comune_id_str.startswith('0'):
-                unique_comuni[stripped_id] = comune_id_str
-            else:
-                unique_comuni[stripped_id] = comune_id_str
-    
     # Generazione dei GeoJSON features per ogni comune
-    for comune_orig, comune_id_str in unique_comuni.items():
-        # Normalizza l'ID
-        if len(comune_id_str) == 6 and comune_id_str.startswith('0'):
-            normalized_id = comune_id_str
-        elif comune_id_str.startswith('97'):
-            normalized_id = '0' + comune_id_str
-        else:
-            normalized_id = comune_id_str
-            
+    # (gli ID sono normalizzati a 6 cifre: '13001' e '013001' sono lo stesso comune)
+    for normalized_id in OrderedDict.fromkeys(normalize_code(comune_id) for comune_id in comune_ids):
         # Usa coordinate specifiche per i comuni di Lecco, altrimenti genera un poligono
         # Se il comune inizia con 097 (codice Lecco), cerchiamo di usare coordinate realistiche
         is_lecco = normalized_id.startswith('097')
@@ -285,47 +363,240 @@ def _generate_fallback_geojson(comune_ids):
     logger.info(f"Generated fallback GeoJSON with {len(features)} features")
     return geojson
 
-def get_center_coordinates(geojson):
+def approximate_area_km2(geometries):
     """
-    Calculate the center coordinates for a GeoJSON object.
+    Approximate area in km² of lon/lat geometries (degrees² scaled by the
+    cosine of the centroid latitude), accurate enough at the size of a comune.
     
     Args:
-        geojson (dict): GeoJSON data
+        geometries (ndarray): Shapely geometries
     
     Returns:
-        tuple: (latitude, longitude) center coordinates
+        ndarray: Area of each geometry
     """
-    if not geojson or 'features' not in geojson or not geojson['features']:
-        # Default to center of Italy if no features
-        return (41.9, 12.5)
+    import numpy as np
+    import shapely
     
-    # Extract all coordinates from all features
-    all_points = []
+    centroids_lat = shapely.get_y(shapely.centroid(geometries))
+    return shapely.area(geometries) * np.cos(np.radians(centroids_lat)) * KM_PER_DEGREE ** 2
+
+def compute_metrics(comune_ids, geometries):
+    """
+    Compute bounding box, centroid and area of each municipality.
     
-    for feature in geojson['features']:
-        if 'geometry' in feature and feature['geometry']:
-            geometry = feature['geometry']
-            
-            if geometry['type'] == 'Polygon':
-                # Extract points from polygon coordinates
-                for ring in geometry['coordinates']:
-                    for point in ring:
-                        all_points.append(point)
-            
-            elif geometry['type'] == 'MultiPolygon':
-                # Extract points from multipolygon coordinates
-                for polygon in geometry['coordinates']:
-                    for ring in polygon:
-                        for point in ring:
-                            all_points.append(point)
-    
-    if not all_points:
-        # Default to center of Italy if no points found
-        return (41.9, 12.5)
-    
-    # Calculate the average of all coordinates
-    sum_lon = sum(point[0] for point in all_points)
-    sum_lat = sum(point[1] for point in all_points)
-    count = len(all_points)
-    
-    return (sum_lat / count, sum_lon / count)
+    Args:
+        comune_ids (list): Canonical ISTAT codes
+        geometries (list): Original shapely geometries, in the same order
+    
+    Returns:
+        dict: ISTAT code -> tuple of geometry_store.METRIC_FIELDS values
+    """
+    import numpy as np
+    import shapely
+    
+    geometries = np.asarray(geometries, dtype=object)
+    bounds = shapely.bounds(geometries)
+    centroids = shapely.centroid(geometries)
+    columns = np.column_stack((bounds, shapely.get_x(centroids), shapely.get_y(centroids),
+                               approximate_area_km2(geometries)))
+    return {comune_id: tuple(row) for comune_id, row in zip(comune_ids, columns.tolist())}
+
+def build_adjacency(comune_ids, geometries):
+    """
+    Build the adjacency graph of the municipalities from their shared boundaries.
+    
+    Candidate pairs come from an STRtree; two comuni are neighbours when their
+    intersection is at least a line (touching in a single point does not count).
+    A comune is marked as on the edge when part of its boundary is not shared
+    with any neighbour (coast or national border).
+    
+    Args:
+        comune_ids (list): Canonical ISTAT codes
+        geometries (list): Original (not simplified) shapely geometries, in the same order
+    
+    Returns:
+        AdjacencyGraph: The graph
+    """
+    import numpy as np
+    import shapely
+    
+    geometries = np.asarray(geometries, dtype=object)
+    tree = shapely.STRtree(geometries)
+    left, right = tree.query(geometries, predicate='intersects')
+    
+    # Ogni coppia una sola volta, poi si scartano i contatti puntiformi
+    pairs = left < right
+    left, right = left[pairs], right[pairs]
+    shared = shapely.get_dimensions(shapely.intersection(geometries[left], geometries[right])) >= 1
+    left, right = left[shared], right[shared]
+    
+    # Formato CSR: i vicini del comune i sono indices[indptr[i]:indptr[i + 1]]
+    rows = np.concatenate((left, right))
+    cols = np.concatenate((right, left))
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    indptr = np.zeros(len(comune_ids) + 1, dtype=np.int32)
+    np.add.at(indptr, rows + 1, 1)
+    indptr = np.cumsum(indptr, dtype=np.int32)
+    indices = cols.astype(np.int32)
+    
+    boundaries = shapely.boundary(geometries)
+    on_edge = np.zeros(len(comune_ids), dtype=bool)
+    for i in range(len(comune_ids)):
+        neighbours = indices[indptr[i]:indptr[i + 1]]
+        if len(neighbours) == 0:
+            on_edge[i] = True
+            continue
+        shared_boundary = shapely.union_all(boundaries[neighbours]).buffer(EDGE_TOLERANCE)
+        on_edge[i] = boundaries[i].difference(shared_boundary).length > EDGE_MIN_LENGTH
+    
+    # Superficie approssimata, usata come peso per il bilanciamento dei territori
+    area_km2 = approximate_area_km2(geometries)
+    
+    logger.info(f"Adjacency graph with {len(comune_ids)} comuni, {len(left)} borders, "
+                f"{int(on_edge.sum())} on the edge")
+    return AdjacencyGraph(np.array(comune_ids, dtype='<U6'), indptr, indices, on_edge, area_km2)
+
+class AdjacencyGraph:
+    """
+    Adjacency graph of the municipalities, in CSR form.
+    
+    The arrays are produced by process_geojson.py and loaded once per process;
+    queries walk the graph in memory, without any geometry computation.
+    """
+    
+    def __init__(self, ids, indptr, indices, on_edge, area_km2=None):
+        """
+        Args:
+            ids (ndarray): Canonical ISTAT codes, one per node
+            indptr (ndarray): CSR row pointers (len(ids) + 1)
+            indices (ndarray): CSR column indices (neighbour nodes)
+            on_edge (ndarray): True for the comuni on the coast or the national border
+            area_km2 (ndarray): Approximate area of each comune, or None if not available
+        """
+        self.ids = ids.tolist()
+        self.positions = {comune_id: i for i, comune_id in enumerate(self.ids)}
+        # Liste Python: l'accesso elemento per elemento è più veloce che sugli array numpy
+        self.indptr = indptr.tolist()
+        self.indices = indices.tolist()
+        self.on_edge = on_edge.tolist()
+        self.area_km2 = area_km2.tolist() if area_km2 is not None else None
+        self._arrays = (ids, indptr, indices, on_edge, area_km2)
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __contains__(self, comune_id):
+        return comune_id in self.positions
+    
+    @classmethod
+    def load(cls, path):
+        """Load a graph saved with save()"""
+        import numpy as np
+        with np.load(path) as data:
+            # Le superfici mancano nei file prodotti dalle versioni precedenti dell'ETL
+            area_km2 = data['area_km2'] if 'area_km2' in data.files else None
+            return cls(data['ids'], data['indptr'], data['indices'], data['on_edge'], area_km2)
+    
+    def save(self, path):
+        """Save the CSR arrays as .npz, replacing the file atomically"""
+        import numpy as np
+        ids, indptr, indices, on_edge, area_km2 = self._arrays
+        arrays = {'ids': ids, 'indptr': indptr, 'indices': indices, 'on_edge': on_edge}
+        if area_km2 is not None:
+            arrays['area_km2'] = area_km2
+        tmp_path = Path(path).with_suffix(".npz.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+    
+    def _neighbour_positions(self, position):
+        return self.indices[self.indptr[position]:self.indptr[position + 1]]
+    
+    def neighbours(self, comune_id):
+        """
+        Return the municipalities bordering a comune.
+        
+        Returns:
+            list: Canonical ISTAT codes, empty if the comune is unknown
+        """
+        position = self.positions.get(comune_id)
+        if position is None:
+            return []
+        return [self.ids[n] for n in self._neighbour_positions(position)]
+    
+    def components(self, comune_ids):
+        """
+        Split a territory into its contiguous parts.
+        
+        Args:
+            comune_ids (iterable): Canonical ISTAT codes of the territory
+        
+        Returns:
+            list: Lists of codes, one per connected component, largest first;
+                codes not in the graph are ignored
+        """
+        members = {self.positions[c] for c in comune_ids if c in self.positions}
+        visited = set()
+        components = []
+        for start in members:
+            if start in visited:
+                continue
+            visited.add(start)
+            component = [start]
+            stack = [start]
+            while stack:
+                for n in self._neighbour_positions(stack.pop()):
+                    if n in members and n not in visited:
+                        visited.add(n)
+                        component.append(n)
+                        stack.append(n)
+            components.append([self.ids[p] for p in component])
+        components.sort(key=len, reverse=True)
+        return components
+    
+    def enclaves(self, comune_ids):
+        """
+        Find the groups of municipalities entirely surrounded by a territory.
+        
+        An enclave is a connected group of comuni outside the territory that
+        borders only the territory and does not reach the coast or the
+        national border.
+        
+        Args:
+            comune_ids (iterable): Canonical ISTAT codes of the territory
+        
+        Returns:
+            list: Lists of codes, one per enclave, largest first
+        """
+        members = {self.positions[c] for c in comune_ids if c in self.positions}
+        visited = set(members)
+        enclaves = []
+        for member in members:
+            for start in self._neighbour_positions(member):
+                if start in visited:
+                    continue
+                # Visita della componente esterna al territorio che parte da questo vicino
+                visited.add(start)
+                component = [start]
+                stack = [start]
+                enclosed = not self.on_edge[start]
+                while stack:
+                    for n in self._neighbour_positions(stack.pop()):
+                        if n not in visited:
+                            visited.add(n)
+                            component.append(n)
+                            stack.append(n)
+                            if self.on_edge[n]:
+                                enclosed = False
+                if enclosed:
+                    enclaves.append([self.ids[p] for p in component])
+        enclaves.sort(key=len, reverse=True)
+        return enclaves
+
+# Grafo di adiacenza condiviso da tutto il processo, ricaricato se l'ETL lo rigenera
+adjacency_store = GeometryStore(COMUNI_ADJACENCY_PATH, loader=AdjacencyGraph.load)
+
+def load_adjacency():
+    """Return the adjacency graph, or None if process_geojson.py has not built it yet"""
+    return adjacency_store.load()
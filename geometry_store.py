@@ -0,0 +1,335 @@
+import os
+import json
+import mmap
+import hashlib
+import struct
+import logging
+import weakref
+import threading
+from pathlib import Path
+from topology import load_topology
+
+logger = logging.getLogger(__name__)
+
+# Dizionario ISTAT -> Feature prodotto da process_geojson.py (formato storico)
+COMUNI_DICT_PATH = Path("static/data/geojson/optimized/comuni_dict.json")
+# Feature già serializzate, una per riga: "<codice ISTAT>\t<Feature JSON>"
+COMUNI_FRAGMENTS_PATH = Path("static/data/geojson/optimized/comuni_features.jsonl")
+# Le stesse feature in formato binario, aperto con mmap e condiviso tra i worker
+COMUNI_BINARY_PATH = Path("static/data/geojson/optimized/comuni_geometry.bin")
+# Topologia TopoJSON con archi condivisi e coordinate quantizzate
+COMUNI_TOPOLOGY_PATH = Path("static/data/geojson/optimized/comuni_topology.json")
+# Grafo di adiacenza dei comuni (array CSR in formato .npz)
+COMUNI_ADJACENCY_PATH = Path("static/data/geojson/optimized/comuni_adjacency.npz")
+
+# Livelli di dettaglio generati dall'ETL: (nome, tolleranza di semplificazione in gradi,
+# zoom minimo di Leaflet a cui usarlo). Il livello predefinito corrisponde ai file
+# senza suffisso, gli altri sono salvati come comuni_geometry_<nome>.bin
+LOD_LEVELS = [
+    ('nazionale', 0.01, 0),
+    ('regionale', 0.004, 7),
+    ('provinciale', 0.001, 9),
+    ('stradale', 0.0002, 11),
+]
+DEFAULT_LOD = 'provinciale'
+
+def lod_binary_path(level):
+    """Return the path of the binary store of a level of detail"""
+    if level == DEFAULT_LOD:
+        return COMUNI_BINARY_PATH
+    return COMUNI_BINARY_PATH.with_name(f"comuni_geometry_{level}.bin")
+
+def select_lod(zoom=None, tolerance=None):
+    """
+    Choose the level of detail for a map zoom or a maximum simplification tolerance.
+    
+    Args:
+        zoom (int): Leaflet zoom level
+        tolerance (float): Largest acceptable simplification tolerance, in degrees
+    
+    Returns:
+        str: Name of the level, DEFAULT_LOD if neither argument is given
+    """
+    if tolerance is not None:
+        # Il livello più semplificato che rispetta la tolleranza richiesta
+        for level, level_tolerance, _ in LOD_LEVELS:
+            if level_tolerance <= tolerance:
+                return level
+        return LOD_LEVELS[-1][0]
+    if zoom is not None:
+        selected = LOD_LEVELS[0][0]
+        for level, _, min_zoom in LOD_LEVELS:
+            if zoom >= min_zoom:
+                selected = level
+        return selected
+    return DEFAULT_LOD
+
+# Formato binario:
+#   header  = magic (8 byte) + numero di comuni (uint32)
+#   indice  = per ogni comune: codice ISTAT (6 byte ASCII), offset (uint64), lunghezza (uint32)
+#             e, dalla versione 2, le metriche del comune (7 double, vedi METRIC_FIELDS)
+#   dati    = Feature JSON concatenate; gli offset sono assoluti rispetto all'inizio del file
+BINARY_MAGIC = b'RMGEO001'
+BINARY_MAGIC_METRICS = b'RMGEO002'
+BINARY_HEADER = struct.Struct('<8sI')
+BINARY_INDEX_ENTRY = struct.Struct('<6sQI')
+BINARY_INDEX_ENTRY_METRICS = struct.Struct('<6sQI7d')
+
+# Metriche precalcolate dall'ETL sulle geometrie originali: riquadro, baricentro e superficie
+METRIC_FIELDS = ('min_lon', 'min_lat', 'max_lon', 'max_lat', 'centroid_lon', 'centroid_lat', 'area_km2')
+
+def write_binary_store(path, fragments, metrics=None):
+    """
+    Write the pre-serialized features in the binary format read by MappedFragments.
+
+    Args:
+        path (Path): Output file
+        fragments (dict): ISTAT code (6 characters) -> Feature JSON (bytes)
+        metrics (dict): Optional ISTAT code -> tuple of METRIC_FIELDS values;
+            when given, the file is written in version 2 of the format
+    """
+    magic, entry = (BINARY_MAGIC_METRICS, BINARY_INDEX_ENTRY_METRICS) if metrics is not None \
+        else (BINARY_MAGIC, BINARY_INDEX_ENTRY)
+    missing = (float('nan'),) * len(METRIC_FIELDS)
+
+    data_offset = BINARY_HEADER.size + entry.size * len(fragments)
+    with open(path, 'wb') as f:
+        f.write(BINARY_HEADER.pack(magic, len(fragments)))
+        offset = data_offset
+        for comune_id, fragment in fragments.items():
+            values = (comune_id.encode('ascii'), offset, len(fragment))
+            if metrics is not None:
+                values += tuple(metrics.get(comune_id, missing))
+            f.write(entry.pack(*values))
+            offset += len(fragment)
+        for fragment in fragments.values():
+            f.write(fragment)
+
+class MappedFragments:
+    """
+    Read-only view over the binary geometry file.
+
+    The file is mapped with mmap, so the pages live in the OS page cache and
+    are shared by all the gunicorn workers. Opening it only decodes the small
+    offset index; get() returns memoryview slices of the mapping, without
+    copying or parsing the geometry. Files in version 2 also carry the
+    precomputed bounding box, centroid and area of each comune.
+
+    When the store is reloaded the previous instance is dropped, and its
+    mapping is released as soon as the last request using it lets it go;
+    close() releases it explicitly.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        self._finalizer = weakref.finalize(self, _release_mapping, self._view, self._mmap, str(path))
+
+        magic, count = BINARY_HEADER.unpack_from(self._mmap, 0)
+        if magic == BINARY_MAGIC:
+            entry = BINARY_INDEX_ENTRY
+        elif magic == BINARY_MAGIC_METRICS:
+            entry = BINARY_INDEX_ENTRY_METRICS
+        else:
+            raise ValueError(f"{path} is not a geometry store (magic {magic!r})")
+
+        index_end = BINARY_HEADER.size + entry.size * count
+        self._index = {}
+        self._metrics = {} if entry is BINARY_INDEX_ENTRY_METRICS else None
+        for comune_id, offset, length, *metrics in entry.iter_unpack(self._mmap[BINARY_HEADER.size:index_end]):
+            comune_id = comune_id.decode('ascii')
+            self._index[comune_id] = (offset, length)
+            # I valori NaN indicano un comune senza metriche
+            if self._metrics is not None and metrics[0] == metrics[0]:
+                self._metrics[comune_id] = tuple(metrics)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, comune_id):
+        return comune_id in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    @property
+    def has_metrics(self):
+        """True if the file carries the precomputed metrics (format version 2)"""
+        return self._metrics is not None
+
+    def metrics(self, comune_id):
+        """Return the METRIC_FIELDS values of a comune, or None if not available"""
+        if self._metrics is None:
+            return None
+        return self._metrics.get(comune_id)
+
+    def get(self, comune_id, default=None):
+        """Return the Feature JSON of a comune as a memoryview, or default"""
+        entry = self._index.get(comune_id)
+        if entry is None:
+            return default
+        offset, length = entry
+        return self._view[offset:offset + length]
+
+    def close(self):
+        """Release the mapping; the instance must not be used afterwards"""
+        self._finalizer()
+
+def _release_mapping(view, mapped, path):
+    """Release the memoryview and unmap the file of a MappedFragments"""
+    view.release()
+    try:
+        mapped.close()
+    except BufferError:
+        # Alcuni frammenti restituiti da get() sono ancora in uso: la mappatura
+        # viene rilasciata insieme all'ultimo di essi
+        logger.debug(f"Mapping of {path} still referenced, released with the last fragment")
+        return
+    logger.debug(f"Released mapping of {path}")
+
+def _load_json(path):
+    """Parse a JSON file"""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def _load_fragments(path):
+    """
+    Load the pre-serialized features as bytes, without decoding the JSON.
+
+    Returns:
+        dict: ISTAT code -> Feature JSON (bytes)
+    """
+    fragments = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            comune_id, _, fragment = line.rstrip(b'\n').partition(b'\t')
+            if fragment:
+                fragments[comune_id.decode('ascii')] = fragment
+    return fragments
+
+def _load_fragments_from_dict(path):
+    """
+    Build the fragments from comuni_dict.json, for data produced by an older
+    version of process_geojson.py. The encoding cost is paid once per load.
+    """
+    return {
+        comune_id: json.dumps(feature, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        for comune_id, feature in _load_json(path).items()
+    }
+
+class GeometryStore:
+    """
+    Process-level cache of a geometry file.
+
+    The file is loaded once per process (on first use, or at startup via
+    load()) and loaded again only when its modification time or size change,
+    e.g. after process_geojson.py has been re-run. With the JSON formats each
+    gunicorn worker keeps its own copy, while the binary format is mapped and
+    shared through the page cache; the lock only protects the reload between
+    threads of the same worker. process_geojson.py replaces the files atomically, so a worker
+    never sees a half-written file.
+    """
+
+    def __init__(self, path, loader=_load_json):
+        """
+        Args:
+            path (Path): File to load
+            loader (callable): Function path -> loaded data
+        """
+        self.path = Path(path)
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._data = None
+        self._signature = None
+
+    def _stat_signature(self):
+        """Return (mtime, size) of the file, or None if it does not exist"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self):
+        """
+        Return the loaded data, reloading it if the file changed.
+
+        Returns:
+            The data returned by the loader, or None if the file does not exist
+        """
+        signature = self._stat_signature()
+        if signature is None:
+            return None
+
+        if signature != self._signature:
+            with self._lock:
+                # Un altro thread potrebbe aver già ricaricato il file
+                if signature != self._signature:
+                    self._data = self.loader(self.path)
+                    self._signature = signature
+                    logger.info(f"Loaded {len(self._data)} geometries from {self.path}")
+
+        return self._data
+
+    @property
+    def version(self):
+        """Identifier of the loaded data, changes whenever the file is reloaded"""
+        if self._signature is None:
+            return None
+        return f"{self._signature[0]:x}-{self._signature[1]:x}"
+
+# Istanze condivise da tutto il processo, in ordine di preferenza
+binary_store = GeometryStore(COMUNI_BINARY_PATH, loader=MappedFragments)
+fragments_store = GeometryStore(COMUNI_FRAGMENTS_PATH, loader=_load_fragments)
+legacy_fragments_store = GeometryStore(COMUNI_DICT_PATH, loader=_load_fragments_from_dict)
+
+topology_store = GeometryStore(COMUNI_TOPOLOGY_PATH, loader=load_topology)
+
+# Archivi degli altri livelli di dettaglio
+lod_stores = {
+    level: GeometryStore(lod_binary_path(level), loader=MappedFragments)
+    for level, _, _ in LOD_LEVELS if level != DEFAULT_LOD
+}
+
+def load_fragments(level=None):
+    """
+    Return the mapping ISTAT code -> Feature JSON and the store it came from.
+    
+    The values are bytes or, for the binary store, memoryview slices: both can
+    be passed to bytes.join() without copies.
+
+    Args:
+        level (str): Level of detail; if its store is missing, or level is None,
+            the default level is used
+
+    Returns:
+        tuple: (fragments, store) or (None, None) if no geometry file exists
+    """
+    if level in lod_stores:
+        fragments = lod_stores[level].load()
+        if fragments is not None:
+            return fragments, lod_stores[level]
+
+    for store in (binary_store, fragments_store, legacy_fragments_store):
+        fragments = store.load()
+        if fragments is not None:
+            return fragments, store
+    return None, None
+
+def data_version():
+    """
+    Identifier of all the geometry files currently on disk.
+    
+    It changes whenever process_geojson.py writes new data and is used in the
+    URLs of cacheable geometry responses; only the files are stat-ed, nothing
+    is loaded.
+    """
+    stores = (binary_store, fragments_store, legacy_fragments_store, topology_store, *lod_stores.values())
+    digest = hashlib.sha1()
+    for store in stores:
+        digest.update(repr(store._stat_signature()).encode('ascii'))
+    return digest.hexdigest()[:16]
@@ -0,0 +1,154 @@
+import gzip
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # brotli è opzionale: senza, si usa solo gzip
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Memoria massima occupata dalle risposte compresse, per processo
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 8
+
+class CompressedPayloadCache:
+    """
+    LRU cache of encoded response bodies, bounded by total size.
+
+    Keys are (ETag, content encoding); the identity body is cached as well
+    so that a new encoding of the same payload does not rebuild it.
+    """
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+# Istanza condivisa da tutto il processo
+payload_cache = CompressedPayloadCache()
+
+def negotiate_encoding():
+    """Pick the best content encoding accepted by the client: br, gzip or identity"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br'] > 0:
+        return 'br'
+    if accepted['gzip'] > 0:
+        return 'gzip'
+    return 'identity'
+
+def compress(body, encoding):
+    """Encode a body with the given content encoding"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+def make_etag(*parts):
+    """Build a strong ETag value from the parts that determine a payload"""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def _representation_etag(etag_parts):
+    """Return (encoding, base ETag, ETag) of the representation negotiated for this request"""
+    encoding = negotiate_encoding()
+    base_etag = make_etag(*etag_parts)
+    # Ogni codifica è una rappresentazione diversa, quindi ha il suo ETag
+    etag = base_etag if encoding == 'identity' else f"{base_etag}-{encoding}"
+    return encoding, base_etag, etag
+
+def _not_modified(etag):
+    """Build the 304 response for an ETag"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+def not_modified_response(etag_parts):
+    """
+    Return a 304 if the client already has the payload identified by etag_parts.
+
+    Routes whose ETag depends only on the request (and on the data files on
+    disk) call this before loading anything; the parts must be the same that
+    are later passed to cached_payload_response().
+
+    Args:
+        etag_parts (tuple): Values that identify the payload
+
+    Returns:
+        Response: The 304 response, or None if the payload must be sent
+    """
+    _, _, etag = _representation_etag(etag_parts)
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+    return None
+
+def cached_payload_response(etag_parts, build_payload, mimetype='application/json', cache=payload_cache):
+    """
+    Return a compressed, conditionally cacheable response.
+
+    If the client already has the representation (If-None-Match), the
+    response is a 304 and build_payload is never called. Otherwise the body
+    is taken from the cache or built, compressed and cached.
+
+    Args:
+        etag_parts (tuple): Values that identify the payload (e.g. hash of the
+            comune set and version of the data)
+        build_payload (callable): Function returning the uncompressed body (bytes)
+        mimetype (str): Content type of the payload
+        cache (CompressedPayloadCache): Cache of the encoded bodies
+
+    Returns:
+        Response: The response to send
+    """
+    encoding, base_etag, etag = _representation_etag(etag_parts)
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    body = cache.get((base_etag, encoding))
+    if body is None:
+        identity = cache.get((base_etag, 'identity'))
+        if identity is None:
+            identity = build_payload()
+            cache.put((base_etag, 'identity'), identity)
+        body = compress(identity, encoding)
+        if encoding != 'identity':
+            cache.put((base_etag, encoding), body)
+            logger.debug(f"Compressed payload {base_etag} with {encoding}: {len(identity)} -> {len(body)} bytes")
+
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    if encoding != 'identity':
+        response.content_encoding = encoding
+    return response
@@ -0,0 +1,207 @@
+import os
+import select
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Canale PostgreSQL su cui viene notificata la nuova revisione delle assegnazioni
+NOTIFY_CHANNEL = 'assignments_changed'
+# Intervallo (secondi) di lettura della revisione sui database senza LISTEN/NOTIFY (SQLite)
+POLL_INTERVAL = 1.0
+# Attesa massima (secondi) di una notifica PostgreSQL, e pausa prima di riconnettersi dopo un errore
+LISTEN_TIMEOUT = 5.0
+
+class InvalidationBus:
+    """
+    Process-level notification of changes committed by any worker.
+
+    A background thread follows the assignment revision: on PostgreSQL it
+    LISTENs on NOTIFY_CHANNEL, where every writing transaction notifies the
+    new revision at commit; on other databases (the SQLite fallback) it reads
+    the revision every POLL_INTERVAL seconds on its own connection.
+
+    While the thread is running, `revision` is the latest committed revision
+    and the per-worker caches can compare against it without querying the
+    database on every request. It is None when the bus is not running, or
+    after a local write until a request has read the new revision: callers
+    then read it from the database themselves and report it with observe().
+    """
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._engine = None
+        self._read_revision = None
+        self._revision = None
+        # Incrementato a ogni invalidazione locale, scarta le letture iniziate prima
+        self._generation = 0
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def configure(self, engine, read_revision):
+        """
+        Args:
+            engine: SQLAlchemy engine of the application database
+            read_revision (callable): Function connection -> current revision
+        """
+        self._engine = engine
+        self._read_revision = read_revision
+
+    @property
+    def backend(self):
+        """'listen' on PostgreSQL, 'poll' otherwise, None if not configured or not shared between processes"""
+        if self._engine is None:
+            return None
+        if self._engine.dialect.name == 'postgresql':
+            return 'listen'
+        if self._engine.dialect.name == 'sqlite' and self._engine.url.database in (None, '', ':memory:'):
+            # Un database in memoria è visibile solo da questo processo
+            return None
+        return 'poll'
+
+    @property
+    def running(self):
+        """True if the listener thread is alive in this process"""
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    @property
+    def revision(self):
+        """Latest committed revision, or None if unknown"""
+        if not self.running:
+            # Dopo un fork (es. gunicorn --preload) il thread non esiste nel worker
+            self.start()
+            return None
+        return self._revision
+
+    def start(self):
+        """
+        Start the listener thread in the current process, if configured and not running.
+
+        Idempotent: it can be called on every request, e.g. by the first
+        request of a gunicorn worker forked after the thread was started.
+        """
+        if self.backend is None or self.running:
+            return
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._revision = None
+            self._pid = os.getpid()
+            target = self._listen if self.backend == 'listen' else self._poll
+            self._thread = threading.Thread(target=target, name='invalidation-bus', daemon=True)
+            self._thread.start()
+            logger.info(f"Invalidation bus started ({self.backend}) in process {self._pid}")
+
+    def stop(self):
+        """Stop the listener thread"""
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=LISTEN_TIMEOUT)
+        self._thread = None
+        self._revision = None
+
+    def subscribe(self, callback):
+        """Call callback(revision) from the listener thread whenever the revision changes"""
+        with self._lock:
+            self._callbacks.append(callback)
+
+    @property
+    def generation(self):
+        """Counter of local invalidations, to be passed to observe()"""
+        return self._generation
+
+    def invalidate(self):
+        """Forget the known revision, e.g. after a local commit, so the next read checks the database"""
+        with self._lock:
+            self._revision = None
+            self._generation += 1
+
+    def observe(self, revision, generation):
+        """
+        Record a revision read from the database by a request.
+
+        Args:
+            revision (int): The revision read
+            generation (int): Value of `generation` before the read; if the bus
+                was invalidated in the meantime the read may be stale and is ignored
+        """
+        with self._lock:
+            if generation == self._generation and (self._revision is None or revision > self._revision):
+                self._revision = revision
+
+    def publish(self, revision):
+        """Record a new committed revision and notify the subscribers"""
+        with self._lock:
+            # Dopo un'invalidazione locale la revisione letta dal thread può precedere il
+            # commit appena fatto: resta sconosciuta finché una richiesta non la rilegge
+            if self._revision is not None:
+                self._revision = revision
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(revision)
+            except Exception as e:
+                logger.error(f"Error in invalidation callback {callback!r}: {str(e)}")
+
+    def _current_revision(self):
+        with self._engine.connect() as connection:
+            return self._read_revision(connection)
+
+    def _poll(self):
+        """Polling loop for databases without LISTEN/NOTIFY"""
+        last = None
+        while not self._stop.is_set():
+            try:
+                revision = self._current_revision()
+                if revision != last:
+                    last = revision
+                    self.publish(revision)
+            except Exception as e:
+                logger.warning(f"Invalidation bus: error reading the revision: {str(e)}")
+                last = None
+                self.invalidate()
+            self._stop.wait(self.poll_interval)
+
+    def _listen(self):
+        """LISTEN loop for PostgreSQL, reconnecting after errors"""
+        while not self._stop.is_set():
+            connection = None
+            try:
+                # Connessione dedicata, fuori dal pool, in autocommit per ricevere le notifiche
+                connection = self._engine.raw_connection()
+                connection.detach()
+                dbapi_connection = connection.dbapi_connection
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+                # Le modifiche fatte mentre non eravamo in ascolto
+                self.publish(self._current_revision())
+
+                while not self._stop.is_set():
+                    if select.select([dbapi_connection], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    revision = None
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        revision = max(revision or 0, int(notify.payload))
+                    if revision is not None:
+                        self.publish(revision)
+            except Exception as e:
+                logger.warning(f"Invalidation bus: LISTEN connection lost: {str(e)}")
+                self.invalidate()
+                self._stop.wait(LISTEN_TIMEOUT)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+# Istanza condivisa da tutto il processo
+invalidation_bus = InvalidationBus()
@@ -0,0 +1,121 @@
+import os
+import logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Elenco ufficiale ISTAT completo (tutte le colonne dei codici)
+ISTAT_CSV_PATH = os.path.join('static', 'data', 'elenco_comuni.csv')
+
+# Colonne del file ISTAT che contengono codici correnti del comune
+CURRENT_CODE_COLUMNS = [
+    "Codice Comune formato alfanumerico",
+    "Codice Comune formato numerico",
+    "Codice Catastale del comune",
+]
+
+# Codici storici: usati solo se non entrano in conflitto con un codice corrente
+HISTORICAL_CODE_COLUMNS = [
+    "Codice Comune numerico con 110 province (dal 2010 al 2016)",
+    "Codice Comune numerico con 107 province (dal 2006 al 2009)",
+    "Codice Comune numerico con 103 province (dal 1995 al 2005)",
+]
+
+def normalize_code(comune_id):
+    """
+    Normalize a municipality code without using the alias table.
+
+    Numeric codes are zero-padded to the 6-digit ISTAT format (97001 -> 097001),
+    any other value is returned stripped.
+    """
+    code = str(comune_id).strip()
+    if code.isdigit() and len(code) <= 6:
+        return code.zfill(6)
+    return code
+
+class IstatCodeResolver:
+    """
+    Alias table mapping every known form of a municipality code to its
+    canonical 6-digit ISTAT code (e.g. '97001', '097001', 'E507' -> '097001').
+
+    The table is built once at startup, so resolving a code is a single
+    dictionary lookup instead of trying format variants for every request.
+    """
+
+    def __init__(self):
+        self._aliases = {}
+
+    def __len__(self):
+        return len(self._aliases)
+
+    def add(self, canonical, alias, override=True):
+        """
+        Register an alias for a canonical code.
+
+        Args:
+            canonical (str): Canonical 6-digit ISTAT code
+            alias (str): Alternative form of the code
+            override (bool): If False, an alias that already exists is kept
+        """
+        alias = str(alias).strip()
+        if not alias or alias == 'nan':
+            return
+        forms = [alias]
+        if alias.isdigit():
+            # Forma a 6 cifre e forma senza zeri iniziali
+            forms.extend([alias.zfill(6), alias.lstrip('0')])
+        for form in forms:
+            if override:
+                self._aliases[form] = canonical
+            else:
+                self._aliases.setdefault(form, canonical)
+
+    def resolve(self, comune_id):
+        """
+        Return the canonical code of a municipality, or None if the code is unknown.
+        """
+        return self._aliases.get(str(comune_id).strip())
+
+    def canonical(self, comune_id):
+        """
+        Return the canonical code if known, otherwise the normalized input.
+        """
+        return self._aliases.get(str(comune_id).strip()) or normalize_code(comune_id)
+
+    @classmethod
+    def from_comuni_data(cls, comuni_data, istat_csv_path=ISTAT_CSV_PATH):
+        """
+        Build the alias table from the application dataset and, when available,
+        from the full ISTAT list with its numeric, alphanumeric and historical codes.
+
+        Args:
+            comuni_data (DataFrame): DataFrame returned by load_comuni_data()
+            istat_csv_path (str): Path of the full ISTAT CSV file
+
+        Returns:
+            IstatCodeResolver: The populated resolver
+        """
+        resolver = cls()
+
+        for codice in comuni_data['codice']:
+            resolver.add(normalize_code(codice), codice)
+
+        if os.path.exists(istat_csv_path):
+            try:
+                istat_df = pd.read_csv(istat_csv_path, encoding='ISO-8859-1', sep=';', dtype=str)
+                canonical_codes = istat_df["Codice Comune formato alfanumerico"].map(normalize_code)
+
+                for column in CURRENT_CODE_COLUMNS:
+                    if column in istat_df.columns:
+                        for canonical, alias in zip(canonical_codes, istat_df[column]):
+                            resolver.add(canonical, alias)
+
+                for column in HISTORICAL_CODE_COLUMNS:
+                    if column in istat_df.columns:
+                        for canonical, alias in zip(canonical_codes, istat_df[column]):
+                            resolver.add(canonical, alias, override=False)
+            except Exception as e:
+                logger.error(f"Error loading ISTAT codes from {istat_csv_path}: {str(e)}")
+
+        logger.info(f"IstatCodeResolver built with {len(resolver)} aliases")
+        return resolver
@@ -17,7 +17,7 @@ class Agent(db.Model):
 class Assignment(db.Model):
     """Model for agent-municipality assignments"""
     id = db.Column(db.Integer, primary_key=True)
-    agent_id = db.Column(db.Integer, db.ForeignKey('agent.id'), nullable=False)
+    agent_id = db.Column(db.Integer, db.ForeignKey('agent.id'), nullable=False, index=True)
     comune_id = db.Column(db.String(20), nullable=False, index=True)
     assignment_date = db.Column(db.DateTime, default=datetime.now)
     
@@ -26,3 +26,31 @@ class Assignment(db.Model):
     
     def __repr__(self):
         return f'<Assignment {self.agent_id}:{self.comune_id}>'
+
+class ComuneSet(db.Model):
+    """Model for registered sets of municipalities, addressed by the digest of their codes"""
+    digest = db.Column(db.String(40), primary_key=True)
+    comune_ids = db.Column(db.Text, nullable=False)  # Codici ISTAT canonici, ordinati e separati da virgola
+    creation_date = db.Column(db.DateTime, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<ComuneSet {self.digest}>'
+
+class AssignmentRevision(db.Model):
+    """Single-row counter incremented by every transaction that changes agents or assignments"""
+    id = db.Column(db.Integer, primary_key=True)
+    revision = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<AssignmentRevision {self.revision}>'
+
+class AssignmentChange(db.Model):
+    """Change log of the assignments, one row per comune or agent touched by a revision"""
+    id = db.Column(db.Integer, primary_key=True)
+    revision = db.Column(db.BigInteger, nullable=False, index=True)
+    kind = db.Column(db.String(10), nullable=False)  # 'assign', 'remove', 'agent' o 'start' (inizio del registro)
+    comune_id = db.Column(db.String(20), nullable=True)
+    agent_id = db.Column(db.Integer, nullable=True)
+    
+    def __repr__(self):
+        return f'<AssignmentChange {self.revision} {self.kind} {self.comune_id or self.agent_id}>'
@@ -17,6 +17,12 @@ import geopandas as gpd
 import pandas as pd
 from pathlib import Path
 from shapely.geometry import mapping
+from data_utils import load_comuni_data
+from istat_codes import normalize_code
+from geometry_store import (write_binary_store, LOD_LEVELS, DEFAULT_LOD, lod_binary_path, COMUNI_TOPOLOGY_PATH,
+                            COMUNI_ADJACENCY_PATH)
+from topology import build_topology
+from geo_utils import build_adjacency, compute_metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -45,6 +51,24 @@ def simplify_geometry(gdf, tolerance=0.001):
     logger.info(f"Semplificazione geometrie con tolleranza {tolerance}")
     return gdf.copy().geometry.simplify(tolerance)
 
+def save_binary_store(output_path, fragments, metrics=None):
+    """
+    Salva le feature serializzate nel formato binario, sostituendo il file in modo atomico
+    
+    Args:
+        output_path (Path): File di destinazione
+        fragments (dict): Codice ISTAT -> Feature JSON (bytes)
+        metrics (dict): Codice ISTAT -> riquadro, baricentro e superficie (vedi METRIC_FIELDS)
+    """
+    tmp_path = output_path.with_suffix(".bin.tmp")
+    write_binary_store(tmp_path, fragments, metrics)
+    os.replace(tmp_path, output_path)
+    logger.info(f"Archivio binario salvato in {output_path}")
+
+def encode_feature(feature):
+    """Serializza una feature in JSON compatto"""
+    return json.dumps(feature, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
 def process_comuni(simplify_tolerance=0.001):
     """
     Elabora il file GeoJSON dei comuni italiani
@@ -86,6 +110,9 @@ def process_comuni(simplify_tolerance=0.001):
         if cols_to_rename:
             comuni_gdf = comuni_gdf.rename(columns=cols_to_rename)
         
+        # Geometrie originali, da cui vengono semplificati i livelli di dettaglio
+        original_geometry = comuni_gdf.geometry.copy()
+        
         # Semplifica le geometrie per migliorare le performance
         logger.info("Semplificazione delle geometrie...")
         comuni_gdf['geometry'] = simplify_geometry(comuni_gdf, tolerance=simplify_tolerance)
@@ -104,6 +131,14 @@ def process_comuni(simplify_tolerance=0.001):
             name_column = comuni_gdf.columns[1]  # Usa la seconda colonna come fallback
             logger.warning(f"Colonna nome non trovata, uso {name_column} come nome")
         
+        # Nomi ufficiali dei comuni, gli stessi mostrati dall'applicazione:
+        # le feature vengono salvate con le properties definitive
+        comuni_data = load_comuni_data()
+        comuni_names = {
+            normalize_code(codice): nome
+            for codice, nome in zip(comuni_data['codice'], comuni_data['comune'])
+        }
+        
         # Crea un GeoJSON con solo le informazioni necessarie
         comuni_dict = {}
         
@@ -113,6 +148,7 @@ def process_comuni(simplify_tolerance=0.001):
             
             # Estrai il nome e altre informazioni utili
             comune_name = row[name_column] if name_column in row else f"Comune {comune_id}"
+            comune_name = comuni_names.get(comune_id, comune_name)
             
             # Crea un oggetto GeoJSON per questo comune
             comuni_dict[comune_id] = {
@@ -125,11 +161,67 @@ def process_comuni(simplify_tolerance=0.001):
             }
         
         # Salva il dizionario come JSON
+        # Scriviamo su un file temporaneo e lo sostituiamo in modo atomico,
+        # così i worker dell'applicazione non leggono mai un file parziale
         output_dict_path = OUTPUT_DIR / "comuni_dict.json"
-        with open(output_dict_path, 'w') as f:
+        tmp_dict_path = output_dict_path.with_suffix(".json.tmp")
+        with open(tmp_dict_path, 'w') as f:
             json.dump(comuni_dict, f)
+        os.replace(tmp_dict_path, output_dict_path)
         logger.info(f"Dizionario salvato in {output_dict_path}")
         
+        # Salva ogni feature già serializzata, una per riga ("<codice>\t<JSON>"),
+        # così l'applicazione può comporre le risposte senza ricodificare le coordinate
+        fragments = {comune_id: encode_feature(feature) for comune_id, feature in comuni_dict.items()}
+        output_fragments_path = OUTPUT_DIR / "comuni_features.jsonl"
+        tmp_fragments_path = output_fragments_path.with_suffix(".jsonl.tmp")
+        with open(tmp_fragments_path, 'wb') as f:
+            for comune_id, fragment in fragments.items():
+                f.write(comune_id.encode('ascii') + b'\t' + fragment + b'\n')
+        os.replace(tmp_fragments_path, output_fragments_path)
+        logger.info(f"Feature serializzate salvate in {output_fragments_path}")
+        
+        # Riquadro, baricentro e superficie di ogni comune, calcolati una sola volta
+        # sulle geometrie originali e salvati nell'indice dell'archivio binario
+        comune_ids = [str(value).zfill(6) for value in comuni_gdf[id_column]]
+        metrics = compute_metrics(comune_ids, list(original_geometry))
+        
+        # Stesse feature in formato binario con indice degli offset, letto con mmap
+        save_binary_store(lod_binary_path(DEFAULT_LOD), fragments, metrics)
+        
+        # Altri livelli di dettaglio (dalla vista nazionale a quella stradale),
+        # semplificati a partire dalle geometrie originali
+        for level, tolerance, _ in LOD_LEVELS:
+            if level == DEFAULT_LOD:
+                continue
+            logger.info(f"Livello di dettaglio {level}: tolleranza {tolerance}")
+            level_fragments = {}
+            for comune_id, geometry in zip(comune_ids, original_geometry.simplify(tolerance)):
+                level_fragments[comune_id] = encode_feature({
+                    "type": "Feature",
+                    "properties": comuni_dict[comune_id]["properties"],
+                    "geometry": mapping(geometry)
+                })
+            save_binary_store(lod_binary_path(level), level_fragments, metrics)
+        
+        # Topologia TopoJSON: i confini condivisi tra comuni vicini sono salvati una
+        # sola volta; la semplificazione avviene sugli archi, dopo averli condivisi
+        logger.info("Costruzione della topologia...")
+        topology = build_topology([
+            (comune_id, comuni_dict[comune_id]["properties"], mapping(geometry))
+            for comune_id, geometry in zip(comune_ids, original_geometry)
+        ], tolerance=simplify_tolerance)
+        tmp_topology_path = COMUNI_TOPOLOGY_PATH.with_suffix(".json.tmp")
+        with open(tmp_topology_path, 'w') as f:
+            json.dump(topology, f, separators=(',', ':'), ensure_ascii=False)
+        os.replace(tmp_topology_path, COMUNI_TOPOLOGY_PATH)
+        logger.info(f"Topologia salvata in {COMUNI_TOPOLOGY_PATH}")
+        
+        # Grafo di adiacenza dai confini condivisi, calcolato sulle geometrie originali
+        logger.info("Costruzione del grafo di adiacenza...")
+        build_adjacency(comune_ids, list(original_geometry)).save(COMUNI_ADJACENCY_PATH)
+        logger.info(f"Grafo di adiacenza salvato in {COMUNI_ADJACENCY_PATH}")
+        
         # Salva il GeoDataFrame come GeoJSON
         logger.info(f"Salvataggio del file GeoJSON ottimizzato: {output_path}")
         comuni_gdf.to_file(str(output_path), driver="GeoJSON")
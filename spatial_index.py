@@ -0,0 +1,144 @@
+import logging
+import threading
+
+from geometry_store import load_fragments
+
+logger = logging.getLogger(__name__)
+
+def parse_bbox(value):
+    """
+    Parse a bounding box given as "minlon,minlat,maxlon,maxlat" or as a list.
+
+    Returns:
+        tuple: (minlon, minlat, maxlon, maxlat), or None if value is empty
+
+    Raises:
+        ValueError: If the value is not a valid bounding box
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    if len(value) != 4:
+        raise ValueError(f"Invalid bbox: {value}")
+    minlon, minlat, maxlon, maxlat = (float(v) for v in value)
+    if minlon > maxlon or minlat > maxlat:
+        raise ValueError(f"Invalid bbox: {value}")
+    return (minlon, minlat, maxlon, maxlat)
+
+class SpatialIndex:
+    """
+    STRtree over the bounding boxes of the municipalities.
+
+    Only the rectangles are kept in memory: the polygons stay in the
+    geometry store and are decoded by the callers that need them.
+    """
+
+    def __init__(self, fragments):
+        """
+        Args:
+            fragments: Mapping ISTAT code -> Feature JSON (see geometry_store.load_fragments)
+        """
+        import numpy as np
+        import shapely
+
+        self.ids = list(fragments.keys())
+        metrics = [fragments.metrics(comune_id) for comune_id in self.ids] \
+            if getattr(fragments, 'has_metrics', False) else [None]
+        if None not in metrics:
+            # Rettangoli precalcolati dall'ETL nell'indice dell'archivio binario
+            self.bounds = np.array([values[:4] for values in metrics], dtype=float)
+        else:
+            # Lettura vettoriale (GEOS) delle feature, poi teniamo solo i rettangoli
+            geometries = shapely.from_geojson([bytes(fragments.get(comune_id)) for comune_id in self.ids])
+            self.bounds = shapely.bounds(geometries)
+        self.boxes = shapely.box(*self.bounds.T)
+        self.tree = shapely.STRtree(self.boxes)
+        self._ids = np.array(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query_bbox(self, bbox):
+        """
+        Return the codes of the municipalities whose bounding box intersects bbox.
+
+        Args:
+            bbox (tuple): (minlon, minlat, maxlon, maxlat)
+
+        Returns:
+            set: Canonical ISTAT codes
+        """
+        import shapely
+
+        indexes = self.tree.query(shapely.box(*bbox))
+        return set(self._ids[indexes].tolist())
+
+    def locate(self, lons, lats, fragments):
+        """
+        Find the municipality containing each point.
+
+        The STRtree gives the candidates by bounding box for all the points at
+        once; only the candidate polygons are decoded, and the exact test is a
+        single vectorized call.
+
+        Args:
+            lons, lats (sequence): Coordinates of the points, in degrees
+            fragments: Mapping ISTAT code -> Feature JSON with the polygons to test
+
+        Returns:
+            list: Canonical ISTAT code for each point, or None if it is outside every comune
+        """
+        import numpy as np
+        import shapely
+
+        points = shapely.points(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+        point_indexes, box_indexes = self.tree.query(points)
+
+        # Decodifica di ogni poligono candidato una sola volta, anche se condiviso da più punti
+        candidates, inverse = np.unique(box_indexes, return_inverse=True)
+        polygons = shapely.from_geojson([
+            bytes(fragments.get(comune_id, b'null')) for comune_id in self._ids[candidates].tolist()
+        ], on_invalid='ignore')
+        # Un punto sul confine appartiene a uno dei due comuni, non a nessuno
+        inside = shapely.intersects(polygons[inverse], points[point_indexes])
+
+        results = [None] * len(points)
+        for point_index, box_index in zip(point_indexes[inside].tolist(), box_indexes[inside].tolist()):
+            if results[point_index] is None:
+                results[point_index] = self.ids[box_index]
+        return results
+
+class SpatialIndexCache:
+    """
+    Process-level spatial index, built from the default level of detail of the
+    geometry store and built again whenever the store is reloaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._store_version = None
+
+    def load(self):
+        """
+        Return the spatial index of the current geometry data.
+
+        Returns:
+            SpatialIndex: The index, or None if no geometry file exists
+        """
+        fragments, store = load_fragments()
+        if fragments is None:
+            return None
+
+        if store.version != self._store_version:
+            with self._lock:
+                if store.version != self._store_version:
+                    self._index = SpatialIndex(fragments)
+                    self._store_version = store.version
+                    logger.info(f"Built spatial index over {len(self._index)} comuni")
+
+        return self._index
+
+# Istanza condivisa da tutto il processo
+spatial_index = SpatialIndexCache()
@@ -0,0 +1,129 @@
+import io
+import csv
+import json
+import logging
+from geo_utils import iter_feature_collection
+
+logger = logging.getLogger(__name__)
+
+# Le righe vengono accumulate fino a questa dimensione prima di essere inviate:
+# pochi write sul socket, memoria comunque costante
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+CSV_COLUMNS = ['comune_id', 'comune_name', 'province', 'region',
+               'agent_id', 'agent_name', 'agent_phone', 'agent_email', 'agent_color']
+
+# Nomi delle proprietà GeoJSON uguali a quelli delle feature delle mappe
+_FEATURE_PROPERTY_NAMES = {'comune_id': 'id', 'comune_name': 'name'}
+# Inizio della geometria nelle feature serializzate dall'ETL (type, properties, geometry)
+_GEOMETRY_MEMBER = b',"geometry":'
+
+def iter_export_rows(snapshot, comuni_index, agent_id=None):
+    """
+    Yield the assignments of a snapshot joined with the comune and agent details.
+
+    Args:
+        snapshot (AssignmentSnapshot): Assignments to export
+        comuni_index (ComuniIndex): Index of the comune names, provinces and regions
+        agent_id (int): Export only the assignments of this agent
+
+    Yields:
+        dict: One record per assignment, with the CSV_COLUMNS keys (comune_id canonical)
+    """
+    agents = sorted(snapshot.agents.values(), key=lambda agent: (agent.name or '', agent.id))
+    for agent in agents:
+        if agent_id is not None and agent.id != agent_id:
+            continue
+        for comune_id in snapshot.comuni_by_agent.get(agent.id, ()):
+            details = comuni_index.get(comune_id) or {}
+            yield {
+                'comune_id': comuni_index.canonical(comune_id),
+                'comune_name': details.get('name', f"Comune {comune_id}"),
+                'province': details.get('province'),
+                'region': details.get('region'),
+                'agent_id': agent.id,
+                'agent_name': agent.name,
+                'agent_phone': agent.phone,
+                'agent_email': agent.email,
+                'agent_color': agent.color
+            }
+
+def _chunked(pieces):
+    """Group consecutive bytes pieces into chunks of about EXPORT_CHUNK_BYTES"""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+def iter_csv(rows):
+    """
+    Encode the export rows as CSV (UTF-8, header row), row by row.
+
+    Yields:
+        bytes: Chunks of the CSV file
+    """
+    def lines():
+        line = io.StringIO()
+        writer = csv.DictWriter(line, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        yield line.getvalue().encode('utf-8')
+        for row in rows:
+            # Un solo buffer riusato per tutte le righe
+            line.seek(0)
+            line.truncate()
+            writer.writerow(row)
+            yield line.getvalue().encode('utf-8')
+
+    return _chunked(lines())
+
+def _export_feature(row, fragment):
+    """
+    Build the Feature of an export row, reusing the serialized geometry.
+
+    The properties are replaced with the export fields; the geometry bytes
+    are copied from the stored fragment without decoding the coordinates.
+    """
+    properties = json.dumps({_FEATURE_PROPERTY_NAMES.get(key, key): value for key, value in row.items()},
+                            separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    head = b'{"type":"Feature","properties":' + properties
+    if fragment is None:
+        return head + b',"geometry":null}'
+
+    fragment = bytes(fragment)
+    position = fragment.find(_GEOMETRY_MEMBER)
+    if position < 0:
+        # Ordine dei membri diverso da quello dell'ETL
+        geometry = json.loads(fragment).get('geometry')
+        return head + b',"geometry":' + json.dumps(geometry, separators=(',', ':')).encode('utf-8') + b'}'
+    return head + fragment[position:]
+
+def iter_geojson(rows, fragments, members=None):
+    """
+    Encode the export rows as a GeoJSON FeatureCollection, feature by feature.
+
+    Args:
+        rows (iterable): Records from iter_export_rows()
+        fragments (Mapping): ISTAT code -> serialized Feature (geometry store), or None
+        members (dict): Extra top-level members of the collection
+
+    Yields:
+        bytes: Chunks of the FeatureCollection
+    """
+    def features():
+        missing = 0
+        for row in rows:
+            fragment = fragments.get(row['comune_id']) if fragments is not None else None
+            if fragment is None:
+                missing += 1
+            yield _export_feature(row, fragment)
+        if missing:
+            logger.warning(f"Exported {missing} comuni without geometry")
+
+    return _chunked(iter_feature_collection(features(), members))
@@ -0,0 +1,126 @@
+import json
+import hashlib
+import logging
+import threading
+
+from geometry_store import load_fragments
+
+logger = logging.getLogger(__name__)
+
+# Distanza (in gradi) usata per chiudere le fessure tra comuni semplificati separatamente
+SNAP_DISTANCE = 0.0005
+# Tolleranza di semplificazione del contorno, adatta alla vista nazionale/regionale
+OUTLINE_TOLERANCE = 0.002
+
+class TerritoryOutlines:
+    """
+    Dissolved outline of each agent's territory.
+
+    The geometries of the assigned municipalities are merged with
+    unary_union into a single (Multi)Polygon per agent and kept serialized
+    in memory. An outline is computed again only when the set of comuni of
+    that agent changes, or when the geometry store is reloaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # agent_id -> (firma dei comuni, geometria GeoJSON serializzata)
+        self._outlines = {}
+        self._store_version = None
+
+    @staticmethod
+    def signature(comune_ids):
+        """Return the signature of a set of canonical ISTAT codes"""
+        return hashlib.sha1(','.join(sorted(comune_ids)).encode()).hexdigest()
+
+    def _check_store(self):
+        """
+        Return the geometry fragments and their version, dropping the outlines
+        if the store was reloaded.
+        """
+        fragments, store = load_fragments()
+        version = store.version if store is not None else None
+        with self._lock:
+            if version != self._store_version:
+                self._outlines = {}
+                self._store_version = version
+        return fragments, version
+
+    def _dissolve(self, comune_ids, fragments):
+        """Merge the geometries of the given comuni, or return None if none is known"""
+        from shapely.geometry import shape, mapping
+        from shapely.ops import unary_union
+
+        geometries = []
+        for comune_id in comune_ids:
+            fragment = fragments.get(comune_id) if fragments is not None else None
+            if fragment is not None:
+                geometries.append(shape(json.loads(bytes(fragment))['geometry']))
+        if not geometries:
+            return None
+
+        outline = unary_union(geometries)
+        # I comuni sono semplificati uno per uno dall'ETL: l'espansione e la successiva
+        # contrazione eliminano le fessure lungo i confini interni
+        outline = outline.buffer(SNAP_DISTANCE).buffer(-SNAP_DISTANCE)
+        outline = outline.simplify(OUTLINE_TOLERANCE, preserve_topology=True)
+        return json.dumps(mapping(outline), separators=(',', ':')).encode('utf-8')
+
+    def outline(self, agent_id, comune_ids):
+        """
+        Return the outline of an agent's territory.
+
+        Args:
+            agent_id (int): ID of the agent
+            comune_ids (list): Canonical ISTAT codes assigned to the agent
+
+        Returns:
+            bytes: GeoJSON geometry, or None if no geometry is known
+        """
+        fragments, version = self._check_store()
+        signature = self.signature(comune_ids)
+
+        with self._lock:
+            cached = self._outlines.get(agent_id)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        geometry = self._dissolve(comune_ids, fragments)
+        with self._lock:
+            # Se nel frattempo il file è stato ricaricato, il contorno appena calcolato
+            # viene dalle geometrie precedenti e non va conservato
+            if version == self._store_version:
+                self._outlines[agent_id] = (signature, geometry)
+
+        logger.info(f"Dissolved territory of agent {agent_id}: {len(comune_ids)} comuni, "
+                    f"{len(geometry) if geometry else 0} bytes")
+        return geometry
+
+    def feature_collection(self, territories):
+        """
+        Build the FeatureCollection with one outline per agent.
+
+        Args:
+            territories (dict): agent_id -> (properties, list of canonical ISTAT codes)
+
+        Returns:
+            bytes: The FeatureCollection, assembled from the cached geometries
+        """
+        features = []
+        for agent_id, (properties, comune_ids) in territories.items():
+            geometry = self.outline(agent_id, comune_ids)
+            if geometry is None:
+                continue
+            head = json.dumps({'type': 'Feature', 'properties': properties},
+                              separators=(',', ':'), ensure_ascii=False)[:-1]
+            features.append(head.encode('utf-8') + b',"geometry":' + geometry + b'}')
+
+        # Rimuoviamo i contorni degli agenti che non hanno più comuni assegnati
+        with self._lock:
+            for agent_id in set(self._outlines) - set(territories):
+                del self._outlines[agent_id]
+
+        return b'{"type":"FeatureCollection","features":[' + b','.join(features) + b']}'
+
+# Istanza condivisa da tutto il processo
+territory_outlines = TerritoryOutlines()
@@ -0,0 +1,263 @@
+import heapq
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Criteri di bilanciamento dei territori
+BALANCE_MODES = ('count', 'area')
+# Numero massimo di passate di ribilanciamento lungo i confini
+REBALANCE_PASSES = 30
+
+INFINITY = float('inf')
+
+def _bfs_distances(graph, sources, nodes, distances, heap=None):
+    """
+    Update the hop distances from the nearest source, visiting only the nodes
+    that get closer, so that adding a seed costs only the area it takes over.
+    Updated distances are also pushed on heap, if given.
+    """
+    queue = deque()
+    for source in sources:
+        distances[source] = 0
+        queue.append(source)
+    while queue:
+        position = queue.popleft()
+        distance = distances[position] + 1
+        for n in graph._neighbour_positions(position):
+            if n in nodes and distance < distances.get(n, INFINITY):
+                distances[n] = distance
+                queue.append(n)
+                if heap is not None:
+                    heapq.heappush(heap, (-distance, n))
+
+def _choose_seeds(graph, nodes, seeds, count):
+    """
+    Complete the seeds up to count with the farthest-point heuristic: each new
+    seed is the comune farthest (in hops) from the seeds chosen so far, so the
+    territories start spread over the whole area and every disconnected part
+    gets a seed as long as there are enough agents.
+    """
+    ordered = sorted(nodes)
+    if not ordered:
+        return list(seeds)
+
+    distances = {}
+    if not seeds:
+        # Nessun seme: partiamo dal comune più periferico rispetto a uno qualsiasi
+        _bfs_distances(graph, [ordered[0]], nodes, distances)
+        seeds = [max(ordered, key=lambda p: distances.get(p, INFINITY))]
+        distances = {}
+    _bfs_distances(graph, seeds, nodes, distances)
+
+    # Max-heap delle distanze; le voci superate da una distanza minore vengono scartate all'estrazione
+    heap = [(-distances.get(p, INFINITY), p) for p in ordered]
+    heapq.heapify(heap)
+
+    seeds = list(seeds)
+    while len(seeds) < count and len(seeds) < len(ordered):
+        while -heap[0][0] != distances.get(heap[0][1], INFINITY):
+            heapq.heappop(heap)
+        farthest = heap[0][1]
+        seeds.append(farthest)
+        _bfs_distances(graph, [farthest], nodes, distances, heap)
+    return seeds
+
+def _stays_connected(graph, territory, removed):
+    """Check that a territory is still connected after removing one comune"""
+    if len(territory) <= 1:
+        return False
+    ring = [n for n in graph._neighbour_positions(removed) if n in territory]
+    if len(ring) == 1:
+        return True
+
+    # Controllo locale: se i vicini nel territorio sono collegati tra loro senza
+    # passare dal comune rimosso, il territorio resta connesso
+    ring_set = set(ring)
+    visited = {ring[0]}
+    stack = [ring[0]]
+    while stack:
+        for n in graph._neighbour_positions(stack.pop()):
+            if n in ring_set and n not in visited:
+                visited.add(n)
+                stack.append(n)
+    if len(visited) == len(ring):
+        return True
+
+    # Altrimenti visita completa del territorio
+    visited = {ring[0], removed}
+    stack = [ring[0]]
+    while stack:
+        for n in graph._neighbour_positions(stack.pop()):
+            if n in territory and n not in visited:
+                visited.add(n)
+                stack.append(n)
+    return len(visited) == len(territory)
+
+def _rebalance(graph, owner, members, totals, weight_of, passes=REBALANCE_PASSES):
+    """
+    Move comuni across the borders, from the heavier territory to the lighter
+    neighbour, as long as the move reduces the difference and the donor stays
+    connected, until a pass makes no move.
+    """
+    for _ in range(passes):
+        moves = 0
+        for position in list(owner):
+            donor = owner[position]
+            weight = weight_of(position)
+            best = None
+            for n in graph._neighbour_positions(position):
+                receiver = owner.get(n)
+                if receiver is None or receiver == donor:
+                    continue
+                if totals[donor] - totals[receiver] > weight and \
+                        (best is None or totals[receiver] < totals[best]):
+                    best = receiver
+            if best is None or not _stays_connected(graph, members[donor], position):
+                continue
+            members[donor].discard(position)
+            members[best].add(position)
+            owner[position] = best
+            totals[donor] -= weight
+            totals[best] += weight
+            moves += 1
+        if not moves:
+            break
+
+def partition_territories(graph, comune_ids, agents, seeds=None, balance='count'):
+    """
+    Split a set of municipalities into contiguous, balanced territories.
+
+    Every agent starts from a seed comune (given or chosen automatically) and
+    the territories grow over the adjacency graph one comune at a time: the
+    agent with the smallest total weight takes the unassigned neighbour
+    closest to its seed. A final pass moves border comuni from heavier to
+    lighter neighbouring territories, keeping every territory connected.
+    Parts of the selection that no territory can reach and comuni without
+    geometry go to the lightest agent.
+
+    Args:
+        graph (AdjacencyGraph): Adjacency graph of the comuni
+        comune_ids (iterable): Canonical ISTAT codes to assign
+        agents (list): Agent keys (e.g. agent IDs), one territory each
+        seeds (dict): Optional agent key -> canonical ISTAT code of its starting comune
+        balance (str): 'count' to balance the number of comuni, 'area' for the surface
+
+    Returns:
+        tuple: (dict agent key -> list of canonical codes, dict agent key -> total weight)
+
+    Raises:
+        ValueError: If the arguments are inconsistent
+    """
+    if balance not in BALANCE_MODES:
+        raise ValueError(f"Unknown balance mode {balance!r} (expected one of {BALANCE_MODES})")
+    if not agents:
+        raise ValueError("At least one agent is required")
+    if balance == 'area' and graph.area_km2 is None:
+        raise ValueError("Areas not available: run process_geojson.py to rebuild the adjacency graph")
+
+    seeds = seeds or {}
+    comune_ids = list(dict.fromkeys(comune_ids))
+    nodes = {graph.positions[c] for c in comune_ids if c in graph.positions}
+    without_geometry = [c for c in comune_ids if c not in graph.positions]
+
+    # Semi indicati esplicitamente
+    seed_positions = {}
+    for agent in agents:
+        comune_id = seeds.get(agent)
+        if comune_id is None:
+            continue
+        position = graph.positions.get(comune_id)
+        if position is None or position not in nodes:
+            raise ValueError(f"Seed {comune_id} of agent {agent} is not in the selected comuni")
+        if position in seed_positions.values():
+            raise ValueError(f"Seed {comune_id} is used by more than one agent")
+        seed_positions[agent] = position
+
+    # Semi mancanti scelti il più lontano possibile da quelli già presenti
+    chosen = _choose_seeds(graph, nodes, list(seed_positions.values()), len(agents))
+    free_seeds = iter(chosen[len(seed_positions):])
+    for agent in agents:
+        if agent not in seed_positions:
+            seed_positions[agent] = next(free_seeds, None)
+
+    if balance == 'area':
+        weight_of = graph.area_km2.__getitem__
+    else:
+        weight_of = lambda position: 1
+
+    owner = {}
+    members = {agent: set() for agent in agents}
+    totals = {agent: 0 for agent in agents}
+    frontiers = {agent: [] for agent in agents}
+    order = {agent: i for i, agent in enumerate(agents)}
+
+    def assign(agent, position, depth):
+        owner[position] = agent
+        members[agent].add(position)
+        totals[agent] += weight_of(position)
+        for n in graph._neighbour_positions(position):
+            if n in nodes and n not in owner:
+                heapq.heappush(frontiers[agent], (depth + 1, n))
+
+    # Crescita: a ogni passo l'agente più leggero prende il vicino libero più vicino al suo seme
+    heap = []
+    for agent in agents:
+        position = seed_positions[agent]
+        if position is not None:
+            assign(agent, position, 0)
+        heap.append((totals[agent], order[agent], agent))
+    heapq.heapify(heap)
+
+    while heap:
+        _, _, agent = heapq.heappop(heap)
+        frontier = frontiers[agent]
+        while frontier and frontier[0][1] in owner:
+            heapq.heappop(frontier)
+        if not frontier:
+            # Territorio chiuso dagli altri: smette di crescere
+            continue
+        depth, position = heapq.heappop(frontier)
+        assign(agent, position, depth)
+        heapq.heappush(heap, (totals[agent], order[agent], agent))
+
+    # Parti non raggiunte (es. isole senza seme): ciascuna va all'agente confinante
+    # più leggero, o al più leggero in assoluto
+    for start in sorted(nodes):
+        if start in owner:
+            continue
+        component = [start]
+        visited = {start}
+        neighbours = set()
+        queue = deque([start])
+        while queue:
+            for n in graph._neighbour_positions(queue.popleft()):
+                if n not in nodes or n in visited:
+                    continue
+                if n in owner:
+                    neighbours.add(owner[n])
+                    continue
+                visited.add(n)
+                component.append(n)
+                queue.append(n)
+        candidates = neighbours or agents
+        agent = min(candidates, key=lambda a: (totals[a], order[a]))
+        for position in component:
+            owner[position] = agent
+            members[agent].add(position)
+            totals[agent] += weight_of(position)
+
+    _rebalance(graph, owner, members, totals, weight_of)
+
+    territories = {agent: [graph.ids[p] for p in sorted(members[agent])] for agent in agents}
+
+    # Comuni senza geometria: non hanno vicini, vanno all'agente con meno comuni
+    for comune_id in without_geometry:
+        agent = min(agents, key=lambda a: (len(territories[a]), order[a]))
+        territories[agent].append(comune_id)
+        if balance == 'count':
+            totals[agent] += 1
+
+    if without_geometry:
+        logger.warning(f"{len(without_geometry)} comuni without geometry assigned without contiguity")
+    return territories, totals
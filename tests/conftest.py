@@ -0,0 +1,28 @@
+import os
+import pytest
+
+# Database SQLite in memoria: va impostato prima che un test importi app,
+# perché i test svuotano e ripopolano le tabelle
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+@pytest.fixture
+def flask_app():
+    """The application, inside an application context"""
+    from app import app
+    with app.app_context():
+        yield app
+
+@pytest.fixture
+def client(flask_app):
+    return flask_app.test_client()
+
+@pytest.fixture
+def empty_db(flask_app):
+    """The database session, with no agents and no assignments"""
+    from database import db
+    from models import Agent, Assignment
+    db.session.query(Assignment).delete()
+    db.session.query(Agent).delete()
+    db.session.commit()
+    yield db.session
+    db.session.rollback()
@@ -0,0 +1,101 @@
+"""
+Change log: changes_since() and the deltas of /api/assignments/changes,
+including the clients that must reset or are ahead of the snapshot.
+"""
+
+import pytest
+
+import app as app_module
+from app import comuni_index
+from assignment_snapshot import assignment_snapshot, changes_since, current_revision
+from models import Agent, Assignment, AssignmentChange
+
+@pytest.fixture(scope='module')
+def codes():
+    """Canonical codes of three comuni"""
+    return comuni_index.codes()[:3]
+
+def _stored(code):
+    """Code in the format stored in the assignments"""
+    return comuni_index.get(code)['id']
+
+def _agent_with(session, codes):
+    agent = Agent(name="Agente", color='#123456')
+    session.add(agent)
+    session.flush()
+    session.add_all(Assignment(agent_id=agent.id, comune_id=_stored(code)) for code in codes)
+    session.commit()
+    return agent
+
+def test_changes_since_lists_comuni_and_agents(empty_db, codes):
+    since = current_revision(empty_db)
+    agent = _agent_with(empty_db, codes[:2])
+    until = current_revision(empty_db)
+
+    comune_ids, agent_ids = changes_since(empty_db, since, until)
+    assert comune_ids == {_stored(code) for code in codes[:2]}
+    assert agent_ids == {agent.id}
+
+def test_changes_since_empty_range(empty_db):
+    revision = current_revision(empty_db)
+    assert changes_since(empty_db, revision, revision) == (set(), set())
+    assert changes_since(empty_db, revision + 5, revision) == (set(), set())
+
+def test_changes_since_pruned_log(empty_db, codes):
+    since = current_revision(empty_db)
+    _agent_with(empty_db, codes[:1])
+    until = current_revision(empty_db)
+    # Il registro è stato potato: ora parte dalla revisione corrente
+    empty_db.execute(AssignmentChange.__table__.insert().values(revision=until, kind='start'))
+    empty_db.commit()
+
+    assert changes_since(empty_db, since, until) is None
+
+def test_delta_reports_assigned_and_removed(empty_db, codes):
+    first, second, third = codes
+    agent = _agent_with(empty_db, [first, second])
+    since = assignment_snapshot.load(empty_db).revision
+
+    empty_db.query(Assignment).filter_by(comune_id=_stored(first)).delete()
+    empty_db.add(Assignment(agent_id=agent.id, comune_id=_stored(third)))
+    empty_db.commit()
+
+    snapshot = assignment_snapshot.load(empty_db)
+    members = app_module._assignment_delta(snapshot, since)
+    assert members['since'] == since
+    assert members['revision'] == snapshot.revision > since
+    assert members['reset'] is False
+    assert members['assignments'] == {third: agent.id}
+    assert members['removed'] == [first]
+    assert members['agents'][agent.id]['count'] == 2
+
+def test_delta_for_client_ahead_of_the_snapshot(empty_db, codes):
+    # Snapshot di questo worker precedente a una scrittura già committata
+    stale = assignment_snapshot.load(empty_db)
+    _agent_with(empty_db, codes[:1])
+    revision = current_revision(empty_db)
+    assert revision > stale.revision
+
+    members = app_module._assignment_delta(stale, revision)
+    assert members['revision'] == revision
+    assert members['reset'] is False
+    assert members['assignments'] == {} and members['removed'] == []
+
+    # Revisione mai esistita (es. database ricreato): la mappa va ricaricata
+    assert app_module._assignment_delta(stale, revision + 10) is None
+
+def test_delta_up_to_date(empty_db, codes):
+    _agent_with(empty_db, codes[:1])
+    snapshot = assignment_snapshot.load(empty_db)
+
+    members = app_module._assignment_delta(snapshot, snapshot.revision)
+    assert members['revision'] == snapshot.revision
+    assert members['assignments'] == {} and members['agents'] == {}
+
+def test_changes_endpoint_reset(client, empty_db):
+    revision = current_revision(empty_db)
+    response = client.get(f'/api/assignments/changes?since={revision + 10}')
+    assert response.status_code == 200
+    assert response.get_json()['reset'] is True
+
+    assert client.get('/api/assignments/changes').status_code == 400
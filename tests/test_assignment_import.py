@@ -0,0 +1,89 @@
+"""
+Parser and single-pass validation of the bulk assignment import.
+"""
+
+import io
+import json
+import pytest
+
+from app import comuni_index
+from models import Agent, Assignment
+from assignment_import import iter_rows, import_assignments, detect_format
+
+@pytest.fixture(scope='module')
+def codes():
+    """Three canonical codes with a leading zero, so that they also have a 5-digit form"""
+    return [code for code in comuni_index.codes() if code.startswith('0')][:3]
+
+def _rows(text, input_format='csv'):
+    return list(iter_rows(io.BytesIO(text.encode('utf-8')), input_format))
+
+def test_csv_with_comma_semicolon_and_bom():
+    expected = [(2, 'Mario Rossi', '097001', {}), (3, 'Luigi', 'E507', {'color': '#ff0000'})]
+    comma = "agente,comune,colore\nMario Rossi,097001,\nLuigi,E507,#ff0000\n"
+    semicolon = "\ufeffAgente;Codice;Colore\nMario Rossi;097001;\nLuigi;E507;#ff0000\n"
+    assert _rows(comma) == expected
+    assert _rows(semicolon) == expected
+
+def test_csv_skips_blank_lines_and_requires_columns():
+    assert _rows("agent,comune\n\nA,1\n") == [(3, 'A', '1', {})]
+    with pytest.raises(ValueError):
+        _rows("nome,codice_postale\nA,1\n")
+
+def test_json_array_and_json_lines():
+    records = [{"agent": "A", "comune": "001001"}, {"agent": "B", "comuni": ["002002", "003003"]}]
+    expected = [(1, 'A', '001001', {}), (2, 'B', '002002', {}), (2, 'B', '003003', {})]
+    assert _rows(json.dumps(records), 'json') == expected
+    assert _rows('\n'.join(json.dumps(record) for record in records) + '\n', 'json') == expected
+
+def test_json_errors():
+    with pytest.raises(ValueError):
+        _rows('[{"agent": "A", "comune": "1"', 'json')
+    with pytest.raises(ValueError):
+        _rows('[1, 2]', 'json')
+
+def test_detect_format():
+    assert detect_format('export.ndjson') == 'json'
+    assert detect_format('export.csv', 'application/json') == 'csv'
+    assert detect_format(None, 'application/x-ndjson') == 'json'
+    assert detect_format() == 'csv'
+
+def _import(session, text, **options):
+    return import_assignments(session, iter_rows(io.BytesIO(text.encode('utf-8')), 'csv'), comuni_index, **options)
+
+def test_import_reports_errors_and_conflicts(empty_db, codes):
+    first, second, _ = codes
+    result = _import(empty_db, f"agente,comune\nA,{first}\nB,{first}\nB,{second}\n,{second}\nB,999999\n")
+
+    assert result['assigned'] == 2
+    assert result['created_agents'] == ['A', 'B']
+    assert [conflict['line'] for conflict in result['conflicts']] == [3]
+    assert [error['line'] for error in result['errors']] == [5, 6]
+    assert empty_db.query(Assignment).count() == 2
+
+def test_dry_run_writes_nothing(empty_db, codes):
+    result = _import(empty_db, f"agente,comune\nA,{codes[0]}\n", dry_run=True)
+
+    assert result['assigned'] == 1
+    assert empty_db.query(Agent).count() == 0
+    assert empty_db.query(Assignment).count() == 0
+
+def test_rows_saved_in_another_code_format_are_conflicts(empty_db, codes):
+    canonical = codes[0]
+    stored = comuni_index.get(canonical)['id']
+    legacy = canonical.lstrip('0') if stored == canonical else canonical
+    owner = Agent(name="Mario", color='#ff9800')
+    empty_db.add(owner)
+    empty_db.flush()
+    empty_db.add(Assignment(agent_id=owner.id, comune_id=legacy))
+    empty_db.commit()
+
+    result = _import(empty_db, f"agente,comune\nLuigi,{canonical}\n")
+    assert [conflict['assigned_to'] for conflict in result['conflicts']] == ['Mario']
+    assert empty_db.query(Assignment).count() == 1
+
+    # Con replace tutte le forme salvate del codice vengono sostituite
+    result = _import(empty_db, f"agente,comune\nLuigi,{canonical}\n", replace=True)
+    assert result['reassigned'] == 1
+    rows = empty_db.query(Assignment.comune_id, Agent.name).join(Agent).all()
+    assert rows == [(stored, 'Luigi')]
@@ -0,0 +1,67 @@
+"""
+ChangeStream buffer: which events a client gets for the revision it already has.
+"""
+
+import pytest
+
+from change_stream import ChangeStream, MAX_BUFFERED_EVENTS
+
+@pytest.fixture
+def stream():
+    return ChangeStream()
+
+def _publish(stream, revision, lost=False):
+    """Notify a new revision; with lost the changes are not available and the event is a resync"""
+    stream.configure(lambda since: (revision, None if lost else {'since': since, 'revision': revision}))
+    stream.publish(revision)
+
+def _revisions(events):
+    return [int(event.split(b'\n', 1)[0][len(b'id: '):]) for event in events]
+
+def test_nothing_pending_before_the_first_notification(stream):
+    assert stream.revision is None
+    assert stream._pending(0) == []
+
+    # La prima notifica fissa solo la revisione di partenza
+    _publish(stream, 3)
+    assert stream.revision == 3
+    assert stream._pending(3) == []
+
+def test_pending_events_after_since(stream):
+    for revision in (1, 2, 3, 4):
+        _publish(stream, revision)
+
+    assert _revisions(stream._pending(1)) == [2, 3, 4]
+    assert _revisions(stream._pending(3)) == [4]
+    assert stream._pending(4) == []
+    # Client più avanti del worker: aspetta l'evento successivo
+    assert stream._pending(9) == []
+    # Revisione precedente al buffer
+    assert stream._pending(0) is None
+
+def test_event_covering_several_revisions(stream):
+    _publish(stream, 1)
+    _publish(stream, 2)
+    # Il bus ha notificato direttamente la 5: un solo evento copre 3 e 4
+    _publish(stream, 5)
+
+    assert _revisions(stream._pending(3)) == [5]
+    assert _revisions(stream._pending(4)) == [5]
+    assert _revisions(stream._pending(2)) == [5]
+    assert _revisions(stream._pending(1)) == [2, 5]
+
+def test_unavailable_changes_become_resync(stream):
+    _publish(stream, 1)
+    _publish(stream, 2, lost=True)
+
+    (event,) = stream._pending(1)
+    assert b'event: resync' in event
+
+def test_buffer_overflow(stream):
+    _publish(stream, 1)
+    for revision in range(2, MAX_BUFFERED_EVENTS + 3):
+        _publish(stream, revision)
+
+    assert stream._pending(1) is None
+    oldest = stream.revision - MAX_BUFFERED_EVENTS
+    assert len(stream._pending(oldest)) == MAX_BUFFERED_EVENTS
@@ -0,0 +1,49 @@
+"""
+/api/partition must reject unknown comuni before writing anything.
+"""
+
+import app as app_module
+from models import Agent, Assignment
+
+def _agents(session, count):
+    agents = [Agent(name=f"Agente {i}", color='#ff9800') for i in range(count)]
+    session.add_all(agents)
+    session.commit()
+    return [agent.id for agent in agents]
+
+def test_unknown_comuni_are_rejected_and_nothing_is_saved(client, empty_db, monkeypatch):
+    # La validazione avviene prima di usare il grafo: basta che risulti disponibile
+    monkeypatch.setattr(app_module, 'load_adjacency', lambda: object())
+    agent_ids = _agents(empty_db, 2)
+    known = app_module.comuni_index.codes()[0]
+
+    response = client.post('/api/partition', json={
+        'agent_ids': agent_ids,
+        'comune_ids': ['999999', 'abc', known]
+    })
+
+    assert response.status_code == 400
+    assert response.get_json()['unknown'] == ['999999', 'abc']
+    assert empty_db.query(Assignment).count() == 0
+
+def test_unknown_seed_is_rejected(client, empty_db, monkeypatch):
+    monkeypatch.setattr(app_module, 'load_adjacency', lambda: object())
+    agent_ids = _agents(empty_db, 1)
+
+    response = client.post('/api/partition', json={
+        'agent_ids': agent_ids,
+        'all': True,
+        'seeds': {str(agent_ids[0]): '999999'}
+    })
+
+    assert response.status_code == 400
+    assert empty_db.query(Assignment).count() == 0
+
+def test_replace_assignments_skips_unknown_codes(flask_app, empty_db):
+    agent_id, = _agents(empty_db, 1)
+    known = app_module.comuni_index.codes()[0]
+
+    app_module.replace_assignments({agent_id: [known, '999999']})
+
+    stored = [comune_id for (comune_id,) in empty_db.query(Assignment.comune_id)]
+    assert stored == [app_module.comuni_index.get(known)['id']]
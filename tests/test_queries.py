@@ -0,0 +1,82 @@
+"""
+Regression test: the number of SQL statements of the pages that list every
+agent must not grow with the number of agents (no query per agent).
+"""
+
+import pytest
+from sqlalchemy import event
+
+from app import app, comuni_index
+from database import db
+from models import Agent, Assignment
+
+# Comuni assegnati a ciascun agente
+COMUNI_PER_AGENT = 10
+
+@pytest.fixture(scope='module')
+def codes():
+    """Codes of 2,000 comuni, in the format stored in the assignments"""
+    return [comuni_index.get(code)['id'] for code in comuni_index.codes()[:2000]]
+
+@pytest.fixture
+def statements():
+    """List of the SQL statements executed while the fixture is active"""
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', record)
+        yield executed
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+def _populate(agents, codes):
+    """Replace all the agents and assignments with the given number of agents"""
+    db.session.query(Assignment).delete()
+    db.session.query(Agent).delete()
+    for i in range(agents):
+        agent = Agent(name=f"Agente {i:03d}", color='#ff9800')
+        db.session.add(agent)
+        db.session.flush()
+        for comune_id in codes[i::agents][:COMUNI_PER_AGENT]:
+            db.session.add(Assignment(agent_id=agent.id, comune_id=comune_id))
+    db.session.commit()
+
+def _reassign_first_comune():
+    """Move one assignment from the first agent to the second, through the ORM"""
+    first, second = Agent.query.order_by(Agent.id).limit(2).all()
+    assignment = Assignment.query.filter_by(agent_id=first.id).first()
+    assignment.agent_id = second.id
+    db.session.commit()
+
+@pytest.mark.parametrize('url', ['/agents', '/mappa_completa'])
+def test_query_count_does_not_depend_on_agents(url, codes, statements):
+    client = app.test_client()
+    # Caricamenti unici del processo (indici, tabella delle revisioni) fuori dal conteggio
+    _populate(1, codes)
+    assert client.get(url).status_code == 200
+    
+    counts = {}
+    for agents in (5, 200):
+        _populate(agents, codes)
+        request_counts = {}
+        # Prima richiesta dopo il popolamento: ricarica la snapshot e registra gli insiemi di comuni
+        statements.clear()
+        assert client.get(url).status_code == 200
+        request_counts['cold'] = len(statements)
+        
+        statements.clear()
+        assert client.get(url).status_code == 200
+        request_counts['warm'] = len(statements)
+        
+        # Dopo una scrittura: aggiornamento incrementale della snapshot e un insieme nuovo
+        _reassign_first_comune()
+        statements.clear()
+        assert client.get(url).status_code == 200
+        request_counts['after write'] = len(statements)
+        counts[agents] = request_counts
+    
+    for kind in ('cold', 'warm', 'after write'):
+        assert counts[5][kind] == counts[200][kind], \
+            f"{url} ({kind}): {counts[5][kind]} statements with 5 agents, {counts[200][kind]} with 200"
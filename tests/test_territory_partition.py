@@ -0,0 +1,99 @@
+"""
+Automatic partitioning: every territory is contiguous and the totals are balanced.
+"""
+
+from collections import deque
+
+import numpy as np
+import pytest
+
+from geo_utils import AdjacencyGraph
+from territory_partition import partition_territories
+
+def _grid_graph(width, height, islands=0, area_km2=None):
+    """Comuni on a width x height grid bordering their 4 neighbours, plus isolated islands"""
+    ids = [f"{i:06d}" for i in range(width * height + islands)]
+    neighbours = [[] for _ in ids]
+    for row in range(height):
+        for column in range(width):
+            position = row * width + column
+            if column + 1 < width:
+                neighbours[position].append(position + 1)
+                neighbours[position + 1].append(position)
+            if row + 1 < height:
+                neighbours[position].append(position + width)
+                neighbours[position + width].append(position)
+
+    indptr = np.cumsum([0] + [len(n) for n in neighbours])
+    indices = np.array([n for node in neighbours for n in sorted(node)], dtype=np.int64)
+    area = np.array(area_km2, dtype=np.float64) if area_km2 is not None else None
+    return AdjacencyGraph(np.array(ids), indptr, indices, np.zeros(len(ids), dtype=bool), area)
+
+def _is_contiguous(graph, comune_ids):
+    positions = {graph.positions[comune_id] for comune_id in comune_ids}
+    start = next(iter(positions))
+    visited = {start}
+    queue = deque([start])
+    while queue:
+        for n in graph._neighbour_positions(queue.popleft()):
+            if n in positions and n not in visited:
+                visited.add(n)
+                queue.append(n)
+    return visited == positions
+
+@pytest.mark.parametrize('agents', [2, 3, 4, 6])
+def test_territories_are_contiguous_and_balanced(agents):
+    graph = _grid_graph(8, 6)
+    territories, totals = partition_territories(graph, graph.ids, list(range(agents)))
+
+    assigned = [comune_id for comune_ids in territories.values() for comune_id in comune_ids]
+    assert sorted(assigned) == sorted(graph.ids)
+    for agent, comune_ids in territories.items():
+        assert comune_ids, f"agent {agent} got no comuni"
+        assert _is_contiguous(graph, comune_ids), f"territory of agent {agent} is not contiguous"
+        assert totals[agent] == len(comune_ids)
+    assert max(totals.values()) - min(totals.values()) <= 2
+
+def test_seeds_are_kept():
+    graph = _grid_graph(8, 6)
+    seeds = {'a': '000000', 'b': '000047'}
+    territories, _ = partition_territories(graph, graph.ids, ['a', 'b'], seeds=seeds)
+
+    assert '000000' in territories['a']
+    assert '000047' in territories['b']
+
+def test_area_balance():
+    # La colonna di sinistra pesa quanto tutto il resto della griglia
+    width, height = 4, 4
+    area_km2 = [(width - 1) * 1.0 if i % width == 0 else 1.0 for i in range(width * height)]
+    graph = _grid_graph(width, height, area_km2=area_km2)
+    territories, totals = partition_territories(graph, graph.ids, [1, 2], balance='area')
+
+    assert sum(totals.values()) == pytest.approx(sum(area_km2))
+    assert abs(totals[1] - totals[2]) <= max(area_km2)
+    for comune_ids in territories.values():
+        assert _is_contiguous(graph, comune_ids)
+    # Bilanciando la superficie i comuni non sono divisi a metà
+    assert len(territories[1]) != len(territories[2])
+
+def test_unreachable_parts_and_comuni_without_geometry_are_assigned():
+    graph = _grid_graph(3, 3, islands=1)
+    selection = graph.ids + ['999999']
+    territories, totals = partition_territories(graph, selection, [1, 2])
+
+    assigned = sorted(comune_id for comune_ids in territories.values() for comune_id in comune_ids)
+    assert assigned == sorted(selection)
+    assert sum(totals.values()) == len(selection)
+
+def test_invalid_arguments():
+    graph = _grid_graph(3, 3)
+    with pytest.raises(ValueError):
+        partition_territories(graph, graph.ids, [])
+    with pytest.raises(ValueError):
+        partition_territories(graph, graph.ids, [1], balance='population')
+    with pytest.raises(ValueError):
+        partition_territories(graph, graph.ids, [1], balance='area')
+    with pytest.raises(ValueError):
+        partition_territories(graph, graph.ids[:4], [1], seeds={1: graph.ids[8]})
+    with pytest.raises(ValueError):
+        partition_territories(graph, graph.ids, [1, 2], seeds={1: graph.ids[0], 2: graph.ids[0]})
@@ -0,0 +1,95 @@
+"""
+TopoJSON topology: shared arcs, quantization round-trip and subsets.
+"""
+
+import pytest
+
+from topology import build_topology, TopologyIndex, OBJECT_NAME
+
+# Due quadrati affiancati con il lato x=1 in comune, e un terzo staccato
+FEATURES = [
+    ('001001', {'name': 'A'}, {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]}),
+    ('001002', {'name': 'B'}, {'type': 'Polygon', 'coordinates': [[[1, 0], [2, 0], [2, 1], [1, 1], [1, 0]]]}),
+    ('001003', {'name': 'C'}, {'type': 'MultiPolygon',
+                               'coordinates': [[[[3, 3], [4, 3], [4, 4], [3, 4], [3, 3]]]]}),
+]
+
+def _decode_arc(topology, index):
+    """Absolute lon/lat positions of an arc, reversed for negative indexes"""
+    (scale_x, scale_y), (translate_x, translate_y) = (topology['transform']['scale'],
+                                                      topology['transform']['translate'])
+    x = y = 0
+    points = []
+    for dx, dy in topology['arcs'][~index if index < 0 else index]:
+        x, y = x + dx, y + dy
+        points.append((x * scale_x + translate_x, y * scale_y + translate_y))
+    return points[::-1] if index < 0 else points
+
+def _decode_ring(topology, ring):
+    points = []
+    for index in ring:
+        arc = _decode_arc(topology, index)
+        # Gli archi consecutivi condividono il punto di giunzione
+        points.extend(arc if not points else arc[1:])
+    return points
+
+def _geometries(topology):
+    return {geometry['id']: geometry for geometry in topology['objects'][OBJECT_NAME]['geometries']}
+
+def _outer_ring(topology, geometry):
+    rings = geometry['arcs'][0] if geometry['type'] == 'MultiPolygon' else geometry['arcs']
+    return _decode_ring(topology, rings[0])
+
+def test_shared_border_is_stored_once():
+    topology = build_topology(FEATURES)
+    geometries = _geometries(topology)
+
+    arcs_a = {~index if index < 0 else index for index in geometries['001001']['arcs'][0]}
+    arcs_b = {~index if index < 0 else index for index in geometries['001002']['arcs'][0]}
+    shared = arcs_a & arcs_b
+    assert len(shared) == 1
+    # Il lato comune è percorso in senso opposto dai due comuni
+    (arc,) = shared
+    assert (arc in geometries['001001']['arcs'][0]) != (arc in geometries['001002']['arcs'][0])
+
+@pytest.mark.parametrize('quantization', [1000, 1_000_000])
+def test_quantization_round_trip(quantization):
+    topology = build_topology(FEATURES, quantization=quantization)
+    geometries = _geometries(topology)
+    scale_x, scale_y = topology['transform']['scale']
+
+    for comune_id, properties, geometry in FEATURES:
+        decoded = _outer_ring(topology, geometries[comune_id])
+        assert decoded[0] == pytest.approx(decoded[-1])
+        original = geometry['coordinates'][0][0] if geometry['type'] == 'MultiPolygon' \
+            else geometry['coordinates'][0]
+        # Stessi vertici, a meno della rotazione dell'anello e di un passo di quantizzazione
+        assert len(decoded) == len(original)
+        for x, y in original:
+            assert any(abs(x - dx) <= scale_x and abs(y - dy) <= scale_y for dx, dy in decoded)
+        assert geometries[comune_id]['properties'] == properties
+
+def test_subset_keeps_only_used_arcs():
+    topology = build_topology(FEATURES)
+    index = TopologyIndex(topology)
+    subset, missing = index.subset(['001002', '999999'])
+
+    assert missing == ['999999']
+    assert [geometry['id'] for geometry in subset['objects'][OBJECT_NAME]['geometries']] == ['001002']
+    assert subset['transform'] == topology['transform']
+    used = {~i if i < 0 else i for i in subset['objects'][OBJECT_NAME]['geometries'][0]['arcs'][0]}
+    assert used == set(range(len(subset['arcs'])))
+    assert len(subset['arcs']) < len(topology['arcs'])
+
+    # La geometria estratta decodifica agli stessi punti di quella completa
+    assert _outer_ring(subset, _geometries(subset)['001002']) == \
+        _outer_ring(topology, _geometries(topology)['001002'])
+
+def test_subset_of_multipolygon():
+    index = TopologyIndex(build_topology(FEATURES))
+    subset, missing = index.subset(['001003'])
+
+    assert missing == []
+    (geometry,) = subset['objects'][OBJECT_NAME]['geometries']
+    assert geometry['type'] == 'MultiPolygon'
+    assert len(_outer_ring(subset, geometry)) == 5
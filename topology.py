@@ -0,0 +1,275 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Griglia di quantizzazione: il riquadro dei dati viene diviso in QUANTIZATION passi per asse
+# (per l'Italia circa 1 metro di risoluzione)
+QUANTIZATION = 1_000_000
+
+# Nome dell'oggetto con i comuni all'interno della topologia
+OBJECT_NAME = 'comuni'
+
+def _pack(x, y):
+    """Codifica un punto quantizzato in un solo intero (meno memoria delle tuple)"""
+    return (x << 32) | y
+
+def _unpack(point):
+    return point >> 32, point & 0xFFFFFFFF
+
+def _simplify_arc(points, tolerance):
+    """
+    Douglas-Peucker simplification of an arc in quantized units.
+
+    The end points are always kept, so arcs shared by two municipalities stay
+    shared and the borders keep matching after simplification. For closed
+    arcs the farthest point from the start is kept as well.
+    """
+    if tolerance <= 0 or len(points) <= 2:
+        return points
+
+    coords = [_unpack(p) for p in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+
+    stack = [(0, len(points) - 1)]
+    if points[0] == points[-1]:
+        # Arco chiuso: lo dividiamo nel punto più lontano dall'inizio
+        x0, y0 = coords[0]
+        far = max(range(1, len(points) - 1), key=lambda i: (coords[i][0] - x0) ** 2 + (coords[i][1] - y0) ** 2)
+        keep[far] = True
+        stack = [(0, far), (far, len(points) - 1)]
+
+    tolerance_sq = tolerance * tolerance
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        (x1, y1), (x2, y2) = coords[start], coords[end]
+        dx, dy = x2 - x1, y2 - y1
+        length_sq = dx * dx + dy * dy
+
+        max_dist, index = -1, None
+        for i in range(start + 1, end):
+            px, py = coords[i]
+            if length_sq == 0:
+                dist = (px - x1) ** 2 + (py - y1) ** 2
+            else:
+                cross = dx * (py - y1) - dy * (px - x1)
+                dist = cross * cross / length_sq
+            if dist > max_dist:
+                max_dist, index = dist, i
+
+        if max_dist > tolerance_sq:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return [p for p, k in zip(points, keep) if k]
+
+def _delta_encode(points):
+    """Encode an arc as the first position followed by the differences"""
+    encoded = []
+    last_x = last_y = 0
+    for point in points:
+        x, y = _unpack(point)
+        encoded.append([x - last_x, y - last_y])
+        last_x, last_y = x, y
+    return encoded
+
+def build_topology(features, tolerance=0.0, quantization=QUANTIZATION):
+    """
+    Build a TopoJSON topology from municipality polygons.
+
+    The rings are quantized, cut at the junctions (the points where the
+    neighbour changes) and deduplicated, so every border shared by two
+    comuni is stored once as an arc, referenced by one of them in reverse.
+    Arcs are simplified after the cut, keeping the topology intact, and
+    stored delta-encoded.
+
+    Args:
+        features (list): (comune_id, properties, GeoJSON geometry) in lon/lat
+        tolerance (float): Simplification tolerance in degrees (0 = none)
+        quantization (int): Number of quantization steps per axis
+
+    Returns:
+        dict: The TopoJSON topology, with the comuni in objects['comuni']
+    """
+    # 1. Riquadro complessivo e trasformazione di quantizzazione
+    min_x = min_y = float('inf')
+    max_x = max_y = float('-inf')
+    for _, _, geometry in features:
+        polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+        for polygon in polygons:
+            for ring in polygon:
+                for x, y in ring:
+                    min_x, max_x = min(min_x, x), max(max_x, x)
+                    min_y, max_y = min(min_y, y), max(max_y, y)
+
+    scale_x = (max_x - min_x) / (quantization - 1) or 1
+    scale_y = (max_y - min_y) / (quantization - 1) or 1
+
+    # 2. Anelli quantizzati (aperti, senza punti consecutivi ripetuti)
+    rings = []
+    geometries = []
+    for comune_id, properties, geometry in features:
+        polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+        polygon_rings = []
+        for polygon in polygons:
+            ring_indexes = []
+            for ring in polygon:
+                quantized = []
+                for x, y in ring:
+                    point = _pack(round((x - min_x) / scale_x), round((y - min_y) / scale_y))
+                    if not quantized or quantized[-1] != point:
+                        quantized.append(point)
+                if len(quantized) > 1 and quantized[0] == quantized[-1]:
+                    quantized.pop()
+                if len(quantized) >= 3:
+                    ring_indexes.append(len(rings))
+                    rings.append(quantized)
+            if ring_indexes:
+                polygon_rings.append(ring_indexes)
+        geometries.append((comune_id, properties, geometry['type'], polygon_rings))
+
+    # 3. Giunzioni: punti che compaiono con coppie di vicini diverse
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        count = len(ring)
+        for i, point in enumerate(ring):
+            previous, following = ring[i - 1], ring[(i + 1) % count]
+            pair = (previous, following) if previous < following else (following, previous)
+            seen = neighbours.get(point)
+            if seen is None:
+                neighbours[point] = pair
+            elif seen != pair:
+                junctions.add(point)
+    del neighbours
+
+    # 4. Taglio degli anelli in archi e deduplicazione
+    arcs = []
+    arcs_by_key = {}
+
+    def arc_index(points):
+        key = tuple(points)
+        index = arcs_by_key.get(key)
+        if index is not None:
+            return index
+        index = arcs_by_key.get(key[::-1])
+        if index is not None:
+            return ~index
+        arcs_by_key[key] = len(arcs)
+        arcs.append(points)
+        return len(arcs) - 1
+
+    ring_arcs = []
+    for ring in rings:
+        cuts = [i for i, point in enumerate(ring) if point in junctions]
+        if not cuts:
+            # Anello senza giunzioni: partiamo dal punto minimo così due anelli
+            # identici (es. un comune enclave e il foro del comune che lo contiene) coincidono
+            start = ring.index(min(ring))
+            rotated = ring[start:] + ring[:start]
+            ring_arcs.append([arc_index(rotated + [rotated[0]])])
+            continue
+
+        rotated = ring[cuts[0]:] + ring[:cuts[0]] + [ring[cuts[0]]]
+        positions = [i - cuts[0] for i in cuts] + [len(ring)]
+        ring_arcs.append([
+            arc_index(rotated[positions[k]:positions[k + 1] + 1])
+            for k in range(len(positions) - 1)
+        ])
+
+    # 5. Semplificazione (in unità quantizzate) e codifica delta degli archi
+    tolerance_units = tolerance / max(scale_x, scale_y) if tolerance else 0
+    encoded_arcs = [_delta_encode(_simplify_arc(points, tolerance_units)) for points in arcs]
+
+    topology_geometries = []
+    for comune_id, properties, geometry_type, polygon_rings in geometries:
+        if not polygon_rings:
+            continue
+        polygons = [[ring_arcs[r] for r in ring_indexes] for ring_indexes in polygon_rings]
+        topology_geometries.append({
+            "type": geometry_type,
+            "id": comune_id,
+            "properties": properties,
+            "arcs": polygons if geometry_type == 'MultiPolygon' else polygons[0]
+        })
+
+    logger.info(f"Topologia con {len(topology_geometries)} comuni, {len(encoded_arcs)} archi "
+                f"da {len(rings)} anelli")
+
+    return {
+        "type": "Topology",
+        "transform": {"scale": [scale_x, scale_y], "translate": [min_x, min_y]},
+        "arcs": encoded_arcs,
+        "objects": {OBJECT_NAME: {"type": "GeometryCollection", "geometries": topology_geometries}}
+    }
+
+class TopologyIndex:
+    """
+    Topology loaded in memory, with its geometries indexed by ISTAT code so
+    that a subset can be extracted without scanning the whole collection.
+    """
+
+    def __init__(self, topology):
+        self.transform = topology['transform']
+        self.arcs = topology['arcs']
+        self.geometries = {
+            geometry['id']: geometry
+            for geometry in topology['objects'][OBJECT_NAME]['geometries']
+        }
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def subset(self, comune_ids):
+        """
+        Return a topology with only the requested municipalities and the arcs they use.
+
+        Args:
+            comune_ids (list): Canonical ISTAT codes
+
+        Returns:
+            tuple: (topology dict, list of codes not found)
+        """
+        remap = {}
+        arcs = []
+        geometries = []
+        missing = []
+
+        def remap_ring(ring):
+            remapped = []
+            for index in ring:
+                original = ~index if index < 0 else index
+                new_index = remap.get(original)
+                if new_index is None:
+                    new_index = remap[original] = len(arcs)
+                    arcs.append(self.arcs[original])
+                remapped.append(~new_index if index < 0 else new_index)
+            return remapped
+
+        for comune_id in comune_ids:
+            geometry = self.geometries.get(comune_id)
+            if geometry is None:
+                missing.append(comune_id)
+                continue
+            if geometry['type'] == 'MultiPolygon':
+                geometry_arcs = [[remap_ring(ring) for ring in polygon] for polygon in geometry['arcs']]
+            else:
+                geometry_arcs = [remap_ring(ring) for ring in geometry['arcs']]
+            geometries.append(dict(geometry, arcs=geometry_arcs))
+
+        topology = {
+            "type": "Topology",
+            "transform": self.transform,
+            "arcs": arcs,
+            "objects": {OBJECT_NAME: {"type": "GeometryCollection", "geometries": geometries}}
+        }
+        return topology, missing
+
+def load_topology(path):
+    """Load a topology file produced by process_geojson.py"""
+    with open(path, 'r') as f:
+        return TopologyIndex(json.load(f))
@@ -0,0 +1,124 @@
+import math
+import logging
+
+from geometry_store import load_fragments
+from spatial_index import spatial_index
+
+logger = logging.getLogger(__name__)
+
+# Risoluzione interna delle tile (standard Mapbox Vector Tile)
+TILE_EXTENT = 4096
+# Margine oltre i bordi della tile, in unità della tile, per evitare artefatti ai bordi
+TILE_BUFFER = 64
+# Tolleranza di semplificazione, in unità della tile (1 unità = 1/16 di pixel a 256 px)
+SIMPLIFY_UNITS = 2
+# Nome del layer all'interno delle tile
+LAYER_NAME = 'comuni'
+
+EARTH_RADIUS = 6378137.0
+ORIGIN_SHIFT = math.pi * EARTH_RADIUS
+
+def tile_bounds(z, x, y):
+    """
+    Return the Web Mercator (EPSG:3857) bounds of a tile.
+
+    Returns:
+        tuple: (minx, miny, maxx, maxy) in meters
+    """
+    size = 2 * ORIGIN_SHIFT / (1 << z)
+    minx = -ORIGIN_SHIFT + x * size
+    maxy = ORIGIN_SHIFT - y * size
+    return (minx, maxy - size, minx + size, maxy)
+
+def _to_web_mercator(coords):
+    """Project an (N, 2) array of lon/lat coordinates to Web Mercator"""
+    import numpy as np
+    lon = np.radians(coords[:, 0])
+    lat = np.radians(np.clip(coords[:, 1], -85.0511, 85.0511))
+    return np.column_stack((lon * EARTH_RADIUS, np.log(np.tan(math.pi / 4 + lat / 2)) * EARTH_RADIUS))
+
+def _to_lon_lat(x, y):
+    """Return the lon/lat coordinates of a Web Mercator point"""
+    lon = math.degrees(x / EARTH_RADIUS)
+    lat = math.degrees(2 * math.atan(math.exp(y / EARTH_RADIUS)) - math.pi / 2)
+    return lon, lat
+
+class TileRenderer:
+    """
+    Render Mapbox Vector Tiles of the assigned municipalities.
+
+    The municipalities of a tile are found with the spatial index on their
+    bounding boxes; only those geometries are decoded from the geometry store
+    (mapped and shared between workers), projected to Web Mercator, clipped
+    to the tile and simplified for its zoom level. The encoded tiles are
+    cached by the caller under the assignment revision (see http_cache).
+    """
+
+    def _tile_ids(self, clip_box, assignments):
+        """Return the assigned municipalities whose bounding box intersects the clip box (Web Mercator)"""
+        index = spatial_index.load()
+        if index is None:
+            logger.warning("Spatial index not available, decoding every assigned comune for the tile")
+            return list(assignments)
+        minlon, minlat = _to_lon_lat(clip_box[0], clip_box[1])
+        maxlon, maxlat = _to_lon_lat(clip_box[2], clip_box[3])
+        return [comune_id for comune_id in index.query_bbox((minlon, minlat, maxlon, maxlat))
+                if comune_id in assignments]
+
+    def render(self, z, x, y, assignments):
+        """
+        Return the encoded tile.
+
+        Args:
+            z, x, y (int): Tile coordinates
+            assignments (dict): Canonical ISTAT code -> feature attributes
+                (agent_id, agent_color, ...)
+
+        Returns:
+            bytes: The tile in Mapbox Vector Tile format
+        """
+        import shapely
+        import mapbox_vector_tile
+
+        minx, miny, maxx, maxy = tile_bounds(z, x, y)
+        unit = (maxx - minx) / TILE_EXTENT
+        buffer = TILE_BUFFER * unit
+        clip_box = (minx - buffer, miny - buffer, maxx + buffer, maxy + buffer)
+
+        fragments, _ = load_fragments()
+        comune_ids = []
+        encoded = []
+        if fragments is not None:
+            for comune_id in sorted(self._tile_ids(clip_box, assignments)):
+                fragment = fragments.get(comune_id)
+                if fragment is not None:
+                    comune_ids.append(comune_id)
+                    encoded.append(bytes(fragment))
+
+        features = []
+        if encoded:
+            # Lettura, proiezione, ritaglio e semplificazione vettoriali (GEOS) dei soli comuni della tile
+            geometries = shapely.transform(shapely.from_geojson(encoded), _to_web_mercator)
+            clipped = shapely.clip_by_rect(geometries, *clip_box)
+            simplified = shapely.simplify(clipped, SIMPLIFY_UNITS * unit, preserve_topology=True)
+            for comune_id, geometry in zip(comune_ids, simplified):
+                if geometry.is_empty:
+                    continue
+                features.append({
+                    'geometry': geometry,
+                    'properties': dict(assignments[comune_id], id=comune_id)
+                })
+
+        tile = mapbox_vector_tile.encode(
+            [{'name': LAYER_NAME, 'features': features}],
+            default_options={
+                'quantize_bounds': (minx, miny, maxx, maxy),
+                'extents': TILE_EXTENT
+            }
+        )
+
+        logger.debug(f"Rendered tile {z}/{x}/{y} with {len(features)} features ({len(tile)} bytes)")
+        return tile
+
+# Istanza condivisa da tutto il processo
+tile_renderer = TileRenderer()